@@ -0,0 +1,173 @@
+"""
+10. Batch Scoring
+    •	Scores every customer of a gold layer partition with the saved Random Forest model:
+        o	The partition is split into chunks of rows within its row groups, only the model features are read
+        o	Chunks are scored by a pool of worker processes, each worker loads its own copy of the model once
+        o	Gold features are already transformed with the fitted parameters of stage 6,
+            the same features the model was trained on
+    •	Churn probabilities are written as a parquet partition per file arrival
+"""
+
+import argparse
+import glob
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import util
+import forest_export
+from model_registry import ModelRegistry
+from feature_transforms import model_features
+from gold_dataset import customer_loan_info_path
+
+job_name = "10_batch_scoring"
+logging = util.get_logger(job_name)
+
+predictions_folder = "LocalDataLake/predictions/customer_churn/file_arrival="
+
+# model of a worker process, loaded once by init_worker
+model = None
+
+
+def init_worker(model_file):
+    global model
+    model = forest_export.load_model(model_file)
+
+
+def score_chunk(features):
+    """
+        :param features: dataframe with customer_id and the model features
+        :return : dataframe of customer_id, churn_probability and churn_prediction,
+                  null for customers with missing features
+    """
+    # not every model accepts missing values, customers with missing features get no score, as in 11
+    complete = features[model_features].notna().all(axis=1).to_numpy()
+    churn_probability = np.full(len(features), np.nan)
+    if complete.any():
+        churn_probability[complete] = model.predict_proba(features.loc[complete, model_features])[
+            :, list(model.classes_).index(1)]
+    churn_prediction = pd.array(np.where(churn_probability >= 0.5, 1, 0), dtype="Int8")
+    churn_prediction[~complete] = pd.NA
+    return pd.DataFrame({
+        "customer_id": features["customer_id"].to_numpy(),
+        "churn_probability": churn_probability,
+        "churn_prediction": churn_prediction,
+    })
+
+
+def scoring_tasks(parquet_files, chunk_size):
+    """
+        Splits gold files into row ranges of at most chunk_size rows, none of them across a row group
+        :param parquet_files: gold parquet files
+        :param chunk_size: number of rows of a task
+        :return : list of (parquet file, row group, first row, end row) tasks, rows counted within the row group
+    """
+    tasks = []
+    for parquet_file in parquet_files:
+        metadata = pq.ParquetFile(parquet_file).metadata
+        for row_group in range(metadata.num_row_groups):
+            num_rows = metadata.row_group(row_group).num_rows
+            tasks.extend((parquet_file, row_group, start, min(start + chunk_size, num_rows))
+                         for start in range(0, num_rows, chunk_size))
+    return tasks
+
+
+def score_row_range(parquet_file, row_group, start, end, output_file, chunk_size):
+    """
+        Scores rows start to end of a row group of a gold file into one predictions file
+        :return : number of rows scored
+    """
+    rows_scored = 0
+    writer = None
+    with util.Span(f"score {os.path.basename(output_file)}") as span:
+        try:
+            # a row group is the smallest unit parquet reads, a task reads its columns and keeps its own rows
+            table = pq.ParquetFile(parquet_file).read_row_group(row_group, columns=["customer_id"] + model_features)
+            for batch in table.slice(start, end - start).to_batches(max_chunksize=chunk_size):
+                span.bytes_read += batch.nbytes
+                predictions = pa.Table.from_pandas(score_chunk(batch.to_pandas()), preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(output_file, predictions.schema, compression="zstd")
+                writer.write_table(predictions)
+                rows_scored += predictions.num_rows
+        finally:
+            if writer is not None:
+                writer.close()
+        span.rows_in = span.rows_out = rows_scored
+        span.written(output_file)
+    return rows_scored
+
+
+def batch_scoring(file_arrival, model_file=None, chunk_size=100_000, max_workers=None, model_version=None):
+    """
+        Writes churn probabilities of all customers of a gold partition
+        :param file_arrival: gold partition to score
+        :param model_file: joblib model file or exported forest folder to score with, registry model when None
+        :param chunk_size: number of rows scored at a time by one worker
+        :param max_workers: number of worker processes, 1 scores in this process
+        :param model_version: registry version to score with, the promoted version when None
+        :return : number of rows scored
+    """
+    # the compiled tree traversal of the joblib model scores chunks of rows faster than the exported forest
+    model_file = model_file or ModelRegistry().artifact_path(model_version, prefer_forest=False)
+    gold_folder = f"{customer_loan_info_path}/file_arrival={file_arrival}"
+    output_folder = f"{predictions_folder}{file_arrival}"
+    logging.info(f"Scoring {gold_folder} with {model_file}")
+
+    # 1. one task per chunk of rows, a gold partition is often a single row group
+    tasks = scoring_tasks(sorted(glob.glob(f"{gold_folder}/*.parquet")), chunk_size)
+
+    os.makedirs(output_folder, exist_ok=True)
+    for old_file in glob.glob(f"{output_folder}/*.parquet"):
+        os.remove(old_file)
+    output_files = [f"{output_folder}/part-{i:05d}.parquet" for i in range(len(tasks))]
+
+    # 2. score row ranges, the model is loaded once per worker
+    logging.info(f"{len(tasks)} scoring tasks of up to {chunk_size} rows")
+    start = time.perf_counter()
+    if max_workers == 1 or len(tasks) <= 1:
+        init_worker(model_file)
+        rows_scored = sum(score_row_range(*task, output_file, chunk_size)
+                          for task, output_file in zip(tasks, output_files))
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=init_worker,
+                                 initargs=(model_file,)) as workers:
+            futures = [workers.submit(score_row_range, *task, output_file, chunk_size)
+                       for task, output_file in zip(tasks, output_files)]
+            rows_scored = sum(future.result() for future in futures)
+    elapsed = time.perf_counter() - start
+
+    logging.info(f"Scored {rows_scored} rows in {elapsed:.1f}s, {rows_scored / max(elapsed, 1e-9):.0f} rows/sec")
+    logging.info(f"Predictions are written to: {output_folder}")
+    return rows_scored
+
+
+def main():
+    logging.info(f"=== {job_name} started ===")
+
+    parser = argparse.ArgumentParser(description="score customer churn of a gold partition")
+    parser.add_argument("file_arrival_time", help="time of file arrival in YYYYMMDD")
+    parser.add_argument("--model-file", default=None,
+                        help="joblib model file or exported forest folder, overrides the model registry")
+    parser.add_argument("--model-version", type=int, default=None,
+                        help="model registry version to score with, the promoted version when not given")
+    parser.add_argument("--chunk-size", type=int, default=100_000, help="number of rows scored at a time")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes scoring chunks")
+    args = parser.parse_args()
+
+    file_arrival = args.file_arrival_time
+    logging.info(f"file_arrival : {file_arrival}")
+
+    with util.job_span(job_name, file_arrival):
+        batch_scoring(file_arrival, args.model_file, args.chunk_size, args.workers, args.model_version)
+
+    logging.info(f"=== {job_name} ended ===")
+
+
+if __name__ == "__main__":
+    main()
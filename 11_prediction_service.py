@@ -0,0 +1,257 @@
+"""
+11. Prediction Service
+    •	Long-running churn scoring service over HTTP:
+        o	The latest Random Forest model and the online feature client are loaded once and kept in memory
+        o	POST /predict takes {"customer_id": 1} or {"customer_ids": [1, 2, 3]}
+        o	Concurrent requests are coalesced into micro-batches, one online store read and one
+            predict_proba call per batch
+    •	GET /stats reports p50/p99 latency, throughput, batch sizes and feature cache counters
+"""
+
+import argparse
+import json
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+import util
+import forest_export
+from model_registry import ModelRegistry
+from feature_client import OnlineFeatureClient
+from feature_transforms import model_features
+
+job_name = "11_prediction_service"
+logging = util.get_logger(job_name)
+
+
+class LatencyStats:
+    """
+        Latencies of the last window_size requests, request and error counts since start
+    """
+
+    def __init__(self, window_size=10_000):
+        self.latencies = deque(maxlen=window_size)
+        self.batch_sizes = deque(maxlen=window_size)
+        self.lock = threading.Lock()
+        self.started_at = time.monotonic()
+        self.requests = 0
+        self.customers = 0
+        self.errors = 0
+
+    def record_request(self, latency_sec, customers):
+        with self.lock:
+            self.latencies.append(latency_sec)
+            self.requests += 1
+            self.customers += customers
+
+    def record_error(self):
+        with self.lock:
+            self.errors += 1
+
+    def record_batch(self, batch_size):
+        with self.lock:
+            self.batch_sizes.append(batch_size)
+
+    def summary(self):
+        with self.lock:
+            latencies_ms = np.array(self.latencies) * 1000
+            batch_sizes = np.array(self.batch_sizes)
+            uptime = time.monotonic() - self.started_at
+            return {
+                "requests": self.requests,
+                "customers": self.customers,
+                "errors": self.errors,
+                "uptime_sec": uptime,
+                "requests_per_sec": self.requests / uptime if uptime else 0.0,
+                "customers_per_sec": self.customers / uptime if uptime else 0.0,
+                "latency_p50_ms": float(np.percentile(latencies_ms, 50)) if len(latencies_ms) else None,
+                "latency_p99_ms": float(np.percentile(latencies_ms, 99)) if len(latencies_ms) else None,
+                "mean_batch_size": float(batch_sizes.mean()) if len(batch_sizes) else None,
+            }
+
+
+class MicroBatcher:
+    """
+        Collects customer ids of concurrent requests for at most max_wait_ms or max_batch_size customers
+        and scores them together on one thread
+    """
+
+    def __init__(self, model, feature_client, stats, max_batch_size=256, max_wait_ms=5):
+        self.model = model
+        self.feature_client = feature_client
+        self.stats = stats
+        self.max_batch_size = max_batch_size
+        self.max_wait_sec = max_wait_ms / 1000
+        self.requests = queue.Queue()
+        self.churn_class = list(model.classes_).index(1)
+        self.thread = threading.Thread(target=self.run, name="micro-batcher", daemon=True)
+        self.thread.start()
+
+    def predict(self, customer_ids):
+        """
+            Called by request threads, blocks until the batch of these customers is scored
+            :return : list of churn probabilities, None for customers without online features
+        """
+        future = Future()
+        self.requests.put((customer_ids, future))
+        return future.result()
+
+    def next_batch(self):
+        batch = [self.requests.get()]
+        batch_size = len(batch[0][0])
+        deadline = time.monotonic() + self.max_wait_sec
+        while batch_size < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(request)
+            batch_size += len(request[0])
+        return batch
+
+    def score(self, customer_ids):
+        features = self.feature_client.get_online_features(customer_ids)
+        known = features[model_features].notna().all(axis=1).to_numpy()
+        churn_probability = np.full(len(customer_ids), np.nan)
+        if known.any():
+            churn_probability[known] = self.model.predict_proba(features.loc[known, model_features])[:,
+                                                                                                     self.churn_class]
+        return [float(p) if known_customer else None for p, known_customer in zip(churn_probability, known)]
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            customer_ids = [customer_id for ids, _ in batch for customer_id in ids]
+            self.stats.record_batch(len(customer_ids))
+            try:
+                churn_probability = self.score(customer_ids)
+            except Exception as e:
+                logging.exception("Scoring of a micro-batch failed")
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            offset = 0
+            for ids, future in batch:
+                future.set_result(churn_probability[offset:offset + len(ids)])
+                offset += len(ids)
+
+
+class PredictionRequestHandler(BaseHTTPRequestHandler):
+    # set by serve()
+    batcher = None
+    stats = None
+    feature_client = None
+
+    def send_json(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self.send_json(200, {**self.stats.summary(), "feature_cache": self.feature_client.stats()})
+        elif self.path == "/health":
+            self.send_json(200, {"status": "ok"})
+        else:
+            self.send_json(404, {"error": f"unknown path {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/predict":
+            self.send_json(404, {"error": f"unknown path {self.path}"})
+            return
+        start = time.perf_counter()
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            customer_ids = body["customer_ids"] if "customer_ids" in body else [body["customer_id"]]
+            customer_ids = [int(customer_id) for customer_id in customer_ids]
+        except (ValueError, KeyError, TypeError) as e:
+            self.send_json(400, {"error": f"expected customer_id or customer_ids: {e}"})
+            return
+
+        try:
+            churn_probability = self.batcher.predict(customer_ids) if customer_ids else []
+        except Exception as e:
+            # the batcher logs the failure of the micro-batch, the request gets the error
+            self.stats.record_error()
+            self.send_json(500, {"error": f"scoring failed: {e}"})
+            return
+        self.send_json(200, {"predictions": [{"customer_id": customer_id, "churn_probability": p}
+                                             for customer_id, p in zip(customer_ids, churn_probability)]})
+        self.stats.record_request(time.perf_counter() - start, len(customer_ids))
+
+    def log_message(self, format, *args):
+        # access log per request would dominate the latency, errors are logged by the batcher
+        pass
+
+
+def serve(host="127.0.0.1", port=8080, model_file=None, max_batch_size=256, max_wait_ms=5, cache_size=100_000,
+          cache_ttl_seconds=300, model_version=None):
+    """
+        Loads model and feature client once and serves predictions until interrupted
+        :param model_file: joblib model file or exported forest folder to serve, registry model when None
+        :param max_batch_size: maximum number of customers scored in one micro-batch
+        :param max_wait_ms: longest time a request waits for other requests to join its micro-batch
+        :param cache_size: number of customers kept in the online feature cache
+        :param cache_ttl_seconds: seconds cached online features are served
+        :param model_version: registry version to serve, the promoted version when None
+    """
+    # requests carry a few customers each, the exported forest answers them faster than the joblib model
+    model_file = model_file or ModelRegistry().artifact_path(model_version, prefer_forest=True)
+    model = forest_export.load_model(model_file)
+    feature_client = OnlineFeatureClient([f"loan_features:{feature}" for feature in model_features],
+                                         cache_size=cache_size, ttl_seconds=cache_ttl_seconds)
+    feature_client.get_store()
+    stats = LatencyStats()
+
+    PredictionRequestHandler.batcher = MicroBatcher(model, feature_client, stats, max_batch_size, max_wait_ms)
+    PredictionRequestHandler.stats = stats
+    PredictionRequestHandler.feature_client = feature_client
+
+    server = ThreadingHTTPServer((host, port), PredictionRequestHandler)
+    logging.info(f"Serving {model_file} on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        logging.info(f"Prediction service stats: {stats.summary()}")
+
+
+def main():
+    logging.info(f"=== {job_name} started ===")
+
+    parser = argparse.ArgumentParser(description="serve customer churn predictions over HTTP")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--model-file", default=None,
+                        help="joblib model file or exported forest folder, overrides the model registry")
+    parser.add_argument("--model-version", type=int, default=None,
+                        help="model registry version to serve, the promoted version when not given")
+    parser.add_argument("--max-batch-size", type=int, default=256,
+                        help="maximum number of customers scored in one micro-batch")
+    parser.add_argument("--max-wait-ms", type=float, default=5,
+                        help="longest time a request waits for other requests to join its micro-batch")
+    parser.add_argument("--cache-size", type=int, default=100_000, help="number of customers in the feature cache")
+    parser.add_argument("--cache-ttl", type=float, default=300, help="seconds cached online features are served")
+    args = parser.parse_args()
+
+    serve(args.host, args.port, args.model_file, args.max_batch_size, args.max_wait_ms, args.cache_size,
+          args.cache_ttl, args.model_version)
+
+    logging.info(f"=== {job_name} ended ===")
+
+
+if __name__ == "__main__":
+    main()
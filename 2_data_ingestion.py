@@ -12,12 +12,19 @@
 """
 
 import pandas as pd
-import sqlite3
 import os
+import csv
+import json
+import glob
+import time
 from datetime import datetime
 import argparse
+from contextlib import closing
 
 import util
+import stage_cache
+import raw_layer
+from schemas import RAW_LOAN_INFO_SCHEMA, RAW_CUSTOMER_INFO_SCHEMA
 
 # get logger
 # file_arrival_date = datetime.now().strftime('%Y%m%d')
@@ -27,11 +34,143 @@ logging = util.get_logger(job_name)
 # Define paths
 landing_path = "./LocalDataLake/Landing"
 sqlite_db_path = "./db/customer_data.db"
+manifest_path = "./LocalDataLake/_manifest/landing_manifest.csv"
+manifest_fields = ["file_path", "size", "mtime", "sha256", "file_arrival"]
+customer_watermark_path = "./LocalDataLake/_manifest/customer_info_watermark.json"
 
 logging.info(f"Data ingestion job started. It will ingest Loan Info & Customer Info to Raw layer.")
 
 
-def data_ingestion(file_arrival_date):
+def load_manifest():
+    """
+        Reads the manifest of landing files already ingested to raw layer
+        :return : dict of file path -> manifest entry
+    """
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, newline="") as f:
+        return {row["file_path"]: row for row in csv.DictReader(f)}
+
+
+def save_manifest(manifest):
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    tmp_manifest_path = f"{manifest_path}.tmp"
+    with open(tmp_manifest_path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=manifest_fields)
+        writer.writeheader()
+        writer.writerows(manifest.values())
+    os.replace(tmp_manifest_path, manifest_path)
+
+
+def find_new_landing_files(manifest, full_refresh=False):
+    """
+        Lists landing files which are new or changed since they were last ingested.
+        Size and mtime are compared first, the content hash is computed only when they differ
+        :param manifest: manifest returned by load_manifest
+        :param full_refresh: ignore the manifest and return all landing files
+        :return : list of manifest entries of files to be ingested
+    """
+    new_files = []
+    for file_path in sorted(glob.glob(f"{landing_path}/*.csv")):
+        stat = os.stat(file_path)
+        entry = {"file_path": file_path, "size": str(stat.st_size), "mtime": str(stat.st_mtime_ns)}
+        known = manifest.get(file_path)
+        if not full_refresh and known and (known["size"], known["mtime"]) == (entry["size"], entry["mtime"]):
+            continue
+
+        entry["sha256"] = util.file_sha256(file_path)
+        if not full_refresh and known and known["sha256"] == entry["sha256"]:
+            # touched but not changed, remember the new mtime to skip hashing next time
+            known["mtime"] = entry["mtime"]
+            continue
+        new_files.append(entry)
+    return new_files
+
+
+def record_ingested_files(manifest, ingested_files, file_arrival_date):
+    for entry in ingested_files:
+        manifest[entry["file_path"]] = dict(entry, file_arrival=file_arrival_date)
+    save_manifest(manifest)
+
+
+def load_customer_watermark():
+    """
+        :return : dict of the highest customer id ingested and the file arrival of the last full extraction,
+                  empty before the first run
+    """
+    if not os.path.exists(customer_watermark_path):
+        return {}
+    with open(customer_watermark_path) as f:
+        return json.load(f)
+
+
+def save_customer_watermark(high_water_mark, file_arrival_date, after):
+    """
+        :param high_water_mark: highest customer id ingested
+        :param file_arrival_date: file arrival of this run
+        :param after: high water mark the customers were read after, None for a full extraction
+    """
+    full_extract = file_arrival_date if after is None else load_customer_watermark().get("full_extract")
+    os.makedirs(os.path.dirname(customer_watermark_path), exist_ok=True)
+    with open(customer_watermark_path, "w") as f:
+        json.dump({"id": high_water_mark, "full_extract": full_extract}, f)
+
+
+def customer_extract_after(file_arrival_date, incremental_customers, full_refresh, full_extract_days):
+    """
+        Decides whether customer_info is read in full or only after the high water mark of the last run.
+        customer_info has no column telling when a row was updated, the id watermark only finds new customers,
+        so the whole table is extracted again every full_extract_days to pick up updated customers.
+        :return : high water mark to read customers after, None to read the whole table
+    """
+    if not incremental_customers or full_refresh:
+        return None
+    watermark = load_customer_watermark()
+    after, full_extract = watermark.get("id"), watermark.get("full_extract")
+    # file_arrival is YYYYMMDD, optionally followed by the time of arrival
+    days_since_full_extract = None if full_extract is None else (
+        datetime.strptime(file_arrival_date[:8], "%Y%m%d") - datetime.strptime(full_extract[:8], "%Y%m%d")).days
+    if after is None or days_since_full_extract is None or days_since_full_extract >= full_extract_days:
+        logging.info(f"Customer Info is extracted in full, last full extraction: {full_extract}")
+        return None
+    logging.warning(f"Only customers with id above {after} are extracted. Updates of existing customers are "
+                    f"missed until the next full extraction, {full_extract_days} days after {full_extract}")
+    return after
+
+
+def iter_customer_info_pages(conn, page_size, max_memory_mb=None, after=None, watermark=None):
+    """
+        Reads customer_info table page by page on id with one connection
+        :param conn: read only connection, see util.connect_sqlite_readonly
+        :param page_size: maximum number of rows per page
+        :param max_memory_mb: memory ceiling for one page in MB, lowers page_size when needed
+        :param after: only customers with id greater than this high water mark are read
+        :param watermark: dict updated with the highest id read so far
+        :return : generator of dataframes
+    """
+    sample_df = next(util.iter_sqlite_pages(conn, "customer_info", "id", 1000, after), None)
+    if sample_df is None:
+        return
+    page_size = util.rows_within_memory_ceiling(sample_df, max_memory_mb, page_size)
+    for page in util.iter_sqlite_pages(conn, "customer_info", "id", page_size, after):
+        if pd.notna(page["id"].iloc[-1]):
+            watermark["id"] = int(page["id"].iloc[-1])
+        yield page
+
+
+def open_customer_info_db():
+    util.ensure_sqlite_index(sqlite_db_path, "customer_info", "id")
+    return util.connect_sqlite_readonly(sqlite_db_path)
+
+
+def data_ingestion(file_arrival_date, full_refresh=False, incremental_customers=False, page_size=100_000,
+                   customer_full_extract_days=7):
+    """
+        Ingests new Loan Info landing files and Customer Info table to the raw layer
+        :param customer_full_extract_days: with incremental_customers, days after which the whole customer_info
+                                           table is extracted again, so updated customers are picked up
+        :return : loan info and customer info dataframes as written to raw layer, None when nothing new arrived
+    """
     loan_info_raw_folder = f"./LocalDataLake/Raw/loan_info/file_arrival={file_arrival_date}"
     customer_info_raw_folder = f"./LocalDataLake/Raw/customer_info/file_arrival={file_arrival_date}"
 
@@ -39,27 +178,121 @@ def data_ingestion(file_arrival_date):
     os.makedirs(loan_info_raw_folder, exist_ok=True)
     os.makedirs(customer_info_raw_folder, exist_ok=True)
 
-    # 1. Read loan_info CSV
-    try:
-        loan_df = util.pd_read_csv_files(landing_path)
-        logging.info("Loan Info CSV file is loaded successfully.")
-    except FileNotFoundError:
-        logging.error(f"Loan Info CSV file not found at path: {landing_path}, Please upload.")
+    # 1. Read loan_info CSV files which are not ingested yet
+    manifest = load_manifest()
+    landing_files = find_new_landing_files(manifest, full_refresh)
+    loan_df = None
+    if landing_files:
+        with util.Span("read_landing_files") as span:
+            span.read(*[entry["file_path"] for entry in landing_files])
+            loan_df = util.pd_concat_csv_files([entry["file_path"] for entry in landing_files])
+            span.rows_out = len(loan_df)
+        logging.info(f"Loan Info CSV file is loaded successfully. {len(landing_files)} new files.")
+    else:
+        logging.warning(f"No new Loan Info CSV file found at path: {landing_path}, Please upload.")
 
-    # 2. Read customer_info table from SQLite
-    conn = sqlite3.connect(sqlite_db_path)
+    # 2. Read customer_info table from SQLite, page by page on id
+    after = customer_extract_after(file_arrival_date, incremental_customers, full_refresh, customer_full_extract_days)
+    watermark = {"id": after}
+    customer_df = None
     try:
-        customer_df = pd.read_sql_query("SELECT * FROM customer_info", conn)
-        logging.info("Customer Info is successfully loaded from database.")
+        with util.Span("read_customer_info_db") as span:
+            with closing(open_customer_info_db()) as conn:
+                pages = list(iter_customer_info_pages(conn, page_size, after=after, watermark=watermark))
+            span.rows_out = sum(len(page) for page in pages)
+        if pages:
+            customer_df = pd.concat(pages, ignore_index=True)
+            logging.info(f"Customer Info is successfully loaded from database. {len(customer_df)} customers "
+                         f"after id {after}.")
+        else:
+            logging.warning(f"No new Customer Info found in database after id {after}.")
+        # stage 5 reads the earlier partitions of the customer table too when this one is incremental
+        raw_layer.mark_customer_partition(customer_info_raw_folder, after)
     except Exception as e:
         logging.error(f"An error occurred while loading Customer Info from database: {e}")
-    conn.close()
 
-    # 3. Write both DataFrames to CSV
-    loan_df.to_csv(os.path.join(loan_info_raw_folder, "loan_info.csv"), index=False)
-    customer_df.to_csv(os.path.join(customer_info_raw_folder, "customer_info.csv"), index=False)
+    # 3. Write both DataFrames to Parquet
+    with util.Span("write_raw") as span:
+        if loan_df is not None:
+            loan_df = util.pd_conform_to_schema(loan_df, RAW_LOAN_INFO_SCHEMA)
+            util.pd_write_parquet(loan_df, os.path.join(loan_info_raw_folder, "loan_info.parquet"),
+                                  RAW_LOAN_INFO_SCHEMA)
+            record_ingested_files(manifest, landing_files, file_arrival_date)
+        if customer_df is not None:
+            customer_df = util.pd_conform_to_schema(customer_df, RAW_CUSTOMER_INFO_SCHEMA)
+            util.pd_write_parquet(customer_df, os.path.join(customer_info_raw_folder, "customer_info.parquet"),
+                                  RAW_CUSTOMER_INFO_SCHEMA)
+            save_customer_watermark(watermark["id"], file_arrival_date, after)
+        span.rows_in = sum(len(df) for df in (loan_df, customer_df) if df is not None)
+        span.written(loan_info_raw_folder, customer_info_raw_folder)
 
     logging.info("Data Ingestion job is successfully completed. Files written to raw folder in Parquet format.")
+    return loan_df, customer_df
+
+
+def data_ingestion_streaming(file_arrival_date, chunk_size=100_000, max_memory_mb=None, full_refresh=False,
+                             incremental_customers=False, customer_full_extract_days=7):
+    """
+        Streams Loan Info landing files and Customer Info rows to the raw layer in fixed size batches
+        :param file_arrival_date: file arrival partition to write
+        :param chunk_size: maximum number of rows held in memory at a time
+        :param max_memory_mb: memory ceiling for one batch in MB, lowers chunk_size when needed
+        :param full_refresh: ingest all landing files and customers, ignoring manifest and watermark
+        :param incremental_customers: only ingest customers with id above the last high water mark
+        :param customer_full_extract_days: with incremental_customers, days after which the whole customer_info
+                                           table is extracted again, so updated customers are picked up
+    """
+    loan_info_raw_folder = f"./LocalDataLake/Raw/loan_info/file_arrival={file_arrival_date}"
+    customer_info_raw_folder = f"./LocalDataLake/Raw/customer_info/file_arrival={file_arrival_date}"
+
+    os.makedirs(loan_info_raw_folder, exist_ok=True)
+    os.makedirs(customer_info_raw_folder, exist_ok=True)
+
+    logging.info(f"Streaming ingestion with chunk_size={chunk_size}, max_memory_mb={max_memory_mb}")
+    start_time = time.perf_counter()
+
+    # 1. Stream loan_info CSV files which are not ingested yet
+    manifest = load_manifest()
+    landing_files = find_new_landing_files(manifest, full_refresh)
+    loan_rows = 0
+    if landing_files:
+        csv_files = [entry["file_path"] for entry in landing_files]
+        with util.Span("stream_landing_files") as span:
+            span.read(*csv_files)
+            loan_rows = util.write_chunks_to_parquet(util.iter_csv_chunks(csv_files, chunk_size, max_memory_mb),
+                                                     os.path.join(loan_info_raw_folder, "loan_info.parquet"),
+                                                     RAW_LOAN_INFO_SCHEMA)
+            span.rows_in = span.rows_out = loan_rows
+            span.written(loan_info_raw_folder)
+        record_ingested_files(manifest, landing_files, file_arrival_date)
+        logging.info(f"Loan Info is streamed to raw layer: {loan_rows} rows from {len(landing_files)} files.")
+    else:
+        logging.warning(f"No new Loan Info CSV file found at path: {landing_path}, Please upload.")
+
+    # 2. Stream customer_info table from SQLite, page by page on id
+    after = customer_extract_after(file_arrival_date, incremental_customers, full_refresh, customer_full_extract_days)
+    watermark = {"id": after}
+    customer_rows = 0
+    try:
+        with util.Span("stream_customer_info_db") as span:
+            # the connection is closed also when a page or the parquet write fails
+            with closing(open_customer_info_db()) as conn:
+                pages = iter_customer_info_pages(conn, chunk_size, max_memory_mb, after, watermark)
+                customer_rows = util.write_chunks_to_parquet(
+                    pages, os.path.join(customer_info_raw_folder, "customer_info.parquet"),
+                    RAW_CUSTOMER_INFO_SCHEMA)
+            span.rows_in = span.rows_out = customer_rows
+            span.written(customer_info_raw_folder)
+        save_customer_watermark(watermark["id"], file_arrival_date, after)
+        raw_layer.mark_customer_partition(customer_info_raw_folder, after)
+        logging.info(f"Customer Info is streamed to raw layer: {customer_rows} rows after id {after}.")
+    except Exception as e:
+        logging.error(f"An error occurred while loading Customer Info from database: {e}")
+
+    elapsed = time.perf_counter() - start_time
+    total_rows = loan_rows + customer_rows
+    logging.info(f"Data Ingestion job is successfully completed. {total_rows} rows in {elapsed:.2f}s "
+                 f"({total_rows / elapsed if elapsed else 0:.0f} rows/sec).")
 
 
 def main():
@@ -67,13 +300,40 @@ def main():
 
     parser = argparse.ArgumentParser(description="Model customer churn prediction")
     parser.add_argument("file_arrival_time", help="time of file arrival in YYYYMMDD_HHMMSS")
+    parser.add_argument("--chunk-size", type=int, default=None,
+                        help="stream landing files and customer rows in batches of this many rows")
+    parser.add_argument("--max-memory-mb", type=float, default=None,
+                        help="memory ceiling for one streamed batch, implies streaming mode")
+    parser.add_argument("--full-refresh", action="store_true",
+                        help="ingest all landing files and customers, ignoring manifest and watermark")
+    parser.add_argument("--incremental-customers", action="store_true",
+                        help="only ingest customers with id above the high water mark of the last run, "
+                             "data preparation reads them together with the earlier customer_info partitions. "
+                             "Updated customers are missed until the next full extraction")
+    parser.add_argument("--customer-full-extract-days", type=int, default=7,
+                        help="with --incremental-customers, extract the whole customer_info table again when the "
+                             "last full extraction is this many days old")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="run the stage even when its inputs, parameters and code are unchanged since a cached run")
     args = parser.parse_args()
 
     file_arrival = args.file_arrival_time
 
     logging.info(f"file_arrival : {file_arrival}")
 
-    data_ingestion(file_arrival)
+    def run():
+        if args.chunk_size or args.max_memory_mb:
+            data_ingestion_streaming(file_arrival, args.chunk_size or 100_000, args.max_memory_mb,
+                                     args.full_refresh, args.incremental_customers, args.customer_full_extract_days)
+        else:
+            data_ingestion(file_arrival, args.full_refresh, args.incremental_customers,
+                           customer_full_extract_days=args.customer_full_extract_days)
+
+    with util.job_span(job_name, file_arrival):
+        cache = None if args.no_cache else stage_cache.StageCache()
+        skipped, _ = stage_cache.run_cached("ingestion", file_arrival, stage_cache.params_of_args(args), run, cache)
+        if skipped:
+            logging.info("Skipped, outputs of the same inputs, parameters and code are already written")
 
     logging.info(f"=== {job_name} ended ===")
 
@@ -1,21 +1,35 @@
 import pandas as pd
 import sqlite3
 import os
+import argparse
+
+parser = argparse.ArgumentParser(description="load the customer info csv into the customer_info table of SQLite")
+parser.add_argument("csv_path", nargs="?", default="./sample_data/customer_info_table.csv",
+                    help="customer info csv, e.g. written by benchmarks/generate_synthetic_data.py")
+parser.add_argument("--chunk-size", type=int, default=1_000_000, help="number of csv rows loaded at a time")
+args = parser.parse_args()
 
 # Paths
-csv_path = "./sample_data/customer_info_table.csv"
+csv_path = args.csv_path
 db_path = "./db/customer_data.db"
 table_name = "customer_info"
 
 # Creating db folder if not exists
 os.makedirs(os.path.dirname(db_path), exist_ok=True)
 
-# 1. Reading customer info CSV file
-df = pd.read_csv(csv_path)
-
-# 2. Create SQLite DB and write table
+# 1. Create SQLite DB, the table is rebuilt from the csv, so a crash during the load only loses the load
 conn = sqlite3.connect(db_path)
-df.to_sql(table_name, conn, index=False, if_exists="replace")
+conn.execute("PRAGMA synchronous = OFF")
+
+# 2. Reading customer info CSV file chunk by chunk and writing it to the table
+rows_loaded = 0
+for chunk_number, df in enumerate(pd.read_csv(csv_path, chunksize=args.chunk_size)):
+    df.to_sql(table_name, conn, index=False, if_exists="replace" if chunk_number == 0 else "append")
+    rows_loaded += len(df)
+
+# 3. Index id, so ingestion can read the table page by page on id
+conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table_name}_id ON {table_name} (id)")
+conn.commit()
 conn.close()
 
-print(f"SQLite database created at {db_path} with table '{table_name}'.")
\ No newline at end of file
+print(f"SQLite database created at {db_path} with table '{table_name}', {rows_loaded} rows loaded from {csv_path}.")
\ No newline at end of file
@@ -15,17 +15,83 @@ from datetime import datetime
 import csv
 import os
 
-from great_expectations.validator.validator import Validator
-from great_expectations.core.batch import Batch
-from great_expectations.datasource.fluent import PandasDatasource
-import great_expectations as ge
-
 import util
+import stage_cache
+import categories
+import validation_engine
 
 job_name = "4_data_validation"
 logging = util.get_logger(job_name)
 validation_reports_path = "./validation_reports"
-context = ge.get_context()
+validation_report_fields = ["expectation", "column", "success", "result"]
+
+# great_expectations context is created on first use of the ge engine
+context = None
+
+# rules: (expectation, column, kwargs), column is None for table expectations
+loan_info_rules = [
+    # check expected columns
+    ("expect_table_columns_to_match_ordered_list", None,
+     {"column_list": ["id", "default", "balance", "housing", "loan", "contact", "day", "month", "duration",
+                      "campaign", "pdays", "previous", "poutcome", "y"]}),
+
+    # check column types, as declared in schemas.RAW_LOAN_INFO_SCHEMA
+    ("expect_column_values_to_be_of_type", "id", {"type_": "int32"}),
+    ("expect_column_values_to_be_of_type", "balance", {"type_": "int32"}),
+    ("expect_column_values_to_be_of_type", "day", {"type_": "int8"}),
+    ("expect_column_values_to_be_of_type", "duration", {"type_": "int32"}),
+    ("expect_column_values_to_be_of_type", "campaign", {"type_": "int16"}),
+    ("expect_column_values_to_be_of_type", "pdays", {"type_": "int16"}),
+    ("expect_column_values_to_be_of_type", "previous", {"type_": "int16"}),
+
+    # check categorical column values, vocabularies of categories.py
+    ("expect_column_values_to_be_in_set", "default", {"value_set": categories.YES_NO.values}),
+    ("expect_column_values_to_be_in_set", "housing", {"value_set": categories.YES_NO.values}),
+    ("expect_column_values_to_be_in_set", "loan", {"value_set": categories.YES_NO.values}),
+    ("expect_column_values_to_be_in_set", "contact", {"value_set": categories.CONTACT_COMMUNICATION_TYPE.values}),
+    ("expect_column_values_to_be_in_set", "month", {"value_set": categories.CONTACTED_MONTH.values}),
+    ("expect_column_values_to_be_in_set", "poutcome", {"value_set": categories.OUTCOME_OF_PREVIOUS_CAMPAIGN.values}),
+    ("expect_column_values_to_be_in_set", "y", {"value_set": categories.YES_NO.values}),
+
+    # check numerical columns values range
+    ("expect_column_values_to_be_between", "balance", {"min_value": 0}),
+    ("expect_column_values_to_be_between", "day", {"min_value": 1, "max_value": 31}),
+    ("expect_column_values_to_be_between", "duration", {"min_value": 0}),
+    ("expect_column_values_to_be_between", "campaign", {"min_value": 0}),
+    ("expect_column_values_to_be_between", "pdays", {"min_value": 0}),
+    ("expect_column_values_to_be_between", "previous", {"min_value": 0}),
+
+    # check uniqueness check
+    ("expect_column_values_to_be_unique", "id", {}),
+
+    # check nulls
+    ("expect_column_values_to_not_be_null", "id", {}),
+    ("expect_column_values_to_not_be_null", "y", {}),
+]
+
+customer_info_rules = [
+    # check expected columns
+    ("expect_table_columns_to_match_ordered_list", None, {"column_list": ["id", "age", "job", "marital", "education"]}),
+
+    # check column types, as declared in schemas.RAW_CUSTOMER_INFO_SCHEMA
+    ("expect_column_values_to_be_of_type", "id", {"type_": "int32"}),
+    ("expect_column_values_to_be_of_type", "age", {"type_": "int16"}),
+
+    # check categorical column values, vocabularies of categories.py
+    ("expect_column_values_to_be_in_set", "job", {"value_set": categories.JOB_TYPE.values}),
+    ("expect_column_values_to_be_in_set", "marital", {"value_set": categories.MARITAL_STATUS.values}),
+    ("expect_column_values_to_be_in_set", "education", {"value_set": categories.EDUCATIONAL_LEVEL.values}),
+
+    # check numerical columns values range
+    ("expect_column_values_to_be_between", "id", {"min_value": 0}),
+    ("expect_column_values_to_be_between", "age", {"min_value": 0, "max_value": 100}),
+
+    # check uniqueness check
+    ("expect_column_values_to_be_unique", "id", {}),
+
+    # check nulls
+    ("expect_column_values_to_not_be_null", "id", {}),
+]
 
 
 def prepare_validation_summary(validation_results_dict):
@@ -44,143 +110,143 @@ def prepare_validation_summary(validation_results_dict):
     return failed_results
 
 
-def validate_loan_info(loan_file_path):
-    logging.info("Data validation for Loan Info file is started")
-    loan_df = util.pd_read_csv_files(loan_file_path)
+def validate_with_ge(df, rules, datasource_name):
+    """
+        Evaluates a rules table with great_expectations
+        :return : great_expectations validation results as dict
+    """
+    from great_expectations.validator.validator import Validator
+    from great_expectations.core.batch import Batch
+    from great_expectations.datasource.fluent import PandasDatasource
+    import great_expectations as ge
 
-    datasource = PandasDatasource(name="loan_data_source")
+    global context
+    if context is None:
+        context = ge.get_context()
+
+    datasource = PandasDatasource(name=datasource_name)
     validator = Validator(
         execution_engine=datasource.get_execution_engine(),
-        batches=[Batch(data=loan_df)],
+        batches=[Batch(data=df)],
         context=context
     )
+    for expectation, column, kwargs in rules:
+        if column is None:
+            getattr(validator, expectation)(**kwargs)
+        else:
+            getattr(validator, expectation)(column, **kwargs)
+    return validator.validate().to_json_dict()
+
+
+def validate_rules(file_path, df, rules, datasource_name, engine, chunk_size=None, max_workers=None):
+    """
+        Evaluates a rules table with the chosen engine
+        :param file_path: raw layer partition, read when df is None
+        :param df: dataframe already in memory or None
+        :param chunk_size: with the native engine, validate the partition in chunks of this many rows
+                           instead of loading it in memory
+        :param max_workers: number of worker processes validating chunks
+        :return : validation results as dict
+    """
+    with util.Span(f"validate_{datasource_name}") as span:
+        if df is None:
+            span.read(file_path)
+        if df is None and chunk_size and engine == "native":
+            return validation_engine.validate_parquet_partition(file_path, rules, chunk_size, max_workers)
+        if df is None:
+            df = util.pd_read_parquet_files(file_path)
+        span.rows_in = len(df)
+        if engine == "ge":
+            return validate_with_ge(df, rules, datasource_name)
+        return validation_engine.validate(df, rules)
+
+
+def write_validation_report(report_path, failed_validations):
+    with open(report_path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=validation_report_fields)
+        writer.writeheader()
+        writer.writerows(failed_validations)
 
-    # Check expected columns
-    validator.expect_table_columns_to_match_ordered_list(
-        ["id", "default", "balance", "housing", "loan", "contact", "day", "month", "duration", "campaign", "pdays",
-         "previous", "poutcome", "y"])
-
-    # check column types
-    validator.expect_column_values_to_be_of_type("id", "int64")
-    validator.expect_column_values_to_be_of_type("balance", "int64")
-    validator.expect_column_values_to_be_of_type("day", "int64")
-    validator.expect_column_values_to_be_of_type("duration", "int64")
-    validator.expect_column_values_to_be_of_type("campaign", "int64")
-    validator.expect_column_values_to_be_of_type("pdays", "int64")
-    validator.expect_column_values_to_be_of_type("previous", "int64")
-
-    # check categorical column values
-    validator.expect_column_values_to_be_in_set("default", ["yes", "no"])
-    validator.expect_column_values_to_be_in_set("housing", ["yes", "no"])
-    validator.expect_column_values_to_be_in_set("loan", ["yes", "no"])
-    validator.expect_column_values_to_be_in_set("contact", ["cellular", "telephone"])
-    validator.expect_column_values_to_be_in_set("month",
-                                                ["jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct",
-                                                 "nov", "dec"])
-    validator.expect_column_values_to_be_in_set("poutcome", ["failure", "success"])
-    validator.expect_column_values_to_be_in_set("y", ["yes", "no"])
-
-    # check numerical columns values range
-    validator.expect_column_values_to_be_between("balance", min_value=0)
-    validator.expect_column_values_to_be_between("day", min_value=1, max_value=31)
-    validator.expect_column_values_to_be_between("duration", min_value=0)
-    validator.expect_column_values_to_be_between("campaign", min_value=0)
-    validator.expect_column_values_to_be_between("pdays", min_value=0)
-    validator.expect_column_values_to_be_between("previous", min_value=0)
-
-    # check uniqueness check
-    validator.expect_column_values_to_be_unique("id")
 
-    # check nulls
-    validator.expect_column_values_to_not_be_null("id")
-    validator.expect_column_values_to_not_be_null("y")
+def validate_loan_info(loan_file_path, reports_path=validation_reports_path, loan_df=None, engine="native",
+                       chunk_size=None, max_workers=None):
+    logging.info("Data validation for Loan Info file is started")
 
     # generate summary
-    results = validator.validate()
-    loan_info_validation_report = f"{validation_reports_path}/loan_info_validation_report.csv"
-    failed_validations = prepare_validation_summary(results.to_json_dict())
-
-    with open(loan_info_validation_report, "w", newline="") as f:
-        writer = csv.DictWriter(f, fieldnames=failed_validations[0].keys())
-        writer.writeheader()
-        writer.writerows(failed_validations)
+    results = validate_rules(loan_file_path, loan_df, loan_info_rules, "loan_data_source", engine, chunk_size,
+                             max_workers)
+    loan_info_validation_report = f"{reports_path}/loan_info_validation_report.csv"
+    failed_validations = prepare_validation_summary(results)
+    write_validation_report(loan_info_validation_report, failed_validations)
 
     logging.info("Data validation for Loan Info file is completed")
     logging.info(f"Loan info validation summary is available at :{loan_info_validation_report}")
 
 
-def validate_customer_info(customer_file_path):
+def validate_customer_info(customer_file_path, reports_path=validation_reports_path, customer_df=None,
+                           engine="native", chunk_size=None, max_workers=None):
     logging.info("Data validation for Customer file is started")
-    customer_df = util.pd_read_csv_files(customer_file_path)
 
-    datasource = PandasDatasource(name="customer_data_source")
-    validator = Validator(
-        execution_engine=datasource.get_execution_engine(),
-        batches=[Batch(data=customer_df)],
-        context=context
-    )
-    # check expected columns
-    validator.expect_table_columns_to_match_ordered_list(
-        ["id", "age", "job", "marital", "education"])
-
-    # check column types
-    validator.expect_column_values_to_be_of_type("id", "int")
-    validator.expect_column_values_to_be_of_type("age", "int")
-
-    # check categorical column values
-    validator.expect_column_values_to_be_in_set("job", ["admin", "blue-collar", "entrepreneur", "housemaid",
-                                                        "management", "retired", "self-employed", "services",
-                                                        "student", "technician", "unemployed"])
-    validator.expect_column_values_to_be_in_set("marital", ["single", "married", "divorced"])
-    validator.expect_column_values_to_be_in_set("education", ["primary", "secondary", "tertiary"])
-
-    # check numerical columns values range
-    validator.expect_column_values_to_be_between("id", min_value=0)
-    validator.expect_column_values_to_be_between("age", min_value=0, max_value=100)
+    # generate summary
+    results = validate_rules(customer_file_path, customer_df, customer_info_rules, "customer_data_source", engine,
+                             chunk_size, max_workers)
+    customer_info_validation_report = f"{reports_path}/customer_validation_report.csv"
+    failed_validations = prepare_validation_summary(results)
+    write_validation_report(customer_info_validation_report, failed_validations)
 
-    # check uniqueness check
-    validator.expect_column_values_to_be_unique("id")
+    logging.info("Data validation for Customer Info file is completed")
+    logging.info(f"Loan info validation summary is available at :{customer_info_validation_report}")
 
-    # check nulls
-    validator.expect_column_values_to_not_be_null("id")
 
-    # generate summary
-    results = validator.validate()
-    customer_info_validation_report = f"{validation_reports_path}/customer_validation_report.csv"
+def data_validation(file_arrival, loan_df=None, customer_df=None, engine="native", chunk_size=None,
+                    max_workers=None):
+    """
+        Validates the raw layer partition of a file arrival
+        :param file_arrival: file arrival partition to validate
+        :param loan_df: loan info dataframe already in memory, read from raw layer when None
+        :param customer_df: customer info dataframe already in memory, read from raw layer when None
+        :param engine: "native" validation engine or "ge" for great_expectations
+        :param chunk_size: with the native engine, validate partitions in chunks of this many rows
+        :param max_workers: number of worker processes validating chunks
+    """
+    loan_file_path = f"./LocalDataLake/Raw/loan_info/file_arrival={file_arrival}"
+    customer_file_path = f"./LocalDataLake/Raw/customer_info/file_arrival={file_arrival}"
 
-    failed_validations = prepare_validation_summary(results.to_json_dict())
+    logging.info(f"loan_file_path: {loan_file_path}")
+    logging.info(f"customer_file_path: {customer_file_path}")
 
-    with open(customer_info_validation_report, "w", newline="") as f:
-        writer = csv.DictWriter(f, fieldnames=failed_validations[0].keys())
-        writer.writeheader()
-        writer.writerows(failed_validations)
+    # make validation directory for this file arrival
+    reports_path = f"{validation_reports_path}/{file_arrival}"
+    os.makedirs(reports_path, exist_ok=True)
 
-    logging.info("Data validation for Customer Info file is completed")
-    logging.info(f"Loan info validation summary is available at :{customer_info_validation_report}")
+    validate_loan_info(loan_file_path, reports_path, loan_df, engine, chunk_size, max_workers)
+    validate_customer_info(customer_file_path, reports_path, customer_df, engine, chunk_size, max_workers)
 
 
 def main():
     logging.info(f"=== {job_name} started ===")
     parser = argparse.ArgumentParser(description="generate validation report for loan and customer info")
     parser.add_argument("file_arrival_time", help="time of file arrival in YYYYMMDD_HHMMSS")
+    parser.add_argument("--engine", choices=["native", "ge"], default="native",
+                        help="validation engine, native engine or great_expectations")
+    parser.add_argument("--chunk-size", type=int, default=None,
+                        help="native engine only: validate raw partitions in chunks of this many rows")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes validating chunks")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="run the stage even when its inputs, parameters and code are unchanged since a cached run")
     args = parser.parse_args()
 
     file_arrival = args.file_arrival_time
     logging.info(f"file_arrival for this job: {file_arrival}")
 
-    loan_file_path = f"./LocalDataLake/Raw/loan_info/file_arrival={file_arrival}"
-    customer_file_path = f"./LocalDataLake/Raw/customer_info/file_arrival={file_arrival}"
-
-    logging.info(f"loan_file_path: {loan_file_path}")
-    logging.info(f"customer_file_path: {customer_file_path}")
-
-    # make validation directory for this file arrival
-    global validation_reports_path
-    validation_reports_path = f"{validation_reports_path}/{file_arrival}"
-    os.makedirs(validation_reports_path, exist_ok=True)
-
-    validate_loan_info(loan_file_path)
-    validate_customer_info(customer_file_path)
+    with util.job_span(job_name, file_arrival):
+        cache = None if args.no_cache else stage_cache.StageCache()
+        skipped, _ = stage_cache.run_cached(
+            "validation", file_arrival, stage_cache.params_of_args(args),
+            lambda: data_validation(file_arrival, engine=args.engine, chunk_size=args.chunk_size,
+                                    max_workers=args.workers), cache)
+        if skipped:
+            logging.info("Skipped, outputs of the same inputs, parameters and code are already written")
 
     logging.info(f"=== {job_name} ended ===")
 
@@ -14,136 +14,304 @@
 import os
 import argparse
 
+import numpy as np
+import pandas as pd
+
 import util
+import stage_cache
+import categories
+import raw_layer
+from schemas import SILVER_CUSTOMER_INFO_SCHEMA, SILVER_LOAN_INFO_SCHEMA
 
 job_name = "5_data_preparation"
 logging = util.get_logger(job_name)
 
-customer_info_raw_path = "LocalDataLake/Raw/customer_info"
+customer_info_raw_path = raw_layer.customer_info_raw_path
 loan_info_raw_path = "LocalDataLake/Raw/loan_info"
 
 loan_info_clean_folder = "LocalDataLake/silver/loan_info/file_arrival="
 customer_info_clean_folder = "LocalDataLake/silver/customer_info/file_arrival="
 
+# raw column -> silver column, to match column description
+customer_info_columns = {'id': 'customer_id', 'age': 'age', 'job': 'job_type', 'marital': 'marital_status',
+                         'education': 'educational_level'}
+
+# days_passed_from_last_campaign (pdays), outcome_of_previous_campaign (poutcome), contact_communication_type
+# (contact) and total_times_contacted_before_this_campaign (previous) are not read from raw layer,
+# since they have mostly -1/unknown as a value and are not valid
+loan_info_columns = {'id': 'customer_id', 'default': 'has_credit', 'balance': 'avg_yearly_balance',
+                     'housing': 'has_housing_loan', 'loan': 'has_personal_loan', 'day': 'contacted_day',
+                     'month': 'contacted_month', 'duration': 'contacted_duration_sec',
+                     'campaign': 'total_times_contacted', 'y': 'outcome'}
+
+customer_numeric_columns = ['customer_id', 'age']
+loan_numeric_columns = ['customer_id', 'avg_yearly_balance', 'contacted_day', 'contacted_duration_sec',
+                        'total_times_contacted']
+
+customer_outlier_columns = ['age']
+loan_outlier_columns = ['avg_yearly_balance', 'contacted_duration_sec', 'total_times_contacted']
 
-def get_LF_UF_3STD(df, col):
-    mean = df[col].mean()
-    std = df[col].std()
-    LF = mean - 3 * std
-    UF = mean + 3 * std
-    return LF, UF
 
+def get_outlier_fences(stats, cols):
+    """
+        Lower and upper fences of the 3 Standard Deviation method for all columns at once
+        :param stats: util.RunningStats of the columns
+        :param cols: column names on which outliers to be removed
+        :return : dict of column -> (lower fence, upper fence)
+    """
+    std = dict(zip(stats.columns, stats.std()))
+    mean = dict(zip(stats.columns, stats.mean))
+    return {col: (mean[col] - 3 * std[col], mean[col] + 3 * std[col]) for col in cols}
 
-def remove_outliers(df, col):
+
+def outlier_mask(df, fences, rows_to_keep=None):
     """
-        Filters outliers in a column using 3 Standard Deviation method
-        :param df:  input dataframe
-        :param col: column name on which outliers to be removed
-        :return : input data frame with outliers removed
+        Combines the fences of all columns into one mask of rows to keep
+        :param df: input dataframe
+        :param fences: dict of column -> (lower fence, upper fence), see get_outlier_fences
+        :param rows_to_keep: mask of rows kept by earlier cleaning steps
+        :return : mask of rows to keep, dict of column -> number of outliers
     """
-    LF, UF = get_LF_UF_3STD(df, col)
-    records_before_cleaning = len(df[col])
-    df = df[(df[col] >= LF) & (df[col] <= UF)]
+    keep = np.ones(len(df), dtype=bool) if rows_to_keep is None else rows_to_keep
+    records_cleaned = {}
+    for col, (LF, UF) in fences.items():
+        values = df[col].to_numpy()
+        outliers = keep & ~((values >= LF) & (values <= UF))
+        records_cleaned[col] = int(outliers.sum())
+        keep = keep & ~outliers
+    return keep, records_cleaned
+
 
-    logging.info("-" * 5 + " Removing outliers for {col.upper()} " + "-" * 5)
-    logging.info(f"Min-Max {df[col].min()}-{df[col].max()}")
-    logging.info(f"Lower_Fence-Upper_Fence {LF}, {UF}")
-    logging.info(f"Records Cleaned: {records_before_cleaning - len(df[col])}")
-    return df
+def log_outliers(fences, records_cleaned, clean_stats):
+    min_max = dict(zip(clean_stats.columns, zip(clean_stats.min, clean_stats.max)))
+    for col, (LF, UF) in fences.items():
+        logging.info("-" * 5 + f" Removing outliers for {col.upper()} " + "-" * 5)
+        logging.info(f"Min-Max {min_max[col][0]}-{min_max[col][1]}")
+        logging.info(f"Lower_Fence-Upper_Fence {LF}, {UF}")
+        logging.info(f"Records Cleaned: {records_cleaned[col]}")
 
 
-def data_preparation(file_arrival):
-    customer_info = util.pd_read_csv_files(f"{customer_info_raw_path}/file_arrival={file_arrival}")
-    loan_info = util.pd_read_csv_files(f"{loan_info_raw_path}/file_arrival={file_arrival}")
+def known_customer_mask(customer_info):
+    return ((customer_info['job_type'] != 'unknown') & (customer_info['educational_level'] != 'unknown')).to_numpy()
+
+
+@util.Span("clean_customer_info")
+def clean_customer_info(customer_info, fences):
+    """
+        Removes unknown values and outliers of Customer Info with one combined mask and encodes it
+        :return : cleaned dataframe, dict of column -> number of outliers
+    """
+    # 4. Handle missing values: remove rows with unknown values
+    # 7. Standardize or normalize numerical : Remove outliers
+    keep, records_cleaned = outlier_mask(customer_info, fences, known_customer_mask(customer_info))
+    customer_info_clean = customer_info[keep]
+
+    # 5. Handle wrong values: replace .admin with admin in job column
+    customer_info_clean['job_type'] = categories.replace_categories(customer_info_clean['job_type'],
+                                                                    {'admin.': 'admin'})
+
+    # 9. label encoding of categorical features of multiclass, see categories.py
+    customer_info_clean['job_type_encoded'] = categories.JOB_TYPE.encode(customer_info_clean['job_type'])
+    customer_info_clean['marital_status_encoded'] = categories.MARITAL_STATUS.encode(
+        customer_info_clean['marital_status'])
+    customer_info_clean['educational_level_encoded'] = categories.EDUCATIONAL_LEVEL.encode(
+        customer_info_clean['educational_level'])
+    return customer_info_clean, records_cleaned
+
+
+@util.Span("clean_loan_info")
+def clean_loan_info(loan_info, fences):
+    """
+        Removes outliers of Loan Info with one combined mask and encodes it
+        :return : cleaned dataframe, dict of column -> number of outliers
+    """
+    # 6. Handle missing columns: invalid loan info columns are already skipped while reading, see loan_info_columns
+
+    # 7. Standardize or normalize numerical : Remove outliers
+    keep, records_cleaned = outlier_mask(loan_info, fences)
+    loan_info_clean = loan_info[keep]
+
+    # 8. one-hot encoding of categorical features of binary class, see categories.py
+    for col in ['has_credit', 'has_housing_loan', 'has_personal_loan', 'outcome']:
+        loan_info_clean[col] = categories.YES_NO.encode(loan_info_clean[col])
+    return loan_info_clean, records_cleaned
+
+
+def read_customer_table(file_arrival, customer_info=None, span=None):
+    """
+        Raw Customer Info of all customers, an incremental partition only holds the customers new since the
+        last ingestion, so the earlier partitions of the table are read as well, see raw_layer.py
+        :param customer_info: raw customer info of this file arrival already in memory, read from raw layer when None
+        :param span: util.Span the partitions read are added to
+        :return : dataframe of the customer_info_columns
+    """
+    this_partition = f"{customer_info_raw_path}/file_arrival={file_arrival}"
+    folders = [folder for folder in raw_layer.customer_info_partitions(file_arrival)
+               if customer_info is None or folder != this_partition]
+    if span is not None:
+        span.read(*folders)
+    tables = [util.pd_read_parquet_files(folder, columns=list(customer_info_columns)) for folder in folders]
+    if customer_info is not None:
+        tables.append(customer_info[list(customer_info_columns)])
+    if not tables:
+        return util.pd_read_parquet_files(this_partition, columns=list(customer_info_columns))
+    return tables[0] if len(tables) == 1 else pd.concat(tables, ignore_index=True)
+
+
+def data_preparation(file_arrival, customer_info=None, loan_info=None, write_output=True):
+    """
+        Cleans raw layer Customer Info and Loan Info and writes them to the silver layer
+        :param file_arrival: file arrival partition to prepare
+        :param customer_info: raw customer info dataframe already in memory, read from raw layer when None
+        :param loan_info: raw loan info dataframe already in memory, read from raw layer when None
+        :param write_output: write the cleaned dataframes to the silver layer
+        :return : cleaned customer info and loan info dataframes, customer info of all customers
+                  also when the customer info of this file arrival is incremental
+    """
+    with util.Span("read_raw") as span:
+        customer_info = read_customer_table(file_arrival, customer_info, span)
+        if loan_info is None:
+            span.read(f"{loan_info_raw_path}/file_arrival={file_arrival}")
+            loan_info = util.pd_read_parquet_files(f"{loan_info_raw_path}/file_arrival={file_arrival}",
+                                                   columns=list(loan_info_columns))
+        span.rows_out = len(customer_info) + len(loan_info)
+    customer_info = customer_info[list(customer_info_columns)]
+    loan_info = loan_info[list(loan_info_columns)]
 
     # 1.Renaming the columns to match column description
-    customer_info.columns = ['customer_id', 'age', 'job_type', 'marital_status', 'educational_level']
-    loan_info.columns = ['customer_id', 'has_credit', 'avg_yearly_balance',
-                         'has_housing_loan', 'has_personal_loan', 'contact_communication_type',
-                         'contacted_day', 'contacted_month', 'contacted_duration_sec',
-                         'total_times_contacted', 'days_passed_from_last_campaign',
-                         'total_times_contacted_before_this_campaign',
-                         'outcome_of_previous_campaign', 'outcome']
-
-    # 2. PDA Analysis: Find min, max, mean, median, standard deviation
-    logging.info("=" * 5 + " Describe Customer Info " + "=" * 5)
-    logging.info(customer_info.describe())
-    logging.info("=" * 5 + " Describe Loan Info " + "=" * 5)
-    logging.info(loan_info.describe())
+    customer_info = customer_info.rename(columns=customer_info_columns)
+    loan_info = loan_info.rename(columns=loan_info_columns)
+
+    # 2. PDA Analysis: Find count, min, max, mean, standard deviation in one pass,
+    # loan info statistics are also used for the outlier fences
+    customer_stats = util.RunningStats(customer_numeric_columns)
+    customer_stats.update(customer_info)
+    loan_stats = util.RunningStats(loan_numeric_columns)
+    loan_stats.update(loan_info)
+    log_statistics(customer_stats, loan_stats)
 
     # 3. PDA Analysis: print data dimensionality
     logging.info("=" * 5 + " Dimensionality of input data " + "=" * 5)
     logging.info(f"Customer info -> {customer_info.shape}")
     logging.info(f"Loan info -> {loan_info.shape}")
 
-    # 4. Handle missing values: remove rows with unknown values
-    customer_info_clean = customer_info.copy()
-    loan_info_clean = loan_info.copy()
-
-    customer_info_clean = customer_info_clean[customer_info_clean['job_type'] != 'unknown']
-    customer_info_clean = customer_info_clean[customer_info_clean['educational_level'] != 'unknown']
+    # 4 - 9. clean and encode, outlier fences of customers are computed on customers without unknown values
+    customer_fence_stats = util.RunningStats(customer_outlier_columns)
+    customer_fence_stats.update(customer_info.loc[known_customer_mask(customer_info), customer_outlier_columns])
+    customer_fences = get_outlier_fences(customer_fence_stats, customer_outlier_columns)
+    loan_fences = get_outlier_fences(loan_stats, loan_outlier_columns)
 
-    # 5. Handle wrong values: replace .admin with admin in job column
-    customer_info_clean['job_type'] = customer_info_clean['job_type'].replace('admin.', 'admin')
+    customer_info_clean, customer_records_cleaned = clean_customer_info(customer_info, customer_fences)
+    loan_info_clean, loan_records_cleaned = clean_loan_info(loan_info, loan_fences)
 
-    # 6. Handle missing columns: drop column days_passed_from_last_campaign from loan info,
-    # since it has only -1 as a value and not valid
-    loan_info_clean = loan_info_clean.drop(columns=['days_passed_from_last_campaign',
-                                                    'outcome_of_previous_campaign',
-                                                    'contact_communication_type',
-                                                    'total_times_contacted_before_this_campaign'])
+    customer_clean_stats = util.RunningStats(customer_outlier_columns)
+    customer_clean_stats.update(customer_info_clean)
+    loan_clean_stats = util.RunningStats(loan_outlier_columns)
+    loan_clean_stats.update(loan_info_clean)
 
-    # 7. Standardize or normalize numerical : Remove outliers
     logging.info("=" * 5 + " Removing outliers for Customer Info " + "=" * 5)
-    customer_info_clean = remove_outliers(customer_info_clean, 'age')
-
+    log_outliers(customer_fences, customer_records_cleaned, customer_clean_stats)
     logging.info("=" * 5 + " Removing outliers for Loan Info " + "=" * 5)
-    loan_info_clean = remove_outliers(loan_info_clean, 'avg_yearly_balance')
-    loan_info_clean = remove_outliers(loan_info_clean, 'contacted_duration_sec')
-    loan_info_clean = remove_outliers(loan_info_clean, 'total_times_contacted')
-
-    # 8. one-hot encoding of categorical features of binary class
-    loan_info_clean['has_credit'] = loan_info_clean['has_credit'].map({'yes': 1, 'no': 0})
-    loan_info_clean['has_housing_loan'] = loan_info_clean['has_housing_loan'].map({'yes': 1, 'no': 0})
-    loan_info_clean['has_personal_loan'] = loan_info_clean['has_personal_loan'].map({'yes': 1, 'no': 0})
-    loan_info_clean['outcome'] = loan_info_clean['outcome'].map({'yes': 1, 'no': 0})
-
-    # 9. label encoding of categorical features of multiclass
-    customer_info_clean['job_type_encoded'] = customer_info_clean['job_type'] \
-        .map({'student': 1,
-              'unemployed': 2,
-              'housemaid': 3,
-              'self-employed': 4,
-              'blue-collar': 5,
-              'services': 6,
-              'admin': 7,
-              'entrepreneur': 8,
-              'technician': 9,
-              'management': 10,
-              'retired': 11})
-
-    customer_info_clean['marital_status_encoded'] = customer_info_clean['marital_status'] \
-        .map({'single': 1,
-              'married': 2,
-              'divorced': 3})
-
-    customer_info_clean['educational_level_encoded'] = customer_info_clean['educational_level'] \
-        .map({'primary': 1,
-              'secondary': 2,
-              'tertiary': 3})
+    log_outliers(loan_fences, loan_records_cleaned, loan_clean_stats)
 
     # 10. write data in the clean layer
+    customer_info_clean = util.pd_conform_to_schema(customer_info_clean, SILVER_CUSTOMER_INFO_SCHEMA)
+    loan_info_clean = util.pd_conform_to_schema(loan_info_clean, SILVER_LOAN_INFO_SCHEMA)
+    if write_output:
+        customer_info_clean_folder_this_run = f"{customer_info_clean_folder}{file_arrival}"
+        loan_info_clean_folder_this_run = f"{loan_info_clean_folder}{file_arrival}"
+
+        os.makedirs(customer_info_clean_folder_this_run, exist_ok=True)
+        os.makedirs(loan_info_clean_folder_this_run, exist_ok=True)
+
+        customer_info_clean_full_path = os.path.join(customer_info_clean_folder_this_run, "customer_info.parquet")
+        loan_info_clean_full_path = os.path.join(loan_info_clean_folder_this_run, "loan_info.parquet")
+
+        with util.Span("write_silver", rows_in=len(customer_info_clean) + len(loan_info_clean)) as span:
+            util.pd_write_parquet(customer_info_clean, customer_info_clean_full_path, SILVER_CUSTOMER_INFO_SCHEMA)
+            util.pd_write_parquet(loan_info_clean, loan_info_clean_full_path, SILVER_LOAN_INFO_SCHEMA)
+            span.written(customer_info_clean_full_path, loan_info_clean_full_path)
+
+        logging.info(f"Customer info cleaned file is written to: {customer_info_clean_full_path}")
+        logging.info(f"Loan info cleaned file is written to: {loan_info_clean_full_path}")
+
+    return customer_info_clean, loan_info_clean
+
+
+def log_statistics(customer_stats, loan_stats):
+    logging.info("=" * 5 + " Describe Customer Info " + "=" * 5)
+    logging.info(customer_stats.summary())
+    logging.info("=" * 5 + " Describe Loan Info " + "=" * 5)
+    logging.info(loan_stats.summary())
+
+
+def iter_raw_chunks(raw_folders, columns, chunk_size):
+    for raw_folder in raw_folders:
+        for chunk in util.iter_parquet_batches(raw_folder, list(columns), chunk_size):
+            yield chunk.rename(columns=columns)
+
+
+def data_preparation_chunked(file_arrival, chunk_size=100_000):
+    """
+        Cleans raw layer Customer Info and Loan Info chunk by chunk, for partitions larger than memory.
+        First pass computes mean and standard deviation with util.RunningStats for the outlier fences,
+        second pass cleans, encodes and writes every chunk to the silver layer.
+        :param file_arrival: file arrival partition to prepare
+        :param chunk_size: number of rows held in memory at a time
+    """
+    # customers of an incremental partition are read with the earlier partitions of the customer table
+    customer_folders = raw_layer.customer_info_partitions(file_arrival)
+    loan_folders = [f"{loan_info_raw_path}/file_arrival={file_arrival}"]
+
+    # 1 - 3. first pass: statistics of the whole partition
+    customer_stats = util.RunningStats(customer_numeric_columns)
+    customer_fence_stats = util.RunningStats(customer_outlier_columns)
+    for chunk in iter_raw_chunks(customer_folders, customer_info_columns, chunk_size):
+        customer_stats.update(chunk)
+        customer_fence_stats.update(chunk.loc[known_customer_mask(chunk), customer_outlier_columns])
+
+    loan_stats = util.RunningStats(loan_numeric_columns)
+    for chunk in iter_raw_chunks(loan_folders, loan_info_columns, chunk_size):
+        loan_stats.update(chunk)
+
+    log_statistics(customer_stats, loan_stats)
+    logging.info("=" * 5 + " Dimensionality of input data " + "=" * 5)
+    logging.info(f"Customer info -> ({int(customer_stats.count[0])}, {len(customer_info_columns)})")
+    logging.info(f"Loan info -> ({int(loan_stats.count[0])}, {len(loan_info_columns)})")
+
+    customer_fences = get_outlier_fences(customer_fence_stats, customer_outlier_columns)
+    loan_fences = get_outlier_fences(loan_stats, loan_outlier_columns)
+
+    # 4 - 10. second pass: clean, encode and write every chunk
+    def clean_chunks(raw_folders, columns, clean, fences, records_cleaned, clean_stats):
+        for chunk in iter_raw_chunks(raw_folders, columns, chunk_size):
+            chunk_clean, chunk_records_cleaned = clean(chunk, fences)
+            for col, count in chunk_records_cleaned.items():
+                records_cleaned[col] = records_cleaned.get(col, 0) + count
+            clean_stats.update(chunk_clean)
+            yield chunk_clean
+
     customer_info_clean_folder_this_run = f"{customer_info_clean_folder}{file_arrival}"
     loan_info_clean_folder_this_run = f"{loan_info_clean_folder}{file_arrival}"
-
     os.makedirs(customer_info_clean_folder_this_run, exist_ok=True)
     os.makedirs(loan_info_clean_folder_this_run, exist_ok=True)
+    customer_info_clean_full_path = os.path.join(customer_info_clean_folder_this_run, "customer_info.parquet")
+    loan_info_clean_full_path = os.path.join(loan_info_clean_folder_this_run, "loan_info.parquet")
 
-    customer_info_clean_full_path = os.path.join(customer_info_clean_folder_this_run, "customer_info.csv")
-    loan_info_clean_full_path = os.path.join(loan_info_clean_folder_this_run, "loan_info.csv")
+    customer_records_cleaned, customer_clean_stats = {}, util.RunningStats(customer_outlier_columns)
+    util.write_chunks_to_parquet(clean_chunks(customer_folders, customer_info_columns, clean_customer_info,
+                                              customer_fences, customer_records_cleaned, customer_clean_stats),
+                                 customer_info_clean_full_path, SILVER_CUSTOMER_INFO_SCHEMA)
 
-    customer_info_clean.to_csv(customer_info_clean_full_path, index=False)
-    loan_info_clean.to_csv(loan_info_clean_full_path, index=False)
+    loan_records_cleaned, loan_clean_stats = {}, util.RunningStats(loan_outlier_columns)
+    util.write_chunks_to_parquet(clean_chunks(loan_folders, loan_info_columns, clean_loan_info,
+                                              loan_fences, loan_records_cleaned, loan_clean_stats),
+                                 loan_info_clean_full_path, SILVER_LOAN_INFO_SCHEMA)
+
+    logging.info("=" * 5 + " Removing outliers for Customer Info " + "=" * 5)
+    log_outliers(customer_fences, customer_records_cleaned, customer_clean_stats)
+    logging.info("=" * 5 + " Removing outliers for Loan Info " + "=" * 5)
+    log_outliers(loan_fences, loan_records_cleaned, loan_clean_stats)
 
     logging.info(f"Customer info cleaned file is written to: {customer_info_clean_full_path}")
     logging.info(f"Loan info cleaned file is written to: {loan_info_clean_full_path}")
@@ -154,11 +322,25 @@ def main():
 
     parser = argparse.ArgumentParser(description="prepare loan and customer info for silver layer")
     parser.add_argument("file_arrival_time", help="time of file arrival in YYYYMMDD_HHMMSS")
+    parser.add_argument("--chunk-size", type=int, default=None,
+                        help="prepare raw partitions in chunks of this many rows, for partitions larger than memory")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="run the stage even when its inputs, parameters and code are unchanged since a cached run")
     args = parser.parse_args()
 
     file_arrival = args.file_arrival_time
 
-    data_preparation(file_arrival)
+    def run():
+        if args.chunk_size:
+            data_preparation_chunked(file_arrival, args.chunk_size)
+        else:
+            data_preparation(file_arrival)
+
+    with util.job_span(job_name, file_arrival):
+        cache = None if args.no_cache else stage_cache.StageCache()
+        skipped, _ = stage_cache.run_cached("preparation", file_arrival, stage_cache.params_of_args(args), run, cache)
+        if skipped:
+            logging.info("Skipped, outputs of the same inputs, parameters and code are already written")
 
     logging.info(f"=== {job_name} ended ===")
 
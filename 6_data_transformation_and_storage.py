@@ -12,11 +12,19 @@
 """
 
 import os
+import glob
+import shutil
 import argparse
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 
 import util
+import stage_cache
+from feature_transforms import FeatureTransformer, latest_params_folder
+from gold_dataset import customer_loan_info_path
 
 job_name = "6_data_transformation_and_storage"
 logging = util.get_logger(job_name)
@@ -25,69 +33,250 @@ customer_info_silver_path = "LocalDataLake/silver/customer_info"
 loan_info_silver_path = "LocalDataLake/silver/loan_info"
 
 customer_loan_info_folder = "LocalDataLake/gold/customer_loan_info/file_arrival="
+spill_folder = "LocalDataLake/_spill/customer_loan_info/file_arrival="
+csv_of_last_run_file = "LocalDataLake/gold/csv_of_last_run/customer_loan_info.csv"
 
 
-def apply_min_max_scaling(df, col):
-    df[col] = (df[col] - df[col].min()) / (df[col].max() - df[col].min())
-    return df
+def widen_integer_columns(df):
+    """
+        Silver layer stores compact integer types, gold layer keeps the Int64 types of the loan_features view
+    """
+    return df.astype({col: 'int64' for col in df.columns if pd.api.types.is_integer_dtype(df[col])})
 
 
-def data_transformation_and_storage(file_arrival):
+def clear_gold_partition(folder):
+    """
+        Removes parquet files of an earlier run, the gold dataset reads every file of a partition
+    """
+    os.makedirs(folder, exist_ok=True)
+    for old_file in glob.glob(f"{folder}/*.parquet"):
+        os.remove(old_file)
 
-    customer_info = util.pd_read_csv_files(f"{customer_info_silver_path}/file_arrival={file_arrival}")
-    loan_info = util.pd_read_csv_files(f"{loan_info_silver_path}/file_arrival={file_arrival}")
 
-    # 1. Combining below features into credit_commitment, since these are related information.
-    loan_info['credit_commitment'] = loan_info['has_credit'] \
-                                     + loan_info['has_housing_loan'] \
-                                     + loan_info['has_personal_loan']
+def load_transformer(file_arrival, refit=False):
+    """
+        Scaling parameters are fitted once and reused by later batches, so features of all partitions are on
+        the same scale as the features the model was trained on
+        :param refit: fit the parameters on this batch instead
+        :return : FeatureTransformer of the latest earlier gold partition, None when it has to be fitted
+    """
+    params_folder = None if refit else latest_params_folder(customer_loan_info_path, file_arrival)
+    if params_folder is not None:
+        logging.info(f"Transform parameters are reused from: {params_folder}")
+        return FeatureTransformer.load(params_folder)
+    reason = "--refit-transform is given" if refit else "no earlier gold partition has transform parameters"
+    logging.warning(f"!!! Transform parameters are FITTED on file_arrival={file_arrival}, {reason}. "
+                    f"Features of this partition are not on the scale of earlier partitions and models !!!")
+    return None
 
-    # 2. drop has_credit, has_housing_loan, has_personal_loan
-    loan_info = loan_info.drop(columns=['has_credit', 'has_housing_loan', 'has_personal_loan'])
 
-    # 2. Splitting Age into different groups using Equal width partitioning
-    customer_info['age_binned'] = pd.cut(customer_info['age'], bins=[10, 25, 35, 45, 55, 65, 75])
-    customer_info['age_binned'] = pd.to_numeric(customer_info['age_binned'] \
-                                            .apply(lambda x: x.mid if isinstance(x, pd.Interval) else x))
+def data_transformation_and_storage(file_arrival, customer_info=None, loan_info=None, write_output=True,
+                                    transformer=None, write_csv=False, refit=False):
+    """
+        Builds the customer_loan_info features of the gold layer from the silver layer
+        :param file_arrival: file arrival partition to transform
+        :param customer_info: silver customer info dataframe already in memory, read from silver layer when None
+        :param loan_info: silver loan info dataframe already in memory, read from silver layer when None
+        :param write_output: write the features to the gold layer
+        :param transformer: fitted FeatureTransformer to reuse, the one of the latest earlier gold partition when None
+        :param write_csv: also write a csv copy of the features to gold/csv_of_last_run
+        :param refit: fit the scaling parameters on this batch when no transformer is given
+        :return : customer_loan_info dataframe
+    """
+    with util.Span("read_silver") as span:
+        if customer_info is None:
+            span.read(f"{customer_info_silver_path}/file_arrival={file_arrival}")
+            customer_info = util.pd_read_parquet_files(f"{customer_info_silver_path}/file_arrival={file_arrival}")
+        if loan_info is None:
+            span.read(f"{loan_info_silver_path}/file_arrival={file_arrival}")
+            loan_info = util.pd_read_parquet_files(f"{loan_info_silver_path}/file_arrival={file_arrival}")
+        customer_info = widen_integer_columns(customer_info)
+        loan_info = widen_integer_columns(loan_info)
+        span.rows_out = len(customer_info) + len(loan_info)
 
-    # 3. splitting avg_yearly_balance into different groups
-    loan_info['avg_yearly_balance_binned'] = pd.cut(loan_info['avg_yearly_balance'],
-                                                    bins=[-7000, -200, 0, 200, 400, 600, 800, 1200, 2500, 5000, 10281])
-    loan_info['avg_yearly_balance_binned'] = pd.to_numeric(loan_info['avg_yearly_balance_binned'] \
-                                                           .apply(lambda x: x.mid if isinstance(x, pd.Interval) else x))
-
-    # 4. applying feature scaling on numerical column
-    loan_info = apply_min_max_scaling(loan_info, 'contacted_duration_sec')
+    # 1 - 4. credit_commitment, age and balance bins and scaling of contacted_duration_sec,
+    # see feature_transforms.py. Scaling parameters of the latest gold partition are reused unless given,
+    # they are only fitted on this batch for the first partition or when refit
+    with util.Span("transform", rows_in=len(customer_info) + len(loan_info)):
+        if transformer is None:
+            transformer = load_transformer(file_arrival, refit)
+        if transformer is None:
+            transformer = FeatureTransformer().fit(loan_info)
+        logging.info(f"Transform parameters: {transformer.to_dict()}")
+        customer_info = transformer.transform_customer_info(customer_info)
+        loan_info = transformer.transform_loan_info(loan_info)
 
     # 5. join loan_info and customer_info
-    customer_loan_info = pd.merge(customer_info, loan_info, on='customer_id', how='inner')
+    with util.Span("join", rows_in=len(customer_info) + len(loan_info)) as span:
+        customer_loan_info = pd.merge(customer_info, loan_info, on='customer_id', how='inner')
+        span.rows_out = len(customer_loan_info)
 
     # 6. add event_timestamp to be used in feature store
     event_timestamp_for_feature_store = datetime.strptime(file_arrival, "%Y%m%d")
     customer_loan_info["event_timestamp"] = event_timestamp_for_feature_store
 
     # 7. write the customer_loan_campaign_info to gold layer
+    if write_output:
+        customer_loan_info_folder_this_run = f"{customer_loan_info_folder}{file_arrival}"
+        clear_gold_partition(customer_loan_info_folder_this_run)
+
+        customer_loan_info_full_path_parquet = os.path.join(customer_loan_info_folder_this_run,
+                                                            "customer_loan_info.parquet")
+        with util.Span("write_gold", rows_in=len(customer_loan_info)) as span:
+            customer_loan_info.to_parquet(customer_loan_info_full_path_parquet, index=False)
+            transformer.save(customer_loan_info_folder_this_run)
+            span.written(customer_loan_info_full_path_parquet)
+
+        if write_csv:
+            os.makedirs(os.path.dirname(csv_of_last_run_file), exist_ok=True)
+            customer_loan_info.to_csv(csv_of_last_run_file, index=False)
+
+        logging.info(f"Customer loan info gold file is written to: {customer_loan_info_full_path_parquet}")
+    logging.debug(f"Gold layer dtypes:\n{customer_loan_info.dtypes}")
+    return customer_loan_info
+
+
+def spill_partitioned(chunks, output_folder, num_partitions):
+    """
+        Writes chunks of a table into num_partitions parquet files by hash of customer_id,
+        so rows with the same customer_id of both join sides end up in partitions with the same number
+        :param chunks: iterable of dataframes
+        :param output_folder: folder of the partition files
+        :param num_partitions: number of partitions
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    writers = {}
+    try:
+        for chunk in chunks:
+            partition = pd.util.hash_array(chunk['customer_id'].to_numpy()) % num_partitions
+            for p, rows in chunk.groupby(partition, sort=False):
+                table = pa.Table.from_pandas(rows, preserve_index=False)
+                if p not in writers:
+                    writers[p] = pq.ParquetWriter(f"{output_folder}/part-{p:05d}.parquet", table.schema)
+                writers[p].write_table(table.cast(writers[p].schema))
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+
+def join_partition(customer_file, loan_file, output_file, event_timestamp):
+    with util.Span(f"join_partition {os.path.basename(output_file)}") as span:
+        span.read(customer_file, loan_file)
+        customer_info = pd.read_parquet(customer_file)
+        loan_info = pd.read_parquet(loan_file)
+        customer_loan_info = pd.merge(customer_info, loan_info, on='customer_id', how='inner')
+        customer_loan_info["event_timestamp"] = event_timestamp
+        customer_loan_info.to_parquet(output_file, index=False)
+        span.rows_in, span.rows_out = len(customer_info) + len(loan_info), len(customer_loan_info)
+        span.written(output_file)
+    return len(customer_loan_info)
+
+
+def data_transformation_partitioned(file_arrival, num_partitions=16, chunk_size=100_000, max_workers=1,
+                                    transformer=None, refit=False):
+    """
+        Builds the gold layer without holding the silver tables in memory. Both silver tables are transformed
+        chunk by chunk and spilled into num_partitions files by hash of customer_id, then every pair of
+        partitions is joined on its own, optionally by several worker processes, and written as one file
+        of the gold partition.
+        :param file_arrival: file arrival partition to transform
+        :param num_partitions: number of hash partitions, more partitions lower the memory of one join
+        :param chunk_size: number of silver rows held in memory at a time while spilling
+        :param max_workers: number of worker processes joining partitions
+        :param transformer: fitted FeatureTransformer to reuse, the one of the latest earlier gold partition when None
+        :param refit: fit the scaling parameters on this batch when no transformer is given
+    """
+    customer_info_folder = f"{customer_info_silver_path}/file_arrival={file_arrival}"
+    loan_info_folder = f"{loan_info_silver_path}/file_arrival={file_arrival}"
+
+    # 1. parameters of the latest gold partition, or fitted with a pass over the one column they need
+    if transformer is None:
+        transformer = load_transformer(file_arrival, refit)
+    if transformer is None:
+        transformer = FeatureTransformer()
+        for chunk in util.iter_parquet_batches(loan_info_folder, ['contacted_duration_sec'], chunk_size):
+            transformer.partial_fit(chunk)
+    logging.info(f"Transform parameters: {transformer.to_dict()}")
+
+    # 2. transform and spill both sides into hash partitions of customer_id
+    spill_folder_this_run = f"{spill_folder}{file_arrival}"
+    shutil.rmtree(spill_folder_this_run, ignore_errors=True)
+    with util.Span("transform_and_spill") as span:
+        span.read(customer_info_folder, loan_info_folder)
+        spill_partitioned((transformer.transform_customer_info(widen_integer_columns(chunk))
+                           for chunk in util.iter_parquet_batches(customer_info_folder, batch_size=chunk_size)),
+                          f"{spill_folder_this_run}/customer_info", num_partitions)
+        spill_partitioned((transformer.transform_loan_info(widen_integer_columns(chunk))
+                           for chunk in util.iter_parquet_batches(loan_info_folder, batch_size=chunk_size)),
+                          f"{spill_folder_this_run}/loan_info", num_partitions)
+        span.written(spill_folder_this_run)
+
+    # 3. join partition by partition into the gold partition
     customer_loan_info_folder_this_run = f"{customer_loan_info_folder}{file_arrival}"
-    os.makedirs(customer_loan_info_folder_this_run, exist_ok=True)
+    clear_gold_partition(customer_loan_info_folder_this_run)
 
-    customer_loan_info_full_path_parquet = os.path.join(customer_loan_info_folder_this_run, "customer_loan_info.parquet")
-    customer_loan_info.to_parquet(customer_loan_info_full_path_parquet, index=False)
+    event_timestamp_for_feature_store = datetime.strptime(file_arrival, "%Y%m%d")
+    joins = []
+    for p in range(num_partitions):
+        customer_file = f"{spill_folder_this_run}/customer_info/part-{p:05d}.parquet"
+        loan_file = f"{spill_folder_this_run}/loan_info/part-{p:05d}.parquet"
+        if os.path.exists(customer_file) and os.path.exists(loan_file):
+            joins.append((customer_file, loan_file, f"{customer_loan_info_folder_this_run}/part-{p:05d}.parquet",
+                          event_timestamp_for_feature_store))
+
+    if max_workers == 1:
+        rows_written = sum(join_partition(*join) for join in joins)
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as workers:
+            rows_written = sum(workers.map(join_partition, *zip(*joins)))
 
-    customer_loan_info.to_csv("LocalDataLake/gold/csv_of_last_run/customer_loan_info.csv", index=False)
+    transformer.save(customer_loan_info_folder_this_run)
+    shutil.rmtree(spill_folder_this_run, ignore_errors=True)
+    logging.info(f"Customer loan info gold files are written to: {customer_loan_info_folder_this_run}, "
+                 f"{rows_written} rows in {len(joins)} partitions")
 
-    logging.info(f"Customer loan info gold file is written to: {customer_loan_info_full_path_parquet}")
-    print(customer_loan_info.dtypes)
 
 def main():
     logging.info(f"=== {job_name} started ===")
 
     parser = argparse.ArgumentParser(description="prepare loan and customer info for gold layer")
     parser.add_argument("file_arrival_time", help="time of file arrival in YYYYMMDD_HHMMSS")
+    parser.add_argument("--transform-params-from", default=None,
+                        help="file arrival of a gold partition whose fitted transform parameters are reused, "
+                             "the latest earlier gold partition when not given")
+    parser.add_argument("--refit-transform", action="store_true",
+                        help="fit the transform parameters on this batch instead of reusing earlier ones")
+    parser.add_argument("--join-partitions", type=int, default=None,
+                        help="join out of core in this many hash partitions of customer_id")
+    parser.add_argument("--chunk-size", type=int, default=100_000,
+                        help="number of silver rows held in memory at a time for --join-partitions")
+    parser.add_argument("--workers", type=int, default=1, help="number of worker processes joining partitions")
+    parser.add_argument("--csv-of-last-run", action="store_true",
+                        help="also write a csv copy of the features to gold/csv_of_last_run")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="run the stage even when its inputs, parameters and code are unchanged since a cached run")
     args = parser.parse_args()
 
     file_arrival = args.file_arrival_time
 
-    data_transformation_and_storage(file_arrival)
+    def run():
+        transformer = None
+        if args.transform_params_from:
+            transformer = FeatureTransformer.load(f"{customer_loan_info_folder}{args.transform_params_from}")
+
+        if args.join_partitions:
+            data_transformation_partitioned(file_arrival, args.join_partitions, args.chunk_size, args.workers,
+                                            transformer, args.refit_transform)
+        else:
+            data_transformation_and_storage(file_arrival, transformer=transformer, write_csv=args.csv_of_last_run,
+                                            refit=args.refit_transform)
+
+    with util.job_span(job_name, file_arrival):
+        cache = None if args.no_cache else stage_cache.StageCache()
+        skipped, _ = stage_cache.run_cached("transformation", file_arrival, stage_cache.params_of_args(args), run,
+                                            cache)
+        if skipped:
+            logging.info("Skipped, outputs of the same inputs, parameters and code are already written")
 
     logging.info(f"=== {job_name} ended ===")
 
@@ -14,23 +14,29 @@ import pandas as pd
 from datetime import datetime
 
 import util
+from feature_client import OnlineFeatureClient
 
 job_name = "7_feature_store"
 logging = util.get_logger(job_name)
 
 store = FeatureStore(repo_path="feature_repo")
 
-# 1. get online features
-features = store.get_online_features(
+# 1. get online features, many customers per call through the cached online feature client
+online_feature_client = OnlineFeatureClient(
     features=[
         "loan_features:age",
         "loan_features:avg_yearly_balance",
         "loan_features:credit_commitment"
     ],
-    entity_rows=[{"customer_id": 1}]
-).to_dict()
+    store=store
+)
+features = online_feature_client.get_online_features([1, 2, 3, 1000, 2000])
 logging.info("======= Online Features =======")
-logging.info(features)
+logging.info(features.to_string(index=False))
+
+# repeated customers are served from the cache
+online_feature_client.get_online_features([1, 2, 3])
+logging.info(f"Online feature cache: {online_feature_client.stats()}")
 
 # 2. get historical features
 
@@ -0,0 +1,135 @@
+"""
+8. Feature Materialization
+    •	Pushes the gold layer partitions which arrived since the last run into the online store:
+        o	Only partitions newer than the watermark of the feature view are read, and only its columns
+        o	The latest row of every customer is written with bulk batched upserts, one transaction per batch
+        o	The sqlite online store runs in write-ahead logging mode, so readers are not blocked by the writes
+    •	Keeps a watermark per feature view and reports rows/sec
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import time
+
+import pandas as pd
+
+import util
+from gold_dataset import GoldDataset
+
+job_name = "8_feature_materialization"
+logging = util.get_logger(job_name)
+
+feature_repo_path = "feature_repo"
+materialization_watermark_path = "LocalDataLake/_manifest/materialization_watermark.json"
+
+
+def load_materialization_watermarks():
+    if not os.path.exists(materialization_watermark_path):
+        return {}
+    with open(materialization_watermark_path) as f:
+        return json.load(f)
+
+
+def save_materialization_watermarks(watermarks):
+    os.makedirs(os.path.dirname(materialization_watermark_path), exist_ok=True)
+    with open(materialization_watermark_path, "w") as f:
+        json.dump(watermarks, f, indent=2)
+
+
+def enable_write_ahead_logging(db_path):
+    # journal mode WAL is persistent, every later connection of the online store uses it
+    os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    conn = sqlite3.connect(db_path)
+    journal_mode = conn.execute("PRAGMA journal_mode = WAL").fetchone()[0]
+    conn.close()
+    return journal_mode
+
+
+def online_store_db_path(store):
+    # a relative path of feature_store.yaml is relative to the feature repo, as feast resolves it
+    path = store.config.online_store.path
+    return path if os.path.isabs(path) else os.path.join(feature_repo_path, path)
+
+
+def latest_rows_per_entity(df, join_keys, timestamp_field):
+    return df.sort_values(timestamp_field, kind="stable").drop_duplicates(join_keys, keep="last")
+
+
+def feature_materialization(file_arrival, feature_view_name="loan_features", batch_size=50_000,
+                            full_refresh=False):
+    """
+        Writes gold partitions after the watermark of a feature view, up to file_arrival, to the online store
+        :param file_arrival: newest file arrival partition to materialize
+        :param feature_view_name: feature view of feature_repo to materialize
+        :param batch_size: number of entities written in one online store transaction
+        :param full_refresh: ignore the watermark and materialize all partitions up to file_arrival
+        :return : number of entities written
+    """
+    from feast import FeatureStore
+
+    store = FeatureStore(repo_path=feature_repo_path)
+    feature_view = store.get_feature_view(feature_view_name)
+    join_keys = [column.name for column in feature_view.entity_columns]
+    timestamp_field = feature_view.batch_source.timestamp_field
+    columns = join_keys + [feature.name for feature in feature_view.features] + [timestamp_field]
+
+    # 1. read only the partitions after the watermark and only the columns of the feature view
+    watermarks = load_materialization_watermarks()
+    watermark = None if full_refresh else watermarks.get(feature_view_name)
+    gold_dataset = GoldDataset()
+    partitions = [partition for partition in gold_dataset.partitions()
+                  if partition <= file_arrival and (watermark is None or partition > watermark)]
+    logging.info(f"{feature_view_name} watermark: {watermark}, partitions to materialize: {partitions}")
+    if not partitions:
+        logging.info("Online store is up to date")
+        return 0
+
+    features = gold_dataset.read(columns=columns, start=partitions[0], end=partitions[-1])
+    features = latest_rows_per_entity(features, join_keys, timestamp_field)
+    # categorical gold columns are String features of the view
+    for col in features.columns:
+        if isinstance(features[col].dtype, pd.CategoricalDtype):
+            features[col] = features[col].astype(object)
+
+    # 2. bulk upserts into the online store, one transaction per batch
+    logging.info(f"Online store journal mode: {enable_write_ahead_logging(online_store_db_path(store))}")
+    start = time.perf_counter()
+    with util.Span("write_online_store", rows_in=len(features), rows_out=len(features)):
+        for batch_start in range(0, len(features), batch_size):
+            store.write_to_online_store(feature_view_name, features.iloc[batch_start:batch_start + batch_size])
+    elapsed = time.perf_counter() - start
+
+    # 3. move the watermark only after all batches are written
+    watermarks[feature_view_name] = partitions[-1]
+    save_materialization_watermarks(watermarks)
+
+    logging.info(f"Materialized {len(features)} {feature_view_name} entities of {partitions} in {elapsed:.1f}s, "
+                 f"{len(features) / max(elapsed, 1e-9):.0f} rows/sec")
+    return len(features)
+
+
+def main():
+    logging.info(f"=== {job_name} started ===")
+
+    parser = argparse.ArgumentParser(description="materialize new gold partitions into the online store")
+    parser.add_argument("file_arrival_time", help="time of file arrival in YYYYMMDD")
+    parser.add_argument("--feature-view", default="loan_features", help="feature view to materialize")
+    parser.add_argument("--batch-size", type=int, default=50_000,
+                        help="number of entities written in one online store transaction")
+    parser.add_argument("--full-refresh", action="store_true",
+                        help="ignore the watermark and materialize all gold partitions")
+    args = parser.parse_args()
+
+    file_arrival = args.file_arrival_time
+    logging.info(f"file_arrival : {file_arrival}")
+
+    with util.job_span(job_name, file_arrival):
+        feature_materialization(file_arrival, args.feature_view, args.batch_size, args.full_refresh)
+
+    logging.info(f"=== {job_name} ended ===")
+
+
+if __name__ == "__main__":
+    main()
@@ -11,13 +11,16 @@
         o	A versioned, saved model file (e.g., .pkl, .h5)
 """
 
-from feast import FeatureStore
 import pandas as pd
 import argparse
+import os
+import tempfile
+import time
 
 from sklearn.model_selection import train_test_split
 from sklearn.linear_model import LogisticRegression
 from sklearn.metrics import accuracy_score, confusion_matrix, classification_report
+from sklearn.metrics import precision_score, recall_score, f1_score, roc_auc_score
 
 from sklearn.tree import DecisionTreeClassifier
 from sklearn import tree
@@ -25,19 +28,150 @@ from sklearn.ensemble import RandomForestClassifier
 from sklearn.neighbors import KNeighborsClassifier
 
 import joblib
+from joblib import Parallel, delayed
 
 import util
+import model_tuning
+import stage_cache
+from model_registry import ModelRegistry, data_sha256
+import point_in_time
+from gold_dataset import GoldDataset
+from feature_transforms import model_features
 
 job_name = "9_model_building"
 logging = util.get_logger(job_name)
 
-gold_layer_path = "LocalDataLake/gold/customer_loan_info/file_arrival="
 models_path = "models/"
-
-
-def model_building(file_arrival):
-    # 1. Read the data from gold layer to verify label distribution
-    customer_loan_info = pd.read_parquet(f"{gold_layer_path}{file_arrival}")
+selection_metrics = ["accuracy", "precision", "recall", "f1", "roc_auc"]
+feature_repo_path = "feature_repo"
+
+training_features = [f"loan_features:{feature}" for feature in model_features]
+
+
+def get_training_features(entity_df, feature_engine="native"):
+    """
+        Point-in-time correct training features of entity rows
+        :param entity_df: dataframe of customer_id and event_timestamp
+        :param feature_engine: "native" as-of join over the feature view source or "feast" historical retrieval
+        :return : entity_df columns followed by training_features
+    """
+    if feature_engine == "feast":
+        from feast import FeatureStore
+
+        store = FeatureStore(repo_path=feature_repo_path)
+        return store.get_historical_features(entity_df=entity_df, features=training_features).to_df()
+    return point_in_time.get_historical_features(entity_df, training_features, feature_repo_path)
+
+
+def candidate_models():
+    """
+        :return : dict of name -> (title, unfitted model) of the candidates compared in model_building
+    """
+    return {
+        "LR": ("LOGISTIC REGRESSION", LogisticRegression(solver='liblinear')),
+        "DT": ("DECISION TREES", DecisionTreeClassifier(random_state=42)),
+        # one core per candidate, the candidates themselves run in parallel
+        "RF": ("RANDOM FOREST", RandomForestClassifier(n_estimators=50, random_state=12, n_jobs=1)),
+        "KNN": ("KNN CLASSIFIER", KNeighborsClassifier(n_neighbors=5)),
+    }
+
+
+def fit_candidate(name, title, model, training_x, training_y, test_x, test_y, feature_names):
+    """
+        Fits and evaluates one candidate in a worker process
+        :param training_x: feature matrix, a read only memory map shared by all workers
+        :param test_x: feature matrix, a read only memory map shared by all workers
+        :return : dict of fitted model and its test metrics
+    """
+    # dataframes over the memory maps keep the feature names without copying the matrices
+    training_x = pd.DataFrame(training_x, columns=feature_names, copy=False)
+    test_x = pd.DataFrame(test_x, columns=feature_names, copy=False)
+
+    with util.Span(f"fit {name}", rows_in=len(training_x)):
+        start = time.perf_counter()
+        model.fit(training_x, training_y)
+        fit_time = time.perf_counter() - start
+    with util.Span(f"evaluate {name}", rows_in=len(test_x)) as span:
+        test_y_pred = model.predict(test_x)
+        test_y_proba = model.predict_proba(test_x)[:, list(model.classes_).index(1)]
+        span.rows_out = len(test_y_pred)
+
+    return {
+        "name": name,
+        "title": title,
+        "model": model,
+        "fit_time_sec": fit_time,
+        "accuracy": accuracy_score(test_y, test_y_pred),
+        "precision": precision_score(test_y, test_y_pred, zero_division=0),
+        "recall": recall_score(test_y, test_y_pred, zero_division=0),
+        "f1": f1_score(test_y, test_y_pred, zero_division=0),
+        "roc_auc": roc_auc_score(test_y, test_y_proba),
+        "confusion_matrix": confusion_matrix(test_y, test_y_pred),
+        "classification_report": classification_report(test_y, test_y_pred,
+                                                        target_names=["not-subsccribed", "subscribed"]),
+    }
+
+
+def train_candidates(training_x, training_y, test_x, test_y, n_jobs=-1, candidates=None):
+    """
+        Fits all candidate models concurrently, one worker process per candidate.
+        Feature matrices are written once to a memory mapped file which all workers read.
+        :param n_jobs: number of worker processes, -1 for one per candidate up to the number of cores
+        :param candidates: dict of name -> (title, unfitted model), candidate_models() when None
+        :return : list of fit_candidate results in candidate order
+    """
+    feature_names = list(training_x.columns)
+    candidates = candidates or candidate_models()
+    n_jobs = min(len(candidates), os.cpu_count() or 1) if n_jobs == -1 else n_jobs
+
+    with tempfile.TemporaryDirectory(prefix="model_building_") as memmap_folder:
+        memmap_file = os.path.join(memmap_folder, "features.joblib")
+        joblib.dump((training_x.to_numpy(dtype="float64"), test_x.to_numpy(dtype="float64")), memmap_file)
+        shared_training_x, shared_test_x = joblib.load(memmap_file, mmap_mode="r")
+
+        return Parallel(n_jobs=n_jobs)(
+            delayed(fit_candidate)(name, title, model, shared_training_x, training_y.to_numpy(), shared_test_x,
+                                   test_y.to_numpy(), feature_names)
+            for name, (title, model) in candidates.items())
+
+
+def select_best_model(results, selection_metric="accuracy"):
+    # max keeps the first of equally good candidates, in candidate order
+    return max(results, key=lambda result: result[selection_metric])
+
+
+def write_comparison_report(results, best, file_arrival):
+    report_file = f"{models_path}model_comparison_report_{file_arrival}.csv"
+    report = pd.DataFrame([{"model": result["name"], "selected": result is best,
+                            **{metric: result[metric] for metric in ["fit_time_sec"] + selection_metrics}}
+                           for result in results])
+    os.makedirs(models_path, exist_ok=True)
+    report.to_csv(report_file, index=False)
+    logging.info("==== MODEL COMPARISON ====")
+    logging.info(report.to_string(index=False))
+    return report_file
+
+
+def model_building(file_arrival, customer_loan_info=None, start=None, end=None, feature_engine="native",
+                   selection_metric="accuracy", n_jobs=-1, tune=False, tuning_budget_sec=600, promote=True):
+    """
+        Trains the churn models on gold layer entities and their features of the feature store
+        :param file_arrival: file arrival the model is trained for, also names the model file
+        :param customer_loan_info: gold layer dataframe already in memory, read from gold layer when None
+        :param start: first file_arrival partition of the training window, file_arrival when None
+        :param end: last file_arrival partition of the training window, file_arrival when None
+        :param feature_engine: "native" point-in-time join or "feast" historical retrieval
+        :param selection_metric: test metric the saved model is selected by, one of selection_metrics
+        :param n_jobs: number of candidates fitted at the same time, -1 for all candidates
+        :param tune: search hyperparameters of every candidate before fitting it, see model_tuning.py
+        :param tuning_budget_sec: wall clock budget of the hyperparameter search
+        :param promote: make the registered model the promoted version used for scoring
+        :return : fit_candidate result of the selected model
+    """
+    # 1. Read the data from gold layer to verify label distribution, only the entity and label columns
+    if customer_loan_info is None:
+        customer_loan_info = GoldDataset().read(columns=["customer_id", "event_timestamp", "outcome"],
+                                                start=start or file_arrival, end=end or file_arrival)
     min_possible_count_of_label_class = customer_loan_info["outcome"].value_counts().min()
 
     customer_loan_info_1 = customer_loan_info[customer_loan_info['outcome'] == 1] \
@@ -53,19 +187,9 @@ def model_building(file_arrival):
     Y = data_available_for_model["outcome"]
 
     # 2. Query feature store for training data
-    store = FeatureStore(repo_path="feature_repo")
-
-    X = store.get_historical_features(
-        entity_df=ids_to_query_feature_store,
-        features=[
-            "loan_features:age_binned",
-            "loan_features:job_type_encoded",
-            "loan_features:marital_status_encoded",
-            "loan_features:educational_level_encoded",
-            "loan_features:credit_commitment",
-            "loan_features:avg_yearly_balance_binned",
-        ]
-    ).to_df()
+    with util.Span("get_training_features", rows_in=len(ids_to_query_feature_store)) as span:
+        X = get_training_features(ids_to_query_feature_store, feature_engine)
+        span.rows_out = len(X)
 
     X.drop(["customer_id", "event_timestamp"], axis=1, inplace=True)
 
@@ -74,68 +198,36 @@ def model_building(file_arrival):
     training_x, test_x, training_y, test_y = (
         train_test_split(X, Y, test_size=test_size, stratify=Y, random_state=1234))
 
-    # 4. Applying Logistic Regression
-    LR_model = LogisticRegression(solver='liblinear')
-    LR_model.fit(training_x, training_y)
-    test_y_pred = LR_model.predict(test_x)
-
-    accuracy_LR = accuracy_score(test_y, test_y_pred)
-    conf_matrix_LR = confusion_matrix(test_y, test_y_pred)
-    class_report_LR = classification_report(test_y, test_y_pred)
-    logging.info("==== LOGISTIC REGRESSION ====")
-    logging.info(f"Accuracy: {accuracy_LR}")
-    logging.info("Confusion Matrix:")
-    logging.info(conf_matrix_LR)
-    logging.info("Classification Report:")
-    logging.info(class_report_LR)
-
-    # 5. Applying Decision Trees
-    DR_Model = DecisionTreeClassifier(random_state=42)
-    DR_Model.fit(training_x, training_y)
-    test_y_pred_DR = DR_Model.predict(test_x)
-
-    accuracy_DR = accuracy_score(test_y, test_y_pred_DR)
-    conf_matrix_DR = confusion_matrix(test_y, test_y_pred_DR)
-    class_report_DR = classification_report(test_y, test_y_pred_DR, target_names=["not-subsccribed", "subscribed"])
-    logging.info("==== DECISION TREES ====")
-    logging.info(f"Accuracy: {accuracy_DR}")
-    logging.info("Confusion Matrix:")
-    logging.info(conf_matrix_DR)
-    logging.info("Classification Report:")
-    logging.info(class_report_DR)
-
-    # 6. Applying Random Forest
-    RF_Model = RandomForestClassifier(n_estimators=50, random_state=12)
-    RF_Model.fit(training_x, training_y)
-    test_y_pred_RF = RF_Model.predict(test_x)
-
-    accuracy_RF = accuracy_score(test_y, test_y_pred_RF)
-    conf_matrix_RF = confusion_matrix(test_y, test_y_pred_RF)
-    class_report_RF = classification_report(test_y, test_y_pred_RF, target_names=["not-subsccribed", "subscribed"])
-    logging.info("==== RANDOM FOREST ====")
-    logging.info(f"Accuracy: {accuracy_RF}")
-    logging.info("Confusion Matrix:")
-    logging.info(conf_matrix_RF)
-    logging.info("Classification Report:")
-    logging.info(class_report_RF)
-
-    # 7. KNN Classifier
-    KNN_Model = KNeighborsClassifier(n_neighbors=5)
-    KNN_Model.fit(training_x, training_y)
-    test_y_pred_KNN = KNN_Model.predict(test_x)
-
-    accuracy_KNN = accuracy_score(test_y, test_y_pred_KNN)
-    conf_matrix_KNN = confusion_matrix(test_y, test_y_pred_KNN)
-    class_report_KNN = classification_report(test_y, test_y_pred_KNN, target_names=["not-subsccribed", "subscribed"])
-    logging.info("==== KNN CLASSIFIER ====")
-    logging.info(f"Accuracy: {accuracy_KNN}")
-    logging.info("Confusion Matrix:")
-    logging.info(conf_matrix_KNN)
-    logging.info("Classification Report:")
-    logging.info(class_report_KNN)
-
-    # 8. Save Random Forest model, since it is performing well, using versioning tool
-    joblib.dump(RF_Model, f"{models_path}RF_customer_churn_prediction_model_{file_arrival}.pkl")
+    # 4 - 7. Fit Logistic Regression, Decision Trees, Random Forest and KNN concurrently,
+    # with hyperparameters searched on cross validation folds of the training set when tuning
+    candidates = candidate_models()
+    if tune:
+        candidates, search_results = model_tuning.tune_candidates(candidates, training_x, training_y,
+                                                                  selection_metric, tuning_budget_sec)
+        logging.info("==== HYPERPARAMETER SEARCH ====")
+        logging.info(pd.DataFrame(search_results).to_string(index=False))
+    results = train_candidates(training_x, training_y, test_x, test_y, n_jobs, candidates)
+    for result in results:
+        logging.info(f"==== {result['title']} ====")
+        logging.info(f"Accuracy: {result['accuracy']}")
+        logging.info("Confusion Matrix:")
+        logging.info(result["confusion_matrix"])
+        logging.info("Classification Report:")
+        logging.info(result["classification_report"])
+
+    # 8. Register the best model by the selection metric in the model registry, see model_registry.py
+    best = select_best_model(results, selection_metric)
+    comparison_report = write_comparison_report(results, best, file_arrival)
+    logging.info(f"Model comparison report is available at: {comparison_report}")
+    logging.info(f"Selected {best['name']} by {selection_metric}: {best[selection_metric]}")
+
+    registry = ModelRegistry()
+    best["version"] = registry.register(
+        best["model"], file_arrival, list(training_x.columns),
+        metrics={metric: float(best[metric]) for metric in selection_metrics + ["fit_time_sec"]},
+        data_hash=data_sha256(training_x, training_y), promote=promote)
+    logging.info(f"Registered {best['name']} as {registry.name} version {best['version']}, promoted: {promote}")
+    return best
 
 
 def main():
@@ -143,13 +235,42 @@ def main():
 
     parser = argparse.ArgumentParser(description="Model customer churn prediction")
     parser.add_argument("file_arrival_time", help="time of file arrival in YYYYMMDD_HHMMSS")
+    parser.add_argument("--start", default=None, help="first gold partition of the training window, YYYYMMDD")
+    parser.add_argument("--end", default=None, help="last gold partition of the training window, YYYYMMDD")
+    parser.add_argument("--feature-engine", choices=["native", "feast"], default="native",
+                        help="point-in-time join engine for training features, native as-of join or feast")
+    parser.add_argument("--selection-metric", choices=selection_metrics, default="accuracy",
+                        help="test metric the saved model is selected by")
+    parser.add_argument("--n-jobs", type=int, default=-1, help="number of candidates fitted at the same time")
+    parser.add_argument("--tune", action="store_true",
+                        help="search hyperparameters of every candidate with successive halving before fitting")
+    parser.add_argument("--tuning-budget-sec", type=float, default=600,
+                        help="wall clock budget of the hyperparameter search")
+    parser.add_argument("--no-promote", action="store_true",
+                        help="register the model without making it the promoted version")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="run the stage even when its inputs, parameters and code are unchanged since a cached run")
     args = parser.parse_args()
 
     file_arrival = args.file_arrival_time
 
-    logging.info(f"file_arrival : {file_arrival}")
-
-    model_building(file_arrival)
+    logging.info(f"file_arrival : {file_arrival}, training window : {args.start} - {args.end}")
+
+    def run():
+        best = model_building(file_arrival, start=args.start, end=args.end, feature_engine=args.feature_engine,
+                              selection_metric=args.selection_metric, n_jobs=args.n_jobs, tune=args.tune,
+                              tuning_budget_sec=args.tuning_budget_sec, promote=not args.no_promote)
+        return {"name": best["name"], "version": best["version"]}
+
+    # the registered model version is the output of a cached run
+    with util.job_span(job_name, file_arrival):
+        cache = None if args.no_cache else stage_cache.StageCache()
+        skipped, registered = stage_cache.run_cached(
+            "model_building", file_arrival, stage_cache.params_of_args(args), run, cache,
+            outputs_of_result=lambda result: [ModelRegistry().version_folder(result["version"])])
+        if skipped:
+            logging.info(f"Skipped, {registered['name']} trained on the same data, parameters and code is "
+                         f"registered as version {registered['version']}")
 
     logging.info(f"=== {job_name} ended ===")
 
@@ -0,0 +1,117 @@
+"""
+Exported forest benchmark
+    •	Fits a Random Forest like the RF candidate of 9_model_building on synthetic model features
+    •	Times single-row latency, as the prediction service sees it, and bulk throughput, as batch scoring sees it,
+        of the exported forest of forest_export.py against predict_proba of sklearn
+    •	Checks that both return the same probabilities
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import RandomForestClassifier
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import util
+import forest_export
+from feature_transforms import model_features
+
+job_name = "forest_benchmark"
+logging = util.get_logger(job_name)
+
+results_path = "benchmarks/results"
+training_rows = 20_000
+
+
+def synthetic_features(num_rows, seed=1234):
+    rng = np.random.default_rng(seed)
+    data = pd.DataFrame({feature: rng.integers(0, 12, num_rows).astype("float64") for feature in model_features})
+    # some missing values, routed by the missing value direction of the trees
+    data.iloc[::97, 0] = np.nan
+    return data
+
+
+def synthetic_outcome(data, seed=4321):
+    rng = np.random.default_rng(seed)
+    score = data.fillna(0).to_numpy().sum(axis=1) + rng.normal(0, 4, len(data))
+    return (score > np.median(score)).astype("int64")
+
+
+def single_row_latency_ms(model, data):
+    latencies = []
+    for index in range(len(data)):
+        start = time.perf_counter()
+        model.predict_proba(data.iloc[index:index + 1])
+        latencies.append(time.perf_counter() - start)
+    return 1000 * float(np.median(latencies))
+
+
+def bulk_rows_per_sec(model, data):
+    start = time.perf_counter()
+    proba = model.predict_proba(data)
+    return proba, len(data) / (time.perf_counter() - start)
+
+
+def run_benchmark(bulk_rows, n_estimators, max_depth, single_row_calls):
+    """
+        :param bulk_rows: number of rows of the bulk prediction
+        :return : dict of latencies, throughputs and whether the probabilities are the same
+    """
+    training_data = synthetic_features(training_rows)
+    model = RandomForestClassifier(n_estimators=n_estimators, max_depth=max_depth, random_state=12, n_jobs=1)
+    model.fit(training_data, synthetic_outcome(training_data))
+
+    forest_folder = tempfile.mkdtemp(prefix="forest_benchmark_")
+    try:
+        forest_export.export_forest(model, forest_folder)
+        forest = forest_export.ForestPredictor(forest_folder)
+        data = synthetic_features(bulk_rows, seed=5678)
+        single_rows = synthetic_features(single_row_calls, seed=8765)
+
+        result = {"bulk_rows": bulk_rows, "n_estimators": n_estimators, "max_depth": forest.max_depth}
+        for name, predictor in [("forest", forest), ("sklearn", model)]:
+            result[f"{name}_single_row_ms"] = single_row_latency_ms(predictor, single_rows)
+        forest_proba, result["forest_bulk_rows_per_sec"] = bulk_rows_per_sec(forest, data)
+        sklearn_proba, result["sklearn_bulk_rows_per_sec"] = bulk_rows_per_sec(model, data)
+        result["same_probabilities"] = bool(np.array_equal(forest_proba, sklearn_proba))
+    finally:
+        shutil.rmtree(forest_folder, ignore_errors=True)
+
+    logging.info(f"exported forest benchmark: {result}")
+    print(result)
+    return result
+
+
+def main():
+    logging.info(f"=== {job_name} started ===")
+
+    parser = argparse.ArgumentParser(description="benchmark the exported forest against sklearn")
+    parser.add_argument("--bulk-rows", type=int, nargs="+", default=[100_000],
+                        help="numbers of rows of the bulk prediction")
+    parser.add_argument("--n-estimators", type=int, default=50, help="number of trees of the forest")
+    parser.add_argument("--max-depth", type=int, default=None, help="maximum depth of the trees")
+    parser.add_argument("--single-row-calls", type=int, default=200, help="number of single-row predictions timed")
+    args = parser.parse_args()
+
+    results = [run_benchmark(bulk_rows, args.n_estimators, args.max_depth, args.single_row_calls)
+               for bulk_rows in args.bulk_rows]
+
+    os.makedirs(results_path, exist_ok=True)
+    with open(f"{results_path}/forest_benchmark.json", "w") as f:
+        json.dump(results, f, indent=2)
+
+    logging.info(f"=== {job_name} ended ===")
+    # probabilities that differ from sklearn are a bug of the export, not a slow run
+    sys.exit(0 if all(result["same_probabilities"] for result in results) else 1)
+
+
+if __name__ == "__main__":
+    main()
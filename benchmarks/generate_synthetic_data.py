@@ -0,0 +1,240 @@
+"""
+Synthetic data generator
+    •	Generates Loan Info landing files and the Customer Info table at 10k, 1M, 10M or 100M rows,
+        with the columns and value types 2_data_ingestion and 4_data_validation expect
+    •	Loan Info follows sample_data/loan_info/customer_loan_info.csv:
+        o	the outcome y keeps the churn rate of the sample
+        o	every other column is drawn from its distribution in the sample rows with the same outcome,
+            categories by frequency and numbers by the quantiles of the sample
+    •	Customer Info follows a sample csv when given, else the default profile below
+    •	Rows are generated and written chunk by chunk, memory does not grow with the number of rows
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+
+repo_folder = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_folder)
+
+import util
+
+job_name = "generate_synthetic_data"
+logging = util.get_logger(job_name)
+
+scales = {"10k": 10_000, "1m": 1_000_000, "10m": 10_000_000, "100m": 100_000_000}
+
+loan_info_sample_file = os.path.join(repo_folder, "sample_data/loan_info/customer_loan_info.csv")
+landing_folder = "LocalDataLake/Landing"
+customer_info_file = "sample_data/customer_info_table.csv"
+
+loan_info_columns = ["id", "default", "balance", "housing", "loan", "contact", "day", "month", "duration",
+                     "campaign", "pdays", "previous", "poutcome", "y"]
+customer_info_columns = ["id", "age", "job", "marital", "education"]
+
+
+class ColumnProfile:
+    """
+        Distribution of one column: categories with their frequencies, or the sorted values of a numeric column
+        which are sampled by inverse transform with linear interpolation between neighbouring values
+    """
+
+    def __init__(self, categories=None, probabilities=None, quantiles=None):
+        self.categories = None if categories is None else np.asarray(categories, dtype=object)
+        self.probabilities = None if probabilities is None else np.asarray(probabilities, dtype="float64")
+        self.quantiles = None if quantiles is None else np.sort(np.asarray(quantiles, dtype="float64"))
+
+    @classmethod
+    def from_series(cls, series):
+        if pd.api.types.is_numeric_dtype(series):
+            return cls(quantiles=series.dropna().to_numpy())
+        frequencies = series.astype(object).value_counts(normalize=True)
+        return cls(categories=frequencies.index, probabilities=frequencies.to_numpy())
+
+    def sample_indices(self, rows, rng):
+        return rng.choice(len(self.categories), size=rows, p=self.probabilities / self.probabilities.sum())
+
+    def sample(self, rows, rng):
+        """
+            :return : pyarrow array of rows values, strings are decoded from dictionary indices
+        """
+        if self.categories is not None:
+            indices = self.sample_indices(rows, rng)
+            return pa.DictionaryArray.from_arrays(pa.array(indices.astype("int32")),
+                                                  pa.array(self.categories.tolist(), pa.string())) \
+                .dictionary_decode()
+        positions = rng.random(rows) * (len(self.quantiles) - 1)
+        values = np.interp(positions, np.arange(len(self.quantiles)), self.quantiles)
+        return pa.array(np.rint(values).astype("int64"))
+
+
+class TableProfile:
+    """
+        Column distributions of a table, conditional on the value of a label column when given
+    """
+
+    def __init__(self, columns, label=None, label_profile=None, profiles=None):
+        self.columns = list(columns)
+        self.label = label
+        self.label_profile = label_profile
+        # label value -> column -> ColumnProfile, a single None key without label
+        self.profiles = profiles
+
+    @classmethod
+    def from_dataframe(cls, df, id_column="id", label=None):
+        columns = [col for col in df.columns if col != id_column]
+        if label is None:
+            return cls(columns, profiles={None: {col: ColumnProfile.from_series(df[col]) for col in columns}})
+        profiles = {value: {col: ColumnProfile.from_series(rows[col]) for col in columns if col != label}
+                    for value, rows in df.groupby(label)}
+        return cls(columns, label, ColumnProfile.from_series(df[label]), profiles)
+
+    def sample(self, ids, rng):
+        """
+            :param ids: numpy array of the id column of the generated rows
+            :return : pyarrow table of id followed by the profiled columns
+        """
+        rows = len(ids)
+        if self.label is None:
+            arrays = {col: profile.sample(rows, rng) for col, profile in self.profiles[None].items()}
+            return pa.table({"id": pa.array(ids), **{col: arrays[col] for col in self.columns}})
+
+        labels = self.label_profile.sample_indices(rows, rng)
+        order = np.argsort(labels, kind="stable")
+        counts = np.bincount(labels, minlength=len(self.label_profile.categories))
+        chunks = []
+        # rows of one label value are generated together from the distributions of that value
+        for value, count in zip(self.label_profile.categories, counts):
+            if count:
+                profiles = self.profiles[value]
+                chunks.append(pa.table({col: profiles[col].sample(count, rng) if col != self.label
+                                        else pa.repeat(pa.scalar(value, pa.string()), count)
+                                        for col in self.columns}))
+        # back to the random label order, otherwise the rows of a label would form one block
+        table = pa.concat_tables(chunks).take(pa.array(np.argsort(order, kind="stable")))
+        return table.add_column(0, "id", pa.array(ids))
+
+
+# Customer Info of the bank marketing data the sample comes from, used when no customer sample is given
+default_customer_profile = TableProfile(customer_info_columns[1:], profiles={None: {
+    "age": ColumnProfile(quantiles=[18, 29, 32, 34, 36, 39, 42, 46, 51, 56, 95]),
+    "job": ColumnProfile(["blue-collar", "management", "technician", "admin.", "services", "retired",
+                          "self-employed", "entrepreneur", "unemployed", "housemaid", "student", "unknown"],
+                         [0.215, 0.209, 0.168, 0.114, 0.092, 0.050, 0.035, 0.033, 0.029, 0.027, 0.021, 0.007]),
+    "marital": ColumnProfile(["married", "single", "divorced"], [0.602, 0.283, 0.115]),
+    "education": ColumnProfile(["secondary", "tertiary", "primary", "unknown"], [0.513, 0.294, 0.152, 0.041]),
+}})
+
+
+def parse_rows(scale):
+    """
+        :param scale: one of scales, e.g. "10M", or a number of rows
+        :return : number of rows
+    """
+    return scales.get(scale.lower()) or int(scale)
+
+
+def write_csv_chunks(tables, output_file):
+    """
+        Appends a stream of tables to one csv file with a single header
+        :return : number of rows written
+    """
+    rows_written = 0
+    writer = None
+    try:
+        for table in tables:
+            if writer is None:
+                # unquoted like the sample files, no generated value contains a comma
+                writer = pacsv.CSVWriter(output_file, table.schema,
+                                         write_options=pacsv.WriteOptions(quoting_style="none"))
+            writer.write_table(table)
+            rows_written += table.num_rows
+    finally:
+        if writer is not None:
+            writer.close()
+    return rows_written
+
+
+def generate_tables(profile, rows, chunk_size, seed, first_id=1):
+    """
+        :return : generator of tables of at most chunk_size rows with ids first_id, first_id + 1, ...
+    """
+    for chunk_start in range(0, rows, chunk_size):
+        # one random stream per chunk, chunks do not depend on each other
+        rng = np.random.default_rng([seed, chunk_start])
+        ids = np.arange(first_id + chunk_start, first_id + min(rows, chunk_start + chunk_size), dtype="int64")
+        yield profile.sample(ids, rng)
+
+
+def generate_loan_info(rows, output_folder=landing_folder, chunk_size=1_000_000, rows_per_file=10_000_000,
+                       seed=1234, sample_file=loan_info_sample_file):
+    """
+        Writes Loan Info landing csv files of rows_per_file rows each
+        :return : list of files written
+    """
+    profile = TableProfile.from_dataframe(pd.read_csv(sample_file)[loan_info_columns], label="y")
+    os.makedirs(output_folder, exist_ok=True)
+    files = []
+    for file_number, file_start in enumerate(range(0, rows, rows_per_file)):
+        output_file = os.path.join(output_folder, f"loan_info_{rows}_part-{file_number:05d}.csv")
+        file_rows = min(rows_per_file, rows - file_start)
+        write_csv_chunks(generate_tables(profile, file_rows, chunk_size, seed + file_number, file_start + 1),
+                         output_file)
+        files.append(output_file)
+    return files
+
+
+def generate_customer_info(rows, output_file=customer_info_file, chunk_size=1_000_000, seed=4321,
+                           sample_file=None):
+    """
+        Writes the Customer Info table csv, one customer for every Loan Info id
+        :param sample_file: customer info csv to take the distributions from, default_customer_profile when None
+        :return : number of rows written
+    """
+    profile = default_customer_profile if sample_file is None \
+        else TableProfile.from_dataframe(pd.read_csv(sample_file)[customer_info_columns])
+    os.makedirs(os.path.dirname(output_file) or ".", exist_ok=True)
+    return write_csv_chunks(generate_tables(profile, rows, chunk_size, seed), output_file)
+
+
+def main():
+    logging.info(f"=== {job_name} started ===")
+
+    parser = argparse.ArgumentParser(description="generate synthetic loan and customer info like the sample data")
+    parser.add_argument("scale", help=f"number of rows, one of {list(scales)} or a number")
+    parser.add_argument("--output-folder", default=".",
+                        help="folder the LocalDataLake/Landing files and the customer info csv are written under")
+    parser.add_argument("--chunk-size", type=int, default=1_000_000, help="number of rows generated at a time")
+    parser.add_argument("--rows-per-file", type=int, default=10_000_000,
+                        help="number of rows of one Loan Info landing file")
+    parser.add_argument("--customer-sample", default=None,
+                        help="customer info csv to take the distributions from, a built in profile when not given")
+    parser.add_argument("--seed", type=int, default=1234, help="seed of the random generator")
+    args = parser.parse_args()
+
+    rows = parse_rows(args.scale)
+    logging.info(f"rows : {rows}, output_folder : {args.output_folder}")
+
+    start = time.perf_counter()
+    loan_files = generate_loan_info(rows, os.path.join(args.output_folder, landing_folder), args.chunk_size,
+                                    args.rows_per_file, args.seed)
+    customer_rows = generate_customer_info(rows, os.path.join(args.output_folder, customer_info_file),
+                                           args.chunk_size, args.seed + 1, args.customer_sample)
+    elapsed = time.perf_counter() - start
+
+    logging.info(f"Loan Info landing files: {loan_files}")
+    logging.info(f"Customer Info: {customer_rows} rows in {customer_info_file}")
+    logging.info(f"Generated {2 * rows} rows in {elapsed:.1f}s")
+    print(f"Generated {rows} loan info and {customer_rows} customer info rows in {elapsed:.1f}s")
+
+    logging.info(f"=== {job_name} ended ===")
+
+
+if __name__ == "__main__":
+    main()
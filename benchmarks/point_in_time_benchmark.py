@@ -0,0 +1,164 @@
+"""
+Point-in-time join benchmark
+    •	Builds a synthetic loan_features source and entity rows at the given scales
+    •	Times the native as-of join of point_in_time.py against feast historical retrieval
+    •	Checks that both engines return the same features
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import util
+import point_in_time
+
+job_name = "point_in_time_benchmark"
+logging = util.get_logger(job_name)
+
+feature_repo_path = "feature_repo"
+results_path = "benchmarks/results"
+snapshots_per_customer = 4
+features = [
+    "loan_features:age_binned",
+    "loan_features:job_type_encoded",
+    "loan_features:marital_status_encoded",
+    "loan_features:educational_level_encoded",
+    "loan_features:credit_commitment",
+    "loan_features:avg_yearly_balance_binned",
+]
+
+
+def synthetic_feature_source(num_customers, seed=1234):
+    """
+        Weekly snapshots of the loan_features view for num_customers customers
+    """
+    rng = np.random.default_rng(seed)
+    rows = num_customers * snapshots_per_customer
+    customer_id = np.tile(np.arange(num_customers, dtype="int64"), snapshots_per_customer)
+    week = np.repeat(np.arange(snapshots_per_customer), num_customers)
+    return pd.DataFrame({
+        "customer_id": customer_id,
+        "age": rng.integers(18, 95, rows),
+        "job_type_encoded": rng.integers(1, 12, rows),
+        "marital_status_encoded": rng.integers(1, 4, rows),
+        "educational_level_encoded": rng.integers(1, 4, rows),
+        "age_binned": rng.choice([17.5, 30.0, 40.0, 50.0, 60.0, 70.0], rows),
+        "avg_yearly_balance": rng.integers(-200, 10000, rows),
+        "contacted_day": rng.integers(1, 32, rows),
+        "contacted_month": rng.choice(["may", "jun", "jul", "aug"], rows),
+        "contacted_duration_sec": rng.random(rows),
+        "total_times_contacted": rng.integers(1, 10, rows),
+        "credit_commitment": rng.integers(0, 4, rows),
+        "avg_yearly_balance_binned": rng.choice([-100.0, 100.0, 300.0, 500.0, 1000.0, 1850.0], rows),
+        "event_timestamp": pd.Timestamp("2025-08-02") + pd.to_timedelta(week * 7, unit="D"),
+    })
+
+
+def synthetic_entity_df(num_rows, num_customers, seed=4321):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        "customer_id": rng.integers(0, num_customers, num_rows).astype("int64"),
+        "event_timestamp": pd.Timestamp("2025-08-01") + pd.to_timedelta(rng.integers(0, 35 * 24, num_rows),
+                                                                        unit="h"),
+    })
+
+
+def make_feature_repo(repo_path, feature_source):
+    """
+        Copy of the feature repo definitions with the synthetic source as data/customer_loan_info.parquet
+    """
+    os.makedirs(f"{repo_path}/data", exist_ok=True)
+    shutil.copy(f"{feature_repo_path}/repo.py", f"{repo_path}/repo.py")
+    shutil.copy(f"{feature_repo_path}/feature_store.yaml", f"{repo_path}/feature_store.yaml")
+    feature_source.to_parquet(f"{repo_path}/data/customer_loan_info.parquet", index=False)
+
+
+def feast_historical_features(repo_path, entity_df):
+    from feast import Entity, FeatureStore, FeatureView
+
+    module_spec = importlib.util.spec_from_file_location("benchmark_repo", f"{repo_path}/repo.py")
+    module = importlib.util.module_from_spec(module_spec)
+    module_spec.loader.exec_module(module)
+
+    store = FeatureStore(repo_path=repo_path)
+    store.apply([definition for definition in vars(module).values()
+                 if isinstance(definition, (Entity, FeatureView))])
+    return store.get_historical_features(entity_df=entity_df, features=features).to_df()
+
+
+def same_features(native_df, feast_df):
+    keys = ["customer_id", "event_timestamp"]
+    columns = [feature.split(":")[1] for feature in features]
+    native_df = native_df.sort_values(keys, kind="stable").reset_index(drop=True)
+    feast_df = feast_df.sort_values(keys, kind="stable").reset_index(drop=True)
+    return all(np.allclose(native_df[col].to_numpy(dtype="float64", na_value=np.nan),
+                           feast_df[col].to_numpy(dtype="float64", na_value=np.nan), equal_nan=True)
+               for col in columns)
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def run_benchmark(entity_rows, engines):
+    """
+        :param entity_rows: number of entity rows of this run, the source has a quarter as many customers
+        :param engines: engines to time, "native" and/or "feast"
+        :return : dict of timings in seconds
+    """
+    num_customers = max(1, entity_rows // 4)
+    entity_df = synthetic_entity_df(entity_rows, num_customers)
+    repo_path = tempfile.mkdtemp(prefix="pit_benchmark_")
+    result = {"entity_rows": entity_rows, "feature_rows": num_customers * snapshots_per_customer}
+    try:
+        make_feature_repo(repo_path, synthetic_feature_source(num_customers))
+
+        native_df, feast_df = None, None
+        if "native" in engines:
+            native_df, result["native_sec"] = timed(point_in_time.get_historical_features, entity_df, features,
+                                                    repo_path)
+        if "feast" in engines:
+            feast_df, result["feast_sec"] = timed(feast_historical_features, repo_path, entity_df)
+        if native_df is not None and feast_df is not None:
+            result["same_features"] = same_features(native_df, feast_df)
+            result["speedup"] = result["feast_sec"] / result["native_sec"]
+    finally:
+        shutil.rmtree(repo_path, ignore_errors=True)
+
+    logging.info(f"point-in-time join benchmark: {result}")
+    print(result)
+    return result
+
+
+def main():
+    logging.info(f"=== {job_name} started ===")
+
+    parser = argparse.ArgumentParser(description="benchmark native point-in-time join against feast")
+    parser.add_argument("--entity-rows", type=int, nargs="+", default=[1_000_000, 10_000_000],
+                        help="numbers of entity rows to benchmark")
+    parser.add_argument("--engines", nargs="+", choices=["native", "feast"], default=["native", "feast"])
+    args = parser.parse_args()
+
+    results = [run_benchmark(entity_rows, args.engines) for entity_rows in args.entity_rows]
+
+    os.makedirs(results_path, exist_ok=True)
+    with open(f"{results_path}/point_in_time_benchmark.json", "w") as f:
+        json.dump(results, f, indent=2)
+
+    logging.info(f"=== {job_name} ended ===")
+
+
+if __name__ == "__main__":
+    main()
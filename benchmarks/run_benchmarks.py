@@ -0,0 +1,335 @@
+"""
+Pipeline scaling benchmark
+    •	Generates synthetic data of every scale with generate_synthetic_data.py, in a workspace folder per scale
+    •	Runs ingestion, validation, preparation, transformation, feature retrieval and training on it, every step
+        in its own process, so the peak memory of a step is its own:
+        o	stages 2, 4, 5 and 6 run as scheduled by the DAG, streaming chunks from 10M rows on
+        o	feature retrieval is the point-in-time join of point_in_time.py on the gold partition
+        o	training fits the candidates of 9_model_building on a sample of the gold partition
+    •	Wall time, CPU time and peak RSS of a step are read from the metrics file of its run, see util.job_span
+    •	Throughput and peak memory are compared against the stored baseline, a step slower or larger
+      than the baseline by more than the tolerance fails the benchmark, as does a step without baseline.
+      The baseline records the machine it was measured on. Throughput is only compared on the same machine,
+      on another one only peak memory is, until a baseline of that machine is stored.
+      The committed baseline.json holds the default scales, generated with the default seeds of
+      generate_synthetic_data.py, with the slowest throughput and largest peak RSS of three runs
+"""
+
+import argparse
+import importlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+repo_folder = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_folder)
+
+import util
+
+job_name = "run_benchmarks"
+logging = util.get_logger(job_name)
+
+# imported after the logger of this job is configured, the generator configures its own on import
+import generate_synthetic_data
+
+workspace_path = "benchmarks/workspace"
+results_path = "benchmarks/results"
+baseline_file = "benchmarks/baseline.json"
+
+file_arrival = "20250830"
+all_steps = ["ingestion", "validation", "preparation", "transformation", "feature_retrieval", "training"]
+# from this many rows on the stages stream chunks instead of loading a whole partition
+out_of_core_min_rows = 10_000_000
+chunk_size = 1_000_000
+join_partitions = 64
+
+
+def stage_command(step, rows):
+    """
+        :return : command line of a step, run in the workspace folder
+    """
+    out_of_core = rows >= out_of_core_min_rows
+    chunked = ["--chunk-size", str(chunk_size)] if out_of_core else []
+    scripts = {
+        # landing files of an earlier run of the workspace are in the manifest already
+        "ingestion": ["2_data_ingestion.py", "--full-refresh"] + chunked,
+        "validation": ["4_data_validation.py"] + chunked,
+        "preparation": ["5_data_preparation.py"] + chunked,
+        "transformation": ["6_data_transformation_and_storage.py"] + (
+            ["--join-partitions", str(join_partitions), "--chunk-size", str(chunk_size)] if out_of_core else []),
+    }
+    if step in scripts:
+        script, *options = scripts[step]
+        return [sys.executable, os.path.join(repo_folder, script), file_arrival, "--no-cache"] + options
+    return [sys.executable, os.path.abspath(__file__), "--step", step]
+
+
+def step_job_name(step):
+    scripts = {"ingestion": "2_data_ingestion", "validation": "4_data_validation",
+               "preparation": "5_data_preparation", "transformation": "6_data_transformation_and_storage"}
+    return scripts.get(step, f"benchmark_{step}")
+
+
+def prepare_workspace(workspace, rows, regenerate=False):
+    """
+        Generates the landing files and the customer_info table of a scale, unless an earlier run did
+    """
+    marker_file = os.path.join(workspace, "_generated.json")
+    if os.path.exists(marker_file) and not regenerate:
+        return
+    start = time.perf_counter()
+    generate_synthetic_data.generate_loan_info(rows, os.path.join(workspace, generate_synthetic_data.landing_folder),
+                                               chunk_size)
+    customer_info_file = os.path.join(workspace, generate_synthetic_data.customer_info_file)
+    generate_synthetic_data.generate_customer_info(rows, customer_info_file, chunk_size)
+    subprocess.run([sys.executable, os.path.join(repo_folder, "2_load_customer_info_in_db.py"),
+                    generate_synthetic_data.customer_info_file, "--chunk-size", str(chunk_size)],
+                   cwd=workspace, check=True)
+    with open(marker_file, "w") as f:
+        json.dump({"rows": rows, "generation_sec": time.perf_counter() - start}, f)
+
+
+def read_job_metrics(workspace, job, lines_before):
+    """
+        :return : metrics of the root span of the latest run of job in the workspace, None when there is none
+    """
+    metrics_file = os.path.join(workspace, util.metrics_folder, f"file_arrival={file_arrival}", "metrics.jsonl")
+    if not os.path.exists(metrics_file):
+        return None
+    with open(metrics_file) as f:
+        records = [json.loads(line) for line in f.readlines()[lines_before:]]
+    job_records = [record for record in records if record["span"] == job]
+    return job_records[-1] if job_records else None
+
+
+def count_metric_lines(workspace):
+    metrics_file = os.path.join(workspace, util.metrics_folder, f"file_arrival={file_arrival}", "metrics.jsonl")
+    if not os.path.exists(metrics_file):
+        return 0
+    with open(metrics_file) as f:
+        return sum(1 for _ in f)
+
+
+def run_step(workspace, step, rows):
+    """
+        Runs one step in its own process
+        :return : dict of wall and CPU time, peak RSS and throughput of the step
+    """
+    lines_before = count_metric_lines(workspace)
+    completed = subprocess.run(stage_command(step, rows), cwd=workspace)
+    metrics = read_job_metrics(workspace, step_job_name(step), lines_before) or {}
+    # steps of this file count their own rows, the stages process every generated row
+    rows_processed = metrics.get("rows_in") or rows
+    wall_sec = metrics.get("wall_sec")
+    return {
+        "step": step,
+        "status": "ok" if completed.returncode == 0 and metrics.get("status") == "ok" else "failed",
+        "rows": rows_processed,
+        "wall_sec": wall_sec,
+        "cpu_sec": metrics.get("cpu_sec"),
+        "peak_rss_mb": metrics.get("peak_rss_mb"),
+        "rows_per_sec": rows_processed / wall_sec if wall_sec else None,
+    }
+
+
+def feature_retrieval_step(max_rows):
+    """
+        Point-in-time features of the customers of the gold partition, one day after the partition
+        :return : number of entity rows
+    """
+    import point_in_time
+    from feature_transforms import model_features
+    from gold_dataset import GoldDataset, customer_loan_info_path
+
+    spec = point_in_time.FeatureViewSpec("loan_features", f"{customer_loan_info_path}/file_arrival={file_arrival}",
+                                         "event_timestamp", ["customer_id"], model_features,
+                                         ttl=timedelta(days=365))
+    entity_df = head_rows(GoldDataset().iter_batches(["customer_id", "event_timestamp"], file_arrival,
+                                                     file_arrival, batch_size=chunk_size), max_rows)
+    entity_df["event_timestamp"] = entity_df["event_timestamp"] + pd.Timedelta(days=1)
+    point_in_time.get_historical_features(entity_df, [f"loan_features:{feature}" for feature in model_features],
+                                          feature_views={"loan_features": spec})
+    return len(entity_df)
+
+
+def training_step(max_rows):
+    """
+        Fits the candidate models of 9_model_building on the first max_rows customers of the gold partition
+        :return : number of training rows
+    """
+    from sklearn.model_selection import train_test_split
+    from feature_transforms import model_features
+    from gold_dataset import GoldDataset
+
+    model_building = importlib.import_module("9_model_building")
+    data = head_rows(GoldDataset().iter_batches(model_features + ["outcome"], file_arrival, file_arrival,
+                                                batch_size=chunk_size), max_rows).dropna()
+    training_x, test_x, training_y, test_y = train_test_split(data[model_features], data["outcome"],
+                                                              test_size=0.20, stratify=data["outcome"],
+                                                              random_state=1234)
+    model_building.train_candidates(training_x, training_y, test_x, test_y)
+    return len(training_x)
+
+
+def head_rows(batches, max_rows):
+    chunks, rows = [], 0
+    for batch in batches:
+        chunks.append(batch.head(max_rows - rows))
+        rows += len(chunks[-1])
+        if rows >= max_rows:
+            break
+    return pd.concat(chunks, ignore_index=True)
+
+
+def host_info():
+    """
+        :return : dict describing the machine of this run
+    """
+    cpu_model = platform.processor()
+    if os.path.exists("/proc/cpuinfo"):
+        with open("/proc/cpuinfo") as f:
+            cpu_model = next((line.split(":", 1)[1].strip() for line in f if line.startswith("model name")),
+                             cpu_model)
+    return {"system": platform.system(), "machine": platform.machine(), "cpu_model": cpu_model,
+            "cpu_count": os.cpu_count(), "python": platform.python_version()}
+
+
+def same_host(host, other):
+    # rows/sec of one machine say nothing about another one, the python version only shifts them a little
+    keys = ["system", "machine", "cpu_model", "cpu_count"]
+    return bool(host and other) and all(host.get(key) == other.get(key) for key in keys)
+
+
+def compare_to_baseline(results, baseline, tolerance, compare_throughput=True):
+    """
+        :param results: list of run_step results with their scale
+        :param baseline: dict of scale -> step -> {"rows_per_sec", "peak_rss_mb"}
+        :param tolerance: allowed relative regression, 0.2 for 20 percent
+        :param compare_throughput: False when the baseline was measured on another machine
+        :return : list of regression messages, steps without baseline included
+    """
+    regressions = []
+    for result in results:
+        expected = baseline.get(result["scale"], {}).get(result["step"])
+        if result["status"] != "ok":
+            continue
+        if not expected:
+            regressions.append(f"{result['scale']} {result['step']}: no baseline, store one with --update-baseline")
+            continue
+        if compare_throughput and result["rows_per_sec"] < expected["rows_per_sec"] * (1 - tolerance):
+            regressions.append(f"{result['scale']} {result['step']}: {result['rows_per_sec']:.0f} rows/sec, "
+                               f"baseline {expected['rows_per_sec']:.0f} rows/sec")
+        if result["peak_rss_mb"] and result["peak_rss_mb"] > expected["peak_rss_mb"] * (1 + tolerance):
+            regressions.append(f"{result['scale']} {result['step']}: peak RSS {result['peak_rss_mb']:.0f} MB, "
+                               f"baseline {expected['peak_rss_mb']:.0f} MB")
+    return regressions
+
+
+def to_baseline(results, baseline=None):
+    baseline = dict(baseline or {})
+    for result in results:
+        if result["status"] == "ok":
+            baseline.setdefault(result["scale"], {})[result["step"]] = {
+                "rows_per_sec": result["rows_per_sec"], "peak_rss_mb": result["peak_rss_mb"]}
+    return baseline
+
+
+def run_benchmarks(scales, steps, regenerate=False):
+    """
+        :param scales: scales of generate_synthetic_data, e.g. ["10k", "1M"]
+        :param steps: steps to run, in all_steps order
+        :return : list of run_step results with their scale
+    """
+    results = []
+    for scale in scales:
+        rows = generate_synthetic_data.parse_rows(scale)
+        workspace = os.path.abspath(os.path.join(workspace_path, scale.lower()))
+        os.makedirs(workspace, exist_ok=True)
+        prepare_workspace(workspace, rows, regenerate)
+        for step in [step for step in all_steps if step in steps]:
+            result = {"scale": scale.lower(), **run_step(workspace, step, rows)}
+            logging.info(f"benchmark: {result}")
+            print(result)
+            results.append(result)
+    return results
+
+
+def run_step_in_process(step, max_rows):
+    # steps of this file record their metrics like the stages do
+    with util.job_span(step_job_name(step), file_arrival) as span:
+        span.rows_in = feature_retrieval_step(max_rows) if step == "feature_retrieval" else training_step(max_rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark pipeline stages on synthetic data of several scales")
+    parser.add_argument("--scales", nargs="+", default=["10k", "1M"],
+                        help=f"scales to benchmark, of {list(generate_synthetic_data.scales)}")
+    parser.add_argument("--steps", nargs="+", choices=all_steps, default=all_steps, help="steps to benchmark")
+    parser.add_argument("--regenerate", action="store_true", help="generate the data of a workspace again")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed relative regression of throughput and peak memory against the baseline")
+    parser.add_argument("--update-baseline", action="store_true",
+                        help="store the results of this run as the baseline of their scales and steps")
+    parser.add_argument("--step", choices=["feature_retrieval", "training"], default=None,
+                        help="internal: run one step in this process, in the workspace folder")
+    parser.add_argument("--max-rows", type=int, default=None,
+                        help="internal: number of rows of the feature retrieval and training steps")
+    args = parser.parse_args()
+
+    if args.step:
+        default_max_rows = {"feature_retrieval": 10_000_000, "training": 200_000}
+        run_step_in_process(args.step, args.max_rows or default_max_rows[args.step])
+        return
+
+    logging.info(f"=== {job_name} started ===")
+    # without a baseline every step would pass
+    if not os.path.exists(baseline_file) and not args.update_baseline:
+        logging.error(f"Baseline {baseline_file} is missing, store one with --update-baseline")
+        print(f"Baseline {baseline_file} is missing, store one with --update-baseline")
+        sys.exit(1)
+    results = run_benchmarks(args.scales, args.steps, args.regenerate)
+
+    os.makedirs(results_path, exist_ok=True)
+    results_file = f"{results_path}/benchmark_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+    with open(results_file, "w") as f:
+        json.dump(results, f, indent=2)
+    logging.info(f"Benchmark results are written to: {results_file}")
+
+    baseline = {"host": None, "scales": {}}
+    if os.path.exists(baseline_file):
+        with open(baseline_file) as f:
+            baseline = json.load(f)
+    host = host_info()
+    on_baseline_host = same_host(baseline["host"], host)
+    if baseline["host"] and not on_baseline_host:
+        message = (f"Baseline was measured on {baseline['host']}, this run on {host}: only peak memory is compared, "
+                   f"store a baseline of this machine with --update-baseline")
+        logging.warning(message)
+        print(message)
+    regressions = compare_to_baseline(results, baseline["scales"], args.tolerance, on_baseline_host)
+    for regression in regressions:
+        logging.warning(f"Regression: {regression}")
+        print(f"Regression: {regression}")
+
+    if args.update_baseline:
+        with open(baseline_file, "w") as f:
+            # throughput of another machine is not kept next to the one of this machine
+            json.dump({"host": host,
+                       "scales": to_baseline(results, baseline["scales"] if on_baseline_host else None)},
+                      f, indent=2)
+        logging.info(f"Baseline is updated: {baseline_file}")
+
+    logging.info(f"=== {job_name} ended ===")
+    failed = [result for result in results if result["status"] != "ok"]
+    # an updated baseline accepts the results of this run
+    sys.exit(1 if failed or (regressions and not args.update_baseline) else 0)
+
+
+if __name__ == "__main__":
+    main()
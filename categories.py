@@ -0,0 +1,78 @@
+"""
+Categorical vocabularies of the pipeline.
+Validation checks values against them, data preparation encodes with them and inference
+reuses them, so training and serving always see the same integer codes.
+Encoding goes through pandas Categorical codes, the strings of a column are hashed once
+in C instead of being mapped row by row in Python.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+class Vocabulary:
+    """
+        Ordered list of allowed values, value i is encoded as first_code + i
+    """
+
+    def __init__(self, values, first_code=0):
+        self.values = list(values)
+        self.first_code = first_code
+        self.dtype = pd.CategoricalDtype(self.values)
+
+    @property
+    def codes(self):
+        return {value: self.first_code + i for i, value in enumerate(self.values)}
+
+    def categorical(self, series):
+        """
+            :param series: series of strings or categorical
+            :return : categorical series with this vocabulary as categories, other values become NaN
+        """
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            # astype is a no-op for the same categories in another order, set_categories recodes
+            return series.cat.set_categories(self.values)
+        return series.astype(self.dtype)
+
+    def encode(self, series):
+        """
+            :param series: series of strings or categorical
+            :return : int8 series of codes, float series with NaN for values outside the vocabulary
+        """
+        codes = self.categorical(series).cat.codes.to_numpy()
+        encoded = pd.Series((codes + self.first_code).astype(np.int8), index=series.index, name=series.name)
+        if (codes < 0).any():
+            return encoded.where(codes >= 0)
+        return encoded
+
+    def decode(self, codes):
+        return pd.Series(pd.Categorical.from_codes(np.asarray(codes) - self.first_code, dtype=self.dtype))
+
+
+def replace_categories(series, replacements):
+    """
+        Replaces values of a column by rewriting its categories, not its rows
+        :param series: series of strings or categorical
+        :param replacements: dict of old value -> new value
+        :return : categorical series
+    """
+    series = series.astype("category")
+    categories = series.cat.categories.map(lambda value: replacements.get(value, value))
+    new_categories = categories.unique()
+    lookup = np.append(new_categories.get_indexer(categories), -1)
+    # code -1 (NaN) indexes the appended -1
+    codes = lookup[series.cat.codes.to_numpy()]
+    return pd.Series(pd.Categorical.from_codes(codes, categories=new_categories), index=series.index,
+                     name=series.name)
+
+
+YES_NO = Vocabulary(["no", "yes"], first_code=0)
+
+JOB_TYPE = Vocabulary(["student", "unemployed", "housemaid", "self-employed", "blue-collar", "services", "admin",
+                       "entrepreneur", "technician", "management", "retired"], first_code=1)
+MARITAL_STATUS = Vocabulary(["single", "married", "divorced"], first_code=1)
+EDUCATIONAL_LEVEL = Vocabulary(["primary", "secondary", "tertiary"], first_code=1)
+
+CONTACT_COMMUNICATION_TYPE = Vocabulary(["cellular", "telephone"])
+CONTACTED_MONTH = Vocabulary(["jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec"])
+OUTCOME_OF_PREVIOUS_CAMPAIGN = Vocabulary(["failure", "success"])
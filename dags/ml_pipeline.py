@@ -35,6 +35,11 @@ with DAG(
         bash_command=f'/usr/bin/python3 /home/ubuntu/projects/CustomerChurnPredictionPipeline/6_data_transformation_and_storage.py {file_arrival_date}'
     )
 
+    feature_materialization = BashOperator(
+        task_id='feature_materialization',
+        bash_command=f'/usr/bin/python3 /home/ubuntu/projects/CustomerChurnPredictionPipeline/8_feature_materialization.py {file_arrival_date}'
+    )
+
     query_feature_store = BashOperator(
         task_id='query_feature_store',
         bash_command=f'/usr/bin/python3 /home/ubuntu/projects/CustomerChurnPredictionPipeline/7_feature_store.py'
@@ -44,4 +49,4 @@ with DAG(
         task_id='model_building',
         bash_command=f'/usr/bin/python3 /home/ubuntu/projects/CustomerChurnPredictionPipeline/9_model_building.py {file_arrival_date}'
     )
-    upload_file_to_landing >> landing_to_raw >> data_validation >> data_preparation >> data_transformation_and_storage >> query_feature_store >> model_building
\ No newline at end of file
+    upload_file_to_landing >> landing_to_raw >> data_validation >> data_preparation >> data_transformation_and_storage >> feature_materialization >> query_feature_store >> model_building
\ No newline at end of file
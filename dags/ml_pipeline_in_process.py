@@ -0,0 +1,34 @@
+from airflow import DAG
+from airflow.operators.bash import BashOperator
+from datetime import datetime
+
+# stages of each inner list run as one in-process task of pipeline_runner.py, handing DataFrames in memory.
+# [["ingestion", "validation", "preparation", "transformation", "materialization", "model_building"]] runs the
+# pipeline as one task
+stage_groups = [
+    ["ingestion", "validation"],
+    ["preparation", "transformation", "materialization", "model_building"],
+]
+
+with DAG(
+    dag_id='CustomerChurnPredictionPipelineInProcess',
+    start_date=datetime(2023, 1, 1),
+    schedule_interval='@daily',
+    catchup=False
+) as dag:
+    file_arrival_date = datetime.now().strftime('%Y%m%d')
+
+    upload_file_to_landing = BashOperator(
+        task_id='upload_file_to_landing',
+        bash_command=f'/usr/bin/python3 /home/ubuntu/projects/CustomerChurnPredictionPipeline/3_raw_data_storage.py'
+    )
+
+    previous_task = upload_file_to_landing
+    for stages in stage_groups:
+        run_stages = BashOperator(
+            task_id='_and_'.join(stages),
+            bash_command=f'/usr/bin/python3 /home/ubuntu/projects/CustomerChurnPredictionPipeline/pipeline_runner.py '
+                         f'{file_arrival_date} --stages {" ".join(stages)}'
+        )
+        previous_task >> run_stages
+        previous_task = run_stages
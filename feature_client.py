@@ -0,0 +1,147 @@
+"""
+Online feature client
+    •	Resolves thousands of entity ids per call with batched reads of the online store
+        instead of one lookup per customer
+    •	Keeps a bounded in-process cache in front of the online store: least recently used entries
+        are evicted when it is full and entries expire after a TTL, so hot customers skip the store
+    •	Counts cache hits, misses, expirations and evictions
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+import pandas as pd
+
+feature_repo_path = "feature_repo"
+
+
+class TTLCache:
+    """
+        Thread safe LRU cache whose entries expire ttl_seconds after they were stored
+    """
+
+    def __init__(self, max_size=100_000, ttl_seconds=300):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.evictions = 0
+
+    def get_many(self, keys):
+        """
+            :param keys: keys to look up
+            :return : dict of key -> value of the keys found and not expired
+        """
+        now = time.monotonic()
+        found = {}
+        with self.lock:
+            for key in keys:
+                entry = self.entries.get(key)
+                if entry is not None and entry[0] > now:
+                    self.entries.move_to_end(key)
+                    found[key] = entry[1]
+                    self.hits += 1
+                else:
+                    if entry is not None:
+                        del self.entries[key]
+                        self.expirations += 1
+                    self.misses += 1
+        return found
+
+    def put_many(self, items):
+        """
+            :param items: dict of key -> value
+        """
+        expires_at = time.monotonic() + self.ttl_seconds
+        with self.lock:
+            for key, value in items.items():
+                self.entries[key] = (expires_at, value)
+                self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"size": len(self.entries), "hits": self.hits, "misses": self.misses,
+                    "hit_rate": self.hits / lookups if lookups else 0.0,
+                    "expirations": self.expirations, "evictions": self.evictions}
+
+
+class OnlineFeatureClient:
+    """
+        Online features of many entities per call, cached by entity id
+    """
+
+    def __init__(self, features, store=None, entity_key="customer_id", cache_size=100_000, ttl_seconds=300,
+                 batch_size=10_000, repo_path=feature_repo_path):
+        """
+            :param features: feature references "feature_view:feature"
+            :param store: feast FeatureStore, created from repo_path on first lookup when None
+            :param entity_key: join key of the entities
+            :param cache_size: maximum number of cached entities, 0 disables the cache
+            :param ttl_seconds: seconds a cached entity is served before it is read again
+            :param batch_size: maximum number of entities of one online store read
+        """
+        self.features = list(features)
+        self.feature_names = [reference.split(":")[1] for reference in self.features]
+        self.store = store
+        self.repo_path = repo_path
+        self.entity_key = entity_key
+        self.batch_size = batch_size
+        self.cache = TTLCache(cache_size, ttl_seconds) if cache_size else None
+
+    def get_store(self):
+        if self.store is None:
+            from feast import FeatureStore
+
+            self.store = FeatureStore(repo_path=self.repo_path)
+        return self.store
+
+    def read_online_store(self, entity_ids):
+        """
+            One batched online store read per batch_size entities
+            :return : dict of entity id -> tuple of feature values
+        """
+        rows = {}
+        for start in range(0, len(entity_ids), self.batch_size):
+            batch = entity_ids[start:start + self.batch_size]
+            response = self.get_store().get_online_features(
+                features=self.features,
+                entity_rows=[{self.entity_key: entity_id} for entity_id in batch]
+            ).to_dict()
+            values = zip(*(response[name] for name in self.feature_names))
+            rows.update(zip(response[self.entity_key], values))
+        return rows
+
+    def get_online_features(self, entity_ids):
+        """
+            :param entity_ids: list of entity ids, may repeat
+            :return : dataframe of entity_key and feature columns, one row per entity id in the given order
+        """
+        entity_ids = [int(entity_id) for entity_id in entity_ids]
+        unique_ids = list(dict.fromkeys(entity_ids))
+
+        rows = self.cache.get_many(unique_ids) if self.cache is not None else {}
+        missing_ids = [entity_id for entity_id in unique_ids if entity_id not in rows]
+        if missing_ids:
+            fetched = self.read_online_store(missing_ids)
+            if self.cache is not None:
+                self.cache.put_many(fetched)
+            rows.update(fetched)
+
+        features = pd.DataFrame([rows[entity_id] for entity_id in entity_ids], columns=self.feature_names)
+        features.insert(0, self.entity_key, entity_ids)
+        return features
+
+    def stats(self):
+        return self.cache.stats() if self.cache is not None else {}
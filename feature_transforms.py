@@ -0,0 +1,154 @@
+"""
+Feature transformations of the gold layer
+    •	Binning looks up precomputed bin edges and midpoints with a vectorized search
+        instead of building an Interval per row
+    •	Scaling parameters are fitted once, persisted next to the gold partition and reapplied
+        unchanged to later batches and at inference, so training and scoring share one transform path
+"""
+
+import glob
+import json
+import os
+
+import numpy as np
+
+transform_params_file_name = "_transform_params.json"
+
+age_bin_edges = [10, 25, 35, 45, 55, 65, 75]
+avg_yearly_balance_bin_edges = [-7000, -200, 0, 200, 400, 600, 800, 1200, 2500, 5000, 10281]
+
+# gold layer features the churn model is trained and scored on, in model column order
+model_features = ["age_binned", "job_type_encoded", "marital_status_encoded", "educational_level_encoded",
+                  "credit_commitment", "avg_yearly_balance_binned"]
+
+
+class BinTransformer:
+    """
+        Replaces a value by the midpoint of its bin, like pd.cut(values, bins=edges) followed by Interval.mid.
+        Bins are closed on the right, values outside the edges become NaN.
+    """
+
+    def __init__(self, edges):
+        self.edges = np.asarray(edges, dtype="float64")
+        self.midpoints = 0.5 * (self.edges[:-1] + self.edges[1:])
+
+    def transform(self, values):
+        values = np.asarray(values, dtype="float64")
+        bin_index = np.searchsorted(self.edges, values, side="left")
+        in_range = (bin_index >= 1) & (bin_index < len(self.edges))
+        return np.where(in_range, self.midpoints[np.clip(bin_index - 1, 0, len(self.midpoints) - 1)], np.nan)
+
+    def to_dict(self):
+        return {"edges": self.edges.tolist()}
+
+
+class MinMaxScaler:
+    """
+        Scales values to [0, 1] with the min and max seen by fit()
+    """
+
+    def __init__(self, min_value=None, max_value=None):
+        self.min_value = min_value
+        self.max_value = max_value
+
+    def fit(self, values):
+        self.min_value = float(np.nanmin(values))
+        self.max_value = float(np.nanmax(values))
+        return self
+
+    def partial_fit(self, values):
+        """
+            Updates min and max with one more chunk, for data fitted chunk by chunk
+        """
+        if len(values) == 0:
+            return self
+        chunk_min, chunk_max = float(np.nanmin(values)), float(np.nanmax(values))
+        self.min_value = chunk_min if self.min_value is None else min(self.min_value, chunk_min)
+        self.max_value = chunk_max if self.max_value is None else max(self.max_value, chunk_max)
+        return self
+
+    def transform(self, values):
+        return (np.asarray(values, dtype="float64") - self.min_value) / (self.max_value - self.min_value)
+
+    def to_dict(self):
+        return {"min": self.min_value, "max": self.max_value}
+
+
+class FeatureTransformer:
+    """
+        Transformations of stage 6 with their fitted parameters
+    """
+
+    def __init__(self, age_edges=age_bin_edges, balance_edges=avg_yearly_balance_bin_edges, duration_min=None,
+                 duration_max=None):
+        self.age_bins = BinTransformer(age_edges)
+        self.balance_bins = BinTransformer(balance_edges)
+        self.duration_scaler = MinMaxScaler(duration_min, duration_max)
+
+    @property
+    def is_fitted(self):
+        return self.duration_scaler.min_value is not None
+
+    def fit(self, loan_info):
+        self.duration_scaler.fit(loan_info['contacted_duration_sec'].to_numpy(dtype="float64", na_value=np.nan))
+        return self
+
+    def partial_fit(self, loan_info):
+        self.duration_scaler.partial_fit(loan_info['contacted_duration_sec'].to_numpy(dtype="float64",
+                                                                                      na_value=np.nan))
+        return self
+
+    def transform_customer_info(self, customer_info):
+        # Splitting Age into different groups using Equal width partitioning
+        customer_info['age_binned'] = self.age_bins.transform(customer_info['age'])
+        return customer_info
+
+    def transform_loan_info(self, loan_info):
+        # Combining below features into credit_commitment, since these are related information.
+        loan_info['credit_commitment'] = loan_info['has_credit'] \
+                                         + loan_info['has_housing_loan'] \
+                                         + loan_info['has_personal_loan']
+        loan_info = loan_info.drop(columns=['has_credit', 'has_housing_loan', 'has_personal_loan'])
+
+        # splitting avg_yearly_balance into different groups
+        loan_info['avg_yearly_balance_binned'] = self.balance_bins.transform(loan_info['avg_yearly_balance'])
+
+        # applying feature scaling on numerical column
+        loan_info['contacted_duration_sec'] = self.duration_scaler.transform(loan_info['contacted_duration_sec'])
+        return loan_info
+
+    def to_dict(self):
+        return {
+            "age_binned": self.age_bins.to_dict(),
+            "avg_yearly_balance_binned": self.balance_bins.to_dict(),
+            "contacted_duration_sec": self.duration_scaler.to_dict(),
+        }
+
+    @classmethod
+    def from_dict(cls, params):
+        return cls(age_edges=params["age_binned"]["edges"],
+                   balance_edges=params["avg_yearly_balance_binned"]["edges"],
+                   duration_min=params["contacted_duration_sec"]["min"],
+                   duration_max=params["contacted_duration_sec"]["max"])
+
+    def save(self, folder):
+        with open(f"{folder}/{transform_params_file_name}", "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    @classmethod
+    def load(cls, folder):
+        with open(f"{folder}/{transform_params_file_name}") as f:
+            return cls.from_dict(json.load(f))
+
+
+def latest_params_folder(partitions_path, file_arrival):
+    """
+        :param partitions_path: folder of file_arrival=YYYYMMDD partitions, e.g. the gold customer_loan_info
+        :param file_arrival: partition being transformed
+        :return : latest partition folder before file_arrival with saved parameters, None when there is none
+    """
+    folders = sorted(os.path.dirname(params_file)
+                     for params_file in glob.glob(f"{partitions_path}/file_arrival=*/{transform_params_file_name}"))
+    # file_arrival is kept as YYYYMMDD string, so string comparison orders partitions by date
+    earlier = [folder for folder in folders if os.path.basename(folder).split("=", 1)[1] < file_arrival]
+    return earlier[-1] if earlier else None
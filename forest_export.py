@@ -0,0 +1,154 @@
+"""
+Array-backed Random Forest
+    •	Flattens the trees of a fitted RandomForestClassifier into contiguous node arrays
+        (feature, threshold, children, missing value direction, leaf probabilities) saved as .npy files
+    •	Arrays are loaded memory mapped, so loading is cheap and worker processes share the pages of one model
+    •	Rows are routed through all trees at once with numpy, level by level, in blocks of rows. Rows that reached
+        the leaf of a tree are dropped from the arrays, so a level costs about the rows still on their way down.
+        Inputs are compared as float32 and tree probabilities are summed in tree order,
+        so probabilities equal predict_proba of sklearn.
+"""
+
+import json
+import os
+
+import joblib
+import numpy as np
+
+forest_meta_file_name = "forest.json"
+# number of (row, tree) pairs routed together by ForestPredictor.apply
+pair_block_size = 1 << 19
+node_arrays = ["feature", "threshold", "children_left", "children_right", "missing_go_to_left", "leaf_value"]
+
+
+def export_forest(model, folder):
+    """
+        Writes the trees of a fitted RandomForestClassifier as node arrays
+        :param model: fitted RandomForestClassifier
+        :param folder: folder of the exported forest
+    """
+    features, thresholds, lefts, rights, missing_left, leaf_values, roots = [], [], [], [], [], [], []
+    node_offset = 0
+    max_depth = 0
+    for estimator in model.estimators_:
+        tree = estimator.tree_
+        is_leaf = tree.children_left < 0
+        roots.append(node_offset)
+        features.append(np.where(is_leaf, 0, tree.feature).astype(np.int32))
+        thresholds.append(tree.threshold.astype(np.float64))
+        lefts.append(np.where(is_leaf, -1, tree.children_left + node_offset).astype(np.int32))
+        rights.append(np.where(is_leaf, -1, tree.children_right + node_offset).astype(np.int32))
+        missing_left.append(getattr(tree, "missing_go_to_left", np.zeros(tree.node_count, dtype=np.uint8))
+                            .astype(bool))
+        # normalized like DecisionTreeClassifier.predict_proba, once per node instead of once per row
+        value = tree.value[:, 0, :].astype(np.float64)
+        normalizer = value.sum(axis=1)[:, np.newaxis]
+        normalizer[normalizer == 0.0] = 1.0
+        leaf_values.append(value / normalizer)
+        node_offset += tree.node_count
+        max_depth = max(max_depth, tree.max_depth)
+
+    os.makedirs(folder, exist_ok=True)
+    arrays = {
+        "feature": np.concatenate(features),
+        "threshold": np.concatenate(thresholds),
+        "children_left": np.concatenate(lefts),
+        "children_right": np.concatenate(rights),
+        "missing_go_to_left": np.concatenate(missing_left),
+        "leaf_value": np.concatenate(leaf_values),
+        "roots": np.array(roots, dtype=np.int32),
+    }
+    for name, array in arrays.items():
+        np.save(f"{folder}/{name}.npy", np.ascontiguousarray(array))
+
+    feature_names = getattr(model, "feature_names_in_", None)
+    with open(f"{folder}/{forest_meta_file_name}", "w") as f:
+        json.dump({
+            "n_trees": len(model.estimators_),
+            "n_features": int(model.n_features_in_),
+            "max_depth": int(max_depth),
+            "classes": np.asarray(model.classes_).tolist(),
+            "feature_names": None if feature_names is None else list(feature_names),
+        }, f, indent=2)
+
+
+class ForestPredictor:
+    """
+        predict_proba and predict of an exported forest
+    """
+
+    def __init__(self, folder, mmap_mode="r"):
+        with open(f"{folder}/{forest_meta_file_name}") as f:
+            meta = json.load(f)
+        self.n_trees = meta["n_trees"]
+        self.max_depth = meta["max_depth"]
+        self.classes_ = np.array(meta["classes"])
+        self.feature_names = meta["feature_names"]
+        for name in node_arrays + ["roots"]:
+            # plain arrays over the mapped pages, indexing a np.memmap wraps every result in a np.memmap
+            setattr(self, name, np.asarray(np.load(f"{folder}/{name}.npy", mmap_mode=mmap_mode)))
+
+    def to_matrix(self, X):
+        if self.feature_names is not None and hasattr(X, "columns"):
+            X = X[self.feature_names]
+        # sklearn trees compare float32 inputs with float64 thresholds
+        return np.ascontiguousarray(np.asarray(X, dtype=np.float32))
+
+    def apply(self, X):
+        """
+            :return : int array of leaf node per row and tree, shape (rows, trees)
+        """
+        X = self.to_matrix(X)
+        # blocks of rows keep the (row, tree) arrays of a level in cache
+        block_rows = max(1, pair_block_size // self.n_trees)
+        return np.concatenate([self.apply_block(X[start:start + block_rows])
+                               for start in range(0, len(X), block_rows)] or [self.apply_block(X)])
+
+    def apply_block(self, X):
+        n_rows = len(X)
+        leaves = np.empty(n_rows * self.n_trees, dtype=np.int32)
+        # one entry per (row, tree) pair still on its way down
+        pair = np.arange(n_rows * self.n_trees)
+        row = pair // self.n_trees
+        node = np.tile(self.roots, n_rows)
+        while True:
+            left = self.children_left[node]
+            at_leaf = left < 0
+            leaf_pairs = np.count_nonzero(at_leaf)
+            if leaf_pairs == pair.size:
+                leaves[pair] = node
+                break
+            # pairs at a leaf are dropped once they are a quarter of the pairs, until then they stay where they are
+            if leaf_pairs > pair.size // 4:
+                leaves[pair[at_leaf]] = node[at_leaf]
+                on_the_way = np.flatnonzero(~at_leaf)
+                pair, row, node, left = pair[on_the_way], row[on_the_way], node[on_the_way], left[on_the_way]
+                at_leaf = None
+            x = X[row, self.feature[node]]
+            go_left = np.where(np.isnan(x), self.missing_go_to_left[node], x <= self.threshold[node])
+            next_node = np.where(go_left, left, self.children_right[node])
+            node = next_node if at_leaf is None else np.where(at_leaf, node, next_node)
+        return leaves.reshape(n_rows, self.n_trees)
+
+    def predict_proba(self, X):
+        leaves = self.apply(X)
+        proba = np.zeros((len(leaves), len(self.classes_)), dtype=np.float64)
+        # summed tree by tree in order, as RandomForestClassifier.predict_proba does
+        for tree_index in range(self.n_trees):
+            proba += self.leaf_value[leaves[:, tree_index]]
+        proba /= self.n_trees
+        return proba
+
+    def predict(self, X):
+        return self.classes_[np.argmax(self.predict_proba(X), axis=1)]
+
+
+def load_model(model_path):
+    """
+        :param model_path: folder of an exported forest or joblib model file
+        :return : ForestPredictor or the unpickled model, both with predict_proba and classes_
+    """
+    if os.path.isdir(model_path):
+        return ForestPredictor(model_path)
+    # plain numpy arrays of uncompressed joblib files are memory mapped, sklearn trees are rebuilt and copied
+    return joblib.load(model_path, mmap_mode="r")
@@ -0,0 +1,121 @@
+"""
+Gold layer dataset
+    •	One dataset over all file_arrival=YYYYMMDD partitions of the gold layer
+    •	Partitions outside a date window are pruned before any file is opened
+    •	Only the requested columns are read and row filters are pushed into the parquet reader,
+        which skips row groups whose min/max statistics cannot match
+"""
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+customer_loan_info_path = "LocalDataLake/gold/customer_loan_info"
+
+# file_arrival is kept as YYYYMMDD string, so string comparison orders partitions by date
+partitioning = ds.partitioning(pa.schema([("file_arrival", pa.string())]), flavor="hive")
+
+
+class GoldDataset:
+    """
+        Parquet dataset of the gold layer, partitioned by file_arrival
+    """
+
+    def __init__(self, root_folder=customer_loan_info_path):
+        self.root_folder = root_folder
+        # files starting with "_" or "." such as _transform_params.json are ignored
+        self.dataset = ds.dataset(root_folder, format="parquet", partitioning=partitioning)
+
+    @property
+    def columns(self):
+        return self.dataset.schema.names
+
+    def partitions(self):
+        """
+            :return : sorted list of file_arrival partitions
+        """
+        file_arrivals = {ds.get_partition_keys(fragment.partition_expression)["file_arrival"]
+                         for fragment in self.dataset.get_fragments()}
+        return sorted(file_arrivals)
+
+    def latest_partition(self):
+        partitions = self.partitions()
+        return partitions[-1] if partitions else None
+
+    @staticmethod
+    def filter_expression(start=None, end=None, filters=None):
+        """
+            :param start: first file_arrival to read, YYYYMMDD, None for no lower bound
+            :param end: last file_arrival to read, YYYYMMDD, None for no upper bound
+            :param filters: row filters as list of (column, op, value), e.g. [("outcome", "==", 1)]
+            :return : pyarrow expression or None
+        """
+        expression = None
+        conditions = []
+        if start is not None:
+            conditions.append(ds.field("file_arrival") >= str(start))
+        if end is not None:
+            conditions.append(ds.field("file_arrival") <= str(end))
+        if filters:
+            conditions.append(pq.filters_to_expression(filters))
+        for condition in conditions:
+            expression = condition if expression is None else expression & condition
+        return expression
+
+    def to_table(self, columns=None, start=None, end=None, filters=None):
+        return self.dataset.to_table(columns=columns, filter=self.filter_expression(start, end, filters))
+
+    def read(self, columns=None, start=None, end=None, filters=None):
+        """
+            Reads the selected partitions, columns and rows into pandas
+            :param columns: columns to read, None for all columns
+            :param start: first file_arrival to read, YYYYMMDD
+            :param end: last file_arrival to read, YYYYMMDD
+            :param filters: row filters as list of (column, op, value)
+            :return : dataframe
+        """
+        return self.to_table(columns, start, end, filters).to_pandas()
+
+    def iter_batches(self, columns=None, start=None, end=None, filters=None, batch_size=100_000):
+        """
+            Yields the selected rows as dataframes of at most batch_size rows
+        """
+        scanner = self.dataset.scanner(columns=columns, filter=self.filter_expression(start, end, filters),
+                                       batch_size=batch_size)
+        for batch in scanner.to_batches():
+            if batch.num_rows:
+                yield batch.to_pandas()
+
+    def count_rows(self, start=None, end=None, filters=None):
+        return self.dataset.count_rows(filter=self.filter_expression(start, end, filters))
+
+    def row_group_statistics(self, start=None, end=None, columns=None):
+        """
+            Min, max and null count of every row group, as written by the parquet writer
+            :return : dataframe with one row per file, row group and column
+        """
+        records = []
+        for fragment in self.dataset.get_fragments(filter=self.filter_expression(start, end)):
+            file_arrival = ds.get_partition_keys(fragment.partition_expression)["file_arrival"]
+            metadata = fragment.metadata
+            for row_group_index in range(metadata.num_row_groups):
+                row_group = metadata.row_group(row_group_index)
+                for column_index in range(row_group.num_columns):
+                    column = row_group.column(column_index)
+                    if columns is not None and column.path_in_schema not in columns:
+                        continue
+                    statistics = column.statistics
+                    has_min_max = statistics is not None and statistics.has_min_max
+                    records.append({
+                        "file_arrival": file_arrival,
+                        "file": fragment.path,
+                        "row_group": row_group_index,
+                        "column": column.path_in_schema,
+                        "num_rows": row_group.num_rows,
+                        "min": statistics.min if has_min_max else None,
+                        "max": statistics.max if has_min_max else None,
+                        "null_count": statistics.null_count if statistics is not None else None,
+                        "total_compressed_size": column.total_compressed_size,
+                    })
+        return pd.DataFrame(records)
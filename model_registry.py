@@ -0,0 +1,152 @@
+"""
+Local model registry
+    •	Every registered model gets a version folder with its artifact and metadata.json:
+        training file_arrival, features, parameters, metrics and a hash of the training data
+    •	Aliases such as "promoted" point at a version, so picking the model to serve is a lookup
+    •	Models are dumped uncompressed and loaded with mmap_mode="r". Only plain numpy attributes such as
+        coefficients are memory mapped, the trees of a forest are rebuilt on unpickling, so every process
+        loading a joblib forest holds its own copy. Random Forests are also exported as memory mapped
+        node arrays, see forest_export.py
+"""
+
+import hashlib
+import json
+import os
+from datetime import datetime
+
+import joblib
+import pandas as pd
+
+import forest_export
+
+registry_path = "models/registry"
+model_file_name = "model.joblib"
+forest_folder_name = "forest"
+metadata_file_name = "metadata.json"
+index_file_name = "registry.json"
+promoted_alias = "promoted"
+
+
+def data_sha256(X, y=None):
+    """
+        Content hash of a training set, independent of its row index
+    """
+    sha256 = hashlib.sha256()
+    sha256.update(",".join(map(str, X.columns)).encode())
+    sha256.update(pd.util.hash_pandas_object(X, index=False).to_numpy().tobytes())
+    if y is not None:
+        sha256.update(pd.util.hash_pandas_object(pd.Series(y), index=False).to_numpy().tobytes())
+    return sha256.hexdigest()
+
+
+def write_json(path, content):
+    # written next to the target and renamed, readers never see a partly written file
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(content, f, indent=2, default=str)
+    os.replace(f"{path}.tmp", path)
+
+
+class ModelRegistry:
+    """
+        Versions and aliases of one model name, kept in registry_path/<name>
+    """
+
+    def __init__(self, name="customer_churn", root_folder=registry_path):
+        self.name = name
+        self.folder = os.path.join(root_folder, name)
+        self.index_file = os.path.join(self.folder, index_file_name)
+
+    def load_index(self):
+        if not os.path.exists(self.index_file):
+            return {"versions": [], "aliases": {}}
+        with open(self.index_file) as f:
+            return json.load(f)
+
+    def version_folder(self, version):
+        return os.path.join(self.folder, f"v{version}")
+
+    def register(self, model, file_arrival, features, metrics=None, data_hash=None, params=None, promote=False):
+        """
+            Stores a fitted model as the next version
+            :param model: fitted model
+            :param file_arrival: file arrival the model was trained for
+            :param features: feature columns of the model, in model column order
+            :param metrics: dict of test metrics
+            :param data_hash: hash of the training data, see data_sha256
+            :param params: hyperparameters, model.get_params() when None
+            :param promote: point the promoted alias at the new version
+            :return : version number
+        """
+        index = self.load_index()
+        version = max(index["versions"], default=0) + 1
+        folder = self.version_folder(version)
+        os.makedirs(folder, exist_ok=True)
+
+        # uncompressed, so plain numpy attributes of the model can be memory mapped on load
+        joblib.dump(model, os.path.join(folder, model_file_name), compress=0)
+        if hasattr(model, "estimators_") and hasattr(model.estimators_[0], "tree_"):
+            forest_export.export_forest(model, os.path.join(folder, forest_folder_name))
+
+        write_json(os.path.join(folder, metadata_file_name), {
+            "name": self.name,
+            "version": version,
+            "model_class": type(model).__name__,
+            "file_arrival": file_arrival,
+            "features": list(features),
+            "params": params if params is not None else model.get_params(),
+            "metrics": metrics or {},
+            "data_hash": data_hash,
+            "registered_at": datetime.now().isoformat(timespec="seconds"),
+        })
+
+        index["versions"].append(version)
+        write_json(self.index_file, index)
+        if promote:
+            self.set_alias(promoted_alias, version)
+        return version
+
+    def set_alias(self, alias, version):
+        index = self.load_index()
+        if version not in index["versions"]:
+            raise ValueError(f"{self.name} has no version {version}")
+        index["aliases"][alias] = version
+        write_json(self.index_file, index)
+
+    def promote(self, version):
+        self.set_alias(promoted_alias, version)
+
+    def resolve(self, version=None, alias=promoted_alias):
+        """
+            :return : version number of version, or of alias when version is None
+        """
+        if version is not None:
+            return int(version)
+        index = self.load_index()
+        if alias not in index["aliases"]:
+            raise LookupError(f"{self.name} has no version with alias {alias}")
+        return index["aliases"][alias]
+
+    def metadata(self, version=None, alias=promoted_alias):
+        with open(os.path.join(self.version_folder(self.resolve(version, alias)), metadata_file_name)) as f:
+            return json.load(f)
+
+    def list_versions(self):
+        return [self.metadata(version) for version in self.load_index()["versions"]]
+
+    def artifact_path(self, version=None, alias=promoted_alias, prefer_forest=False):
+        """
+            :param prefer_forest: the exported forest answers single rows faster, the joblib model scores
+                                  many rows faster, so only the prediction service prefers the forest
+            :return : exported forest folder when there is one and prefer_forest, else the joblib model file
+        """
+        folder = self.version_folder(self.resolve(version, alias))
+        forest_folder = os.path.join(folder, forest_folder_name)
+        if prefer_forest and os.path.isdir(forest_folder):
+            return forest_folder
+        return os.path.join(folder, model_file_name)
+
+    def load(self, version=None, alias=promoted_alias, prefer_forest=False):
+        """
+            :return : model of a version or alias, see forest_export.load_model
+        """
+        return forest_export.load_model(self.artifact_path(version, alias, prefer_forest))
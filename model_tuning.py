@@ -0,0 +1,189 @@
+"""
+Hyperparameter search of the model candidates
+    •	Random hyperparameters of every model family are raced with successive halving:
+        all candidates are scored on one cross validation fold, the best third goes on to more folds,
+        until the survivors are scored on all folds
+    •	Fold splits and fold matrices are built once per run and shared read only by all worker processes,
+        scores of a fold are computed once and reused by later rungs
+    •	(candidate, fold) fits of a rung run on all cores a batch at a time. A batch only starts when it can end
+        within the time budget and is stopped at its end, the first batch of a family decides how many
+        candidates it races
+"""
+
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+import joblib
+import numpy as np
+from joblib import Parallel, delayed, effective_n_jobs
+from scipy.stats import loguniform, randint
+from sklearn.base import clone
+from sklearn.metrics import get_scorer
+from sklearn.model_selection import ParameterSampler, StratifiedKFold
+
+# parameter distributions per candidate name of 9_model_building.candidate_models
+search_spaces = {
+    "LR": {"C": loguniform(1e-3, 1e2)},
+    "DT": {"max_depth": [None, 3, 4, 5, 6, 8, 10, 12, 16, 20], "min_samples_leaf": randint(1, 50),
+           "criterion": ["gini", "entropy"]},
+    "RF": {"n_estimators": randint(50, 300), "max_depth": [None, 4, 6, 8, 10, 12, 16, 20],
+           "min_samples_leaf": randint(1, 20), "max_features": ["sqrt", "log2", None]},
+    "KNN": {"n_neighbors": randint(1, 50), "weights": ["uniform", "distance"]},
+}
+
+
+class FoldCache:
+    """
+        Stratified fold splits of one training set and their train / validation matrices,
+        written once to a memory mapped file
+    """
+
+    def __init__(self, X, y, n_splits=5, random_state=1234):
+        X = np.asarray(X, dtype="float64")
+        y = np.asarray(y)
+        self.folder = tempfile.mkdtemp(prefix="model_tuning_")
+        splits = list(StratifiedKFold(n_splits=n_splits, shuffle=True, random_state=random_state).split(X, y))
+        fold_file = os.path.join(self.folder, "folds.joblib")
+        joblib.dump([(X[train], y[train], X[validation], y[validation]) for train, validation in splits], fold_file)
+        self.folds = joblib.load(fold_file, mmap_mode="r")
+
+    def __len__(self):
+        return len(self.folds)
+
+    def close(self):
+        self.folds = None
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+
+def score_on_fold(estimator, fold, scoring):
+    X_train, y_train, X_validation, y_validation = fold
+    estimator.fit(X_train, y_train)
+    return get_scorer(scoring)(estimator, X_validation, y_validation)
+
+
+def score_batches(estimator, candidates, tasks, folds, scoring, n_jobs=-1, deadline=None, batch_sec=0.0):
+    """
+        Scores (candidate, fold) tasks one batch of a fit per core at a time
+        :param deadline: time.monotonic() by which the last fit must end. A batch is not started when the longest
+                         batch so far would not end by then, and a batch still running at the deadline is stopped,
+                         unless it runs in this process with n_jobs=1
+        :param batch_sec: longest batch so far, in seconds
+        :return : (dict of (candidate, fold) -> score of the tasks scored, longest batch in seconds,
+                   False when the deadline stopped the tasks)
+    """
+    batch_size = effective_n_jobs(n_jobs)
+    scores = {}
+    for batch_start in range(0, len(tasks), batch_size):
+        if deadline is not None and time.monotonic() + batch_sec > deadline:
+            return scores, batch_sec, False
+        batch = tasks[batch_start:batch_start + batch_size]
+        started = time.monotonic()
+        # the worker pool is reused by every batch, a timeout terminates its workers and the fits they run
+        parallel = Parallel(n_jobs=n_jobs, timeout=None if deadline is None else max(deadline - started, 0.0))
+        try:
+            batch_scores = parallel(delayed(score_on_fold)(clone(estimator).set_params(**candidates[candidate]),
+                                                           folds.folds[fold], scoring)
+                                    for candidate, fold in batch)
+        except multiprocessing.TimeoutError:
+            return scores, max(batch_sec, time.monotonic() - started), False
+        scores.update(zip(batch, batch_scores))
+        batch_sec = max(batch_sec, time.monotonic() - started)
+    return scores, batch_sec, True
+
+
+def successive_halving(estimator, param_distributions, folds, scoring="accuracy", n_candidates=27, factor=3,
+                       deadline=None, n_jobs=-1, random_state=1234):
+    """
+        Races random parameter candidates of one model family over cross validation folds
+        :param estimator: unfitted model of the family
+        :param param_distributions: dict of parameter -> list or scipy distribution
+        :param folds: FoldCache
+        :param scoring: sklearn scorer name
+        :param n_candidates: maximum number of random candidates of the first rung, with a deadline the first
+                             fits decide how many candidates can be raced over all folds before it
+        :param factor: 1 / factor of the candidates go on to the next rung, with factor times more folds
+        :param deadline: time.monotonic() by which the last fit must end, None for no deadline
+        :return : (best parameters, mean score of the best parameters, number of fits),
+                  (None, None, 0) when not a single fit ends before the deadline
+    """
+    candidates = list(ParameterSampler(param_distributions, n_iter=n_candidates, random_state=random_state))
+    fold_scores = {}
+    mean_scores = {}
+    survivors = list(range(len(candidates)))
+    n_folds = 1
+    batch_sec = 0.0
+
+    if deadline is not None:
+        # every rung fits about as many (candidate, fold) pairs as the first one, the first batch tells
+        # how many candidates can go through all rungs in the time left
+        first_tasks = [(candidate, 0) for candidate in survivors[:effective_n_jobs(n_jobs)]]
+        scores, batch_sec, _ = score_batches(estimator, candidates, first_tasks, folds, scoring, n_jobs, deadline)
+        fold_scores.update(scores)
+        if batch_sec:
+            n_rungs = 1 + int(np.ceil(np.log(len(folds)) / np.log(factor)))
+            fits_left = (deadline - time.monotonic()) / batch_sec * len(first_tasks)
+            survivors = survivors[:max(len(first_tasks), int(fits_left / n_rungs))]
+
+    while True:
+        # only folds not scored by an earlier rung or batch are fitted
+        tasks = [(candidate, fold) for candidate in survivors for fold in range(n_folds)
+                 if (candidate, fold) not in fold_scores]
+        scores, batch_sec, in_time = score_batches(estimator, candidates, tasks, folds, scoring, n_jobs, deadline,
+                                                   batch_sec)
+        fold_scores.update(scores)
+
+        # a rung stopped by the deadline ranks the candidates scored on all of its folds,
+        # without any the ranking of the previous rung stands
+        scored = [candidate for candidate in survivors
+                  if all((candidate, fold) in fold_scores for fold in range(n_folds))]
+        if scored:
+            mean_scores = {candidate: np.mean([fold_scores[(candidate, fold)] for fold in range(n_folds)])
+                           for candidate in scored}
+            survivors = sorted(scored, key=lambda candidate: -mean_scores[candidate])
+        if not in_time or len(survivors) == 1 or n_folds == len(folds):
+            break
+        survivors = survivors[:max(1, len(survivors) // factor)]
+        n_folds = min(len(folds), n_folds * factor)
+
+    if not mean_scores:
+        return None, None, 0
+    best = survivors[0]
+    return candidates[best], mean_scores[best], len(fold_scores)
+
+
+def tune_candidates(candidates, X, y, scoring="accuracy", budget_sec=600, n_candidates=27, n_splits=5,
+                    n_jobs=-1):
+    """
+        Searches the hyperparameters of every model family within a shared wall clock budget
+        :param candidates: dict of name -> (title, unfitted model), see 9_model_building.candidate_models
+        :param X: training features
+        :param y: training labels
+        :param scoring: sklearn scorer name the candidates are ranked by
+        :param budget_sec: wall clock budget of the whole search, split evenly among the families left,
+                           fits still running at the end of the budget are stopped
+        :return : dict of name -> (title, unfitted model with the best parameters found)
+                  and list of search results per family
+    """
+    start = time.monotonic()
+    folds = FoldCache(X, y, n_splits)
+    tuned = {}
+    search_results = []
+    try:
+        for i, (name, (title, estimator)) in enumerate(candidates.items()):
+            if name not in search_spaces:
+                tuned[name] = (title, estimator)
+                continue
+            remaining = budget_sec - (time.monotonic() - start)
+            deadline = time.monotonic() + remaining / (len(candidates) - i)
+            params, score, n_fits = successive_halving(estimator, search_spaces[name], folds, scoring,
+                                                       n_candidates, deadline=deadline, n_jobs=n_jobs)
+            # a family without a single fit in its share of the budget keeps its default parameters
+            tuned[name] = (title, estimator if params is None else clone(estimator).set_params(**params))
+            search_results.append({"model": name, "params": params, f"cv_{scoring}": score, "fits": n_fits,
+                                   "elapsed_sec": time.monotonic() - start})
+    finally:
+        folds.close()
+    return tuned, search_results
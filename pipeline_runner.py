@@ -0,0 +1,143 @@
+"""
+Pipeline Runner
+    •	Runs the pipeline stages for a file arrival in one process:
+        o	2. Data Ingestion, 4. Data Validation, 5. Data Preparation,
+            6. Data Transformation and Storage, 8. Feature Materialization, 9. Model Building
+        o	Libraries are imported once and DataFrames are handed from stage to stage in memory
+        o	Writing the silver and gold layers between stages is optional
+        o	Stages whose inputs, parameters and code are unchanged since a cached run are skipped,
+            see stage_cache.py
+        o	Every stage is a run of its own in the metrics file of the file arrival, with the span of the
+            runner as parent, see util.job_span
+    •	A subset of stages can be run, so the Airflow DAG can run the pipeline as one task or several
+"""
+
+import argparse
+import importlib
+
+import util
+import stage_cache
+
+job_name = "pipeline_runner"
+logging = util.get_logger(job_name)
+
+stage_modules = {
+    "ingestion": "2_data_ingestion",
+    "validation": "4_data_validation",
+    "preparation": "5_data_preparation",
+    "transformation": "6_data_transformation_and_storage",
+    "materialization": "8_feature_materialization",
+    "model_building": "9_model_building",
+}
+all_stages = list(stage_modules)
+
+
+def load_stage(stage):
+    # stage modules are imported on first use, so a subset of stages only imports the libraries it needs
+    return importlib.import_module(stage_modules[stage])
+
+
+def run_pipeline(file_arrival, stages=None, checkpoint=False, use_cache=True):
+    """
+        Runs pipeline stages in one process, handing DataFrames from stage to stage in memory
+        :param file_arrival: file arrival partition to process
+        :param stages: list of stages to run in pipeline order, None runs all stages
+        :param checkpoint: write silver and gold layers also when the next stage runs in this process.
+                           Output of the last stage is always written, so a following task can continue from it.
+        :param use_cache: skip stages whose output of the same inputs, parameters and code is already written.
+                          Only stages which write their output and read their input from disk are cached.
+        :return : dict of stage name -> output of the stage
+    """
+    stages = [stage for stage in all_stages if stage in (stages or all_stages)]
+    last_stage = stages[-1]
+    outputs = {}
+    loan_df, customer_df = None, None
+    customer_info_clean, loan_info_clean = None, None
+    customer_loan_info = None
+    cache = stage_cache.StageCache() if use_cache else None
+    # input of the next stage is on disk, not only in memory of this process
+    input_on_disk = True
+
+    for position, stage in enumerate(stages):
+        logging.info(f"=== {stage} started ===")
+        with util.job_span(stage_modules[stage], file_arrival):
+            module = load_stage(stage)
+            # raw layer, validation reports, the online store and the registered model are always written,
+            # materialization reads the gold layer from disk
+            next_stage = stages[position + 1] if position + 1 < len(stages) else None
+            write_output = checkpoint or stage == last_stage or next_stage == "materialization" \
+                or stage in ("ingestion", "validation", "materialization", "model_building")
+            stage_cache_of_run = cache if input_on_disk and write_output else None
+            input_on_disk = write_output
+
+            # 2. raw layer is always written, the landing file manifest depends on it
+            if stage == "ingestion":
+                skipped, result = stage_cache.run_cached(stage, file_arrival, {}, lambda: module.data_ingestion(
+                    file_arrival), stage_cache_of_run)
+                loan_df, customer_df = (None, None) if skipped or result is None else result
+                outputs[stage] = (loan_df, customer_df)
+
+            # 4. validation only reads, its reports are always written
+            elif stage == "validation":
+                skipped, _ = stage_cache.run_cached(stage, file_arrival, {}, lambda: module.data_validation(
+                    file_arrival, loan_df, customer_df), stage_cache_of_run)
+
+            # 5. silver layer
+            elif stage == "preparation":
+                skipped, result = stage_cache.run_cached(stage, file_arrival, {}, lambda: module.data_preparation(
+                    file_arrival, customer_df, loan_df, write_output), stage_cache_of_run)
+                customer_info_clean, loan_info_clean = (None, None) if skipped else result
+                outputs[stage] = (customer_info_clean, loan_info_clean)
+
+            # 6. gold layer
+            elif stage == "transformation":
+                skipped, result = stage_cache.run_cached(stage, file_arrival, {}, lambda: (
+                    module.data_transformation_and_storage(file_arrival, customer_info_clean, loan_info_clean,
+                                                           write_output)), stage_cache_of_run)
+                customer_loan_info = None if skipped else result
+                outputs[stage] = customer_loan_info
+
+            # 8. online store, only gold partitions after its watermark are written
+            elif stage == "materialization":
+                outputs[stage] = module.feature_materialization(file_arrival)
+                skipped = False
+
+            # 9. model, the registered version is its output
+            elif stage == "model_building":
+                def run():
+                    best = module.model_building(file_arrival, customer_loan_info)
+                    return {"name": best["name"], "version": best["version"]}
+
+                skipped, outputs[stage] = stage_cache.run_cached(
+                    stage, file_arrival, {}, run, stage_cache_of_run,
+                    outputs_of_result=lambda result: [module.ModelRegistry().version_folder(result["version"])])
+
+        # skipped stages hand nothing in memory, the next stage reads their output from disk
+        logging.info(f"=== {stage} {'skipped, output is cached' if skipped else 'ended'} ===")
+    return outputs
+
+
+def main():
+    logging.info(f"=== {job_name} started ===")
+
+    parser = argparse.ArgumentParser(description="run customer churn pipeline stages in one process")
+    parser.add_argument("file_arrival_time", help="time of file arrival in YYYYMMDD")
+    parser.add_argument("--stages", nargs="+", choices=all_stages, default=all_stages,
+                        help="stages to run, in pipeline order")
+    parser.add_argument("--checkpoint", action="store_true",
+                        help="write silver and gold layers after every stage, not only after the last one")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="run every stage even when its inputs, parameters and code are unchanged")
+    args = parser.parse_args()
+
+    file_arrival = args.file_arrival_time
+    logging.info(f"file_arrival : {file_arrival}, stages : {args.stages}, checkpoint : {args.checkpoint}")
+
+    with util.job_span(job_name, file_arrival):
+        run_pipeline(file_arrival, args.stages, args.checkpoint, not args.no_cache)
+
+    logging.info(f"=== {job_name} ended ===")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+"""
+Point-in-time join of feature views, the historical retrieval of the feature store without its offline store
+    •	Feature view definitions (source, timestamp field, entities, TTL) are read from feature_repo/repo.py
+        without importing it, so the native join runs where feast is not installed
+    •	Only the requested feature columns of the rows in the time window of the entity rows are read
+    •	Every entity row gets the latest feature row of its entity at or before its event_timestamp
+        and not older than the TTL of the view, with a sorted as-of join instead of a join per timestamp
+    •	Result has the layout of FeatureStore.get_historical_features(...).to_df()
+"""
+
+import ast
+import os
+from collections import namedtuple
+from datetime import timedelta
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+feature_repo_path = "feature_repo"
+entity_row_column = "__entity_row"
+feature_timestamp_column = "__feature_timestamp"
+
+# Entity(...), FileSource(...) or FeatureView(...) call of the feature repo, with its keyword arguments
+RepoDefinition = namedtuple("RepoDefinition", ["kind", "arguments"])
+
+
+class FeatureViewSpec:
+    """
+        What the point-in-time join needs to know of a feature view
+    """
+
+    def __init__(self, name, source_path, timestamp_field, join_keys, features, ttl=None,
+                 created_timestamp_column=None):
+        self.name = name
+        self.source_path = source_path
+        self.timestamp_field = timestamp_field
+        self.join_keys = list(join_keys)
+        self.features = list(features)
+        # no TTL, like a TTL of 0 in feast, means feature rows never expire
+        self.ttl = ttl if ttl else None
+        self.created_timestamp_column = created_timestamp_column or None
+
+
+def repo_value(node, names):
+    """
+        Value of an expression of the feature repo, as far as the point-in-time join needs it
+        :param node: ast expression
+        :param names: dict of module level name -> value assigned before
+        :return : RepoDefinition of a call, timedelta, literal or list of them, None for anything else
+    """
+    if isinstance(node, ast.Call):
+        kind = node.func.attr if isinstance(node.func, ast.Attribute) else getattr(node.func, "id", None)
+        arguments = {keyword.arg: repo_value(keyword.value, names) for keyword in node.keywords if keyword.arg}
+        if kind == "timedelta":
+            return timedelta(*[repo_value(arg, names) for arg in node.args], **arguments)
+        return RepoDefinition(kind, arguments)
+    if isinstance(node, ast.Name):
+        return names.get(node.id)
+    if isinstance(node, (ast.List, ast.Tuple)):
+        return [repo_value(element, names) for element in node.elts]
+    try:
+        return ast.literal_eval(node)
+    except ValueError:
+        # value types and dtypes, e.g. ValueType.INT64, do not matter for the join
+        return None
+
+
+def load_feature_views(repo_path=feature_repo_path):
+    """
+        Reads the feature view definitions of repo.py without importing it, neither feast nor a FeatureStore
+        is needed. Entities, file sources and feature views are read from the keyword arguments of their
+        calls, the feature views of a module level assignment or of a list are found.
+        :return : dict of feature view name -> FeatureViewSpec
+    """
+    with open(os.path.join(repo_path, "repo.py")) as f:
+        module = ast.parse(f.read())
+
+    names, definitions = {}, []
+    for statement in module.body:
+        if not isinstance(statement, (ast.Assign, ast.Expr)):
+            continue
+        value = repo_value(statement.value, names)
+        for target in getattr(statement, "targets", []):
+            if isinstance(target, ast.Name):
+                names[target.id] = value
+        definitions.extend(value if isinstance(value, list) else [value])
+
+    definitions = [definition for definition in definitions if isinstance(definition, RepoDefinition)]
+    # join key of an entity is its name, unless given, as in feast
+    join_keys = {}
+    for entity in [definition.arguments for definition in definitions if definition.kind == "Entity"]:
+        join_keys[entity["name"]] = (entity.get("join_keys") or [entity.get("join_key") or entity["name"]])[0]
+
+    feature_views = {}
+    for view in [definition.arguments for definition in definitions if definition.kind == "FeatureView"]:
+        source = (view.get("source") or view.get("batch_source")).arguments
+        source_path = source["path"]
+        # relative file source paths are relative to the feature repo, as in feast
+        if not os.path.isabs(source_path) and "://" not in source_path:
+            source_path = os.path.join(repo_path, source_path)
+        entities = [entity.arguments["name"] if isinstance(entity, RepoDefinition) else entity
+                    for entity in view.get("entities", [])]
+        feature_views[view["name"]] = FeatureViewSpec(
+            name=view["name"],
+            source_path=source_path,
+            timestamp_field=source.get("timestamp_field"),
+            join_keys=[join_keys.get(entity, entity) for entity in entities],
+            features=[field.arguments["name"] for field in view.get("schema", [])],
+            ttl=view.get("ttl"),
+            created_timestamp_column=source.get("created_timestamp_column"))
+    return feature_views
+
+
+def to_utc(timestamps):
+    timestamps = pd.to_datetime(timestamps)
+    if timestamps.dt.tz is None:
+        timestamps = timestamps.dt.tz_localize("UTC")
+    return timestamps.dt.tz_convert("UTC").astype("datetime64[ns, UTC]")
+
+
+def timestamp_scalar(timestamp, arrow_type):
+    # compares in the time zone of the source column, naive source timestamps are taken as UTC
+    if getattr(arrow_type, "tz", None) is None:
+        return pa.scalar(timestamp.tz_convert("UTC").tz_localize(None).to_pydatetime(), type=pa.timestamp("us"))
+    return pa.scalar(timestamp.to_pydatetime(), type=pa.timestamp("us", tz="UTC"))
+
+
+def read_feature_source(spec, features, start=None, end=None):
+    """
+        Reads join keys, timestamps and features of a feature view source in a time window
+        :param spec: FeatureViewSpec
+        :param features: feature columns to read
+        :param start: UTC timestamp of the oldest feature row that can be joined, None for no bound
+        :param end: UTC timestamp of the newest feature row that can be joined, None for no bound
+        :return : dataframe with UTC timestamps, sorted by timestamp
+    """
+    dataset = ds.dataset(spec.source_path, format="parquet")
+    timestamp_type = dataset.schema.field(spec.timestamp_field).type
+    columns = spec.join_keys + [spec.timestamp_field] + list(features)
+    if spec.created_timestamp_column:
+        columns.append(spec.created_timestamp_column)
+
+    expression = None
+    if start is not None:
+        expression = ds.field(spec.timestamp_field) >= timestamp_scalar(start, timestamp_type)
+    if end is not None:
+        condition = ds.field(spec.timestamp_field) <= timestamp_scalar(end, timestamp_type)
+        expression = condition if expression is None else expression & condition
+
+    feature_df = dataset.to_table(columns=columns, filter=expression).to_pandas()
+    feature_df[feature_timestamp_column] = to_utc(feature_df.pop(spec.timestamp_field))
+    sort_columns = [feature_timestamp_column]
+    if spec.created_timestamp_column:
+        # the latest created row wins among rows of the same entity and timestamp
+        feature_df[spec.created_timestamp_column] = to_utc(feature_df[spec.created_timestamp_column])
+        sort_columns.append(spec.created_timestamp_column)
+    return feature_df.sort_values(sort_columns, kind="stable").reset_index(drop=True)
+
+
+def point_in_time_join(entity_df, feature_df, spec, features, event_timestamp_column="event_timestamp"):
+    """
+        As-of join of entity rows and feature rows, both sorted by timestamp
+        :param entity_df: entity rows with join keys, UTC event timestamps and entity_row_column
+        :param feature_df: feature rows of read_feature_source
+        :return : entity_df with the feature columns, NaN where no feature row is in the TTL window
+    """
+    for join_key in spec.join_keys:
+        feature_df[join_key] = feature_df[join_key].astype(entity_df[join_key].dtype)
+    return pd.merge_asof(entity_df, feature_df[spec.join_keys + [feature_timestamp_column] + list(features)],
+                         left_on=event_timestamp_column, right_on=feature_timestamp_column, by=spec.join_keys,
+                         direction="backward", allow_exact_matches=True, tolerance=spec.ttl) \
+        .drop(columns=[feature_timestamp_column])
+
+
+def get_historical_features(entity_df, features, repo_path=feature_repo_path, feature_views=None,
+                            event_timestamp_column="event_timestamp"):
+    """
+        Point-in-time correct features of entity rows, like FeatureStore.get_historical_features(...).to_df()
+        :param entity_df: dataframe of join keys and event timestamps
+        :param features: feature references "feature_view:feature"
+        :param repo_path: feature repo with the feature view definitions
+        :param feature_views: dict of name -> FeatureViewSpec, loaded from repo_path when None
+        :return : entity_df columns followed by the features, in the row order of entity_df
+    """
+    if feature_views is None:
+        feature_views = load_feature_views(repo_path)
+
+    features_by_view = {}
+    for reference in features:
+        view_name, feature = reference.split(":")
+        features_by_view.setdefault(view_name, []).append(feature)
+
+    result = entity_df.reset_index(drop=True)
+    result[event_timestamp_column] = to_utc(result[event_timestamp_column])
+    result[entity_row_column] = range(len(result))
+    result = result.sort_values(event_timestamp_column, kind="stable")
+
+    for view_name, view_features in features_by_view.items():
+        spec = feature_views[view_name]
+        # feature rows outside [oldest entity row - TTL, newest entity row] can not be joined
+        start, end = None, None
+        if len(result):
+            end = result[event_timestamp_column].max()
+            if spec.ttl is not None:
+                start = result[event_timestamp_column].min() - spec.ttl
+        feature_df = read_feature_source(spec, view_features, start, end)
+        result = point_in_time_join(result, feature_df, spec, view_features, event_timestamp_column)
+
+    return result.sort_values(entity_row_column).drop(columns=[entity_row_column]).reset_index(drop=True)
@@ -0,0 +1,47 @@
+"""
+Raw layer partitions of Customer Info
+    •	A full ingestion writes every customer of the customer_info table to its file_arrival partition
+    •	An incremental ingestion writes only the customers with id above the high water mark of the last run,
+        with a marker file in the partition
+    •	The customer table of a file arrival is therefore the latest full partition up to it
+        and the incremental partitions after that one
+"""
+
+import glob
+import json
+import os
+
+customer_info_raw_path = "LocalDataLake/Raw/customer_info"
+incremental_marker_file_name = "_incremental.json"
+
+
+def mark_customer_partition(folder, after=None):
+    """
+        Records whether a customer info partition holds all customers or only those ingested after a watermark
+        :param folder: customer info partition folder
+        :param after: high water mark the customers were read after, None for a full ingestion
+    """
+    marker_file = os.path.join(folder, incremental_marker_file_name)
+    if after is None:
+        if os.path.exists(marker_file):
+            os.remove(marker_file)
+        return
+    with open(marker_file, "w") as f:
+        json.dump({"after_id": after}, f)
+
+
+def customer_info_partitions(file_arrival, root_folder=customer_info_raw_path):
+    """
+        :param file_arrival: file arrival whose customer table is read
+        :return : partition folders with customer rows that make up the customer table, oldest first
+    """
+    # file_arrival is kept as YYYYMMDD string, so string comparison orders partitions by date
+    folders = [folder for folder in sorted(glob.glob(f"{root_folder}/file_arrival=*"))
+               if os.path.basename(folder).split("=", 1)[1] <= file_arrival]
+    table_folders = []
+    for folder in reversed(folders):
+        table_folders.append(folder)
+        if not os.path.exists(os.path.join(folder, incremental_marker_file_name)):
+            break
+    # a run without new customers leaves an incremental partition without files
+    return [folder for folder in reversed(table_folders) if glob.glob(f"{folder}/*.parquet")]
@@ -1,18 +1,23 @@
-import sqlite3
-import pandas as pd
+import util
 
 # Define your database path and table name
 db_path = "./db/customer_data.db"
 table_name = "customer_info"
 
 # Connect to the SQLite database
-conn = sqlite3.connect(db_path)
+conn = util.connect_sqlite_readonly(db_path)
 
-# Read the table into a DataFrame
-df = pd.read_sql_query(f"SELECT * FROM {table_name}", conn)
+# Read the table page by page on id, so only one page is held in memory
+pages = util.iter_sqlite_pages(conn, table_name, key_column="id", page_size=100_000)
+df = next(pages, None)
+total_rows = 0 if df is None else len(df) + sum(len(page) for page in pages)
 
 # Close the connection
 conn.close()
 
 # Preview the data
-print(df.head())
\ No newline at end of file
+if df is None:
+    print(f"{table_name} is empty")
+else:
+    print(df.head())
+print(f"Total rows in {table_name}: {total_rows}")
\ No newline at end of file
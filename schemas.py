@@ -0,0 +1,61 @@
+"""
+Explicit Parquet schemas of the Raw and silver layers.
+Numeric columns use the narrowest integer type that holds their domain and
+low cardinality text columns are dictionary encoded, so stages read back
+typed columns instead of re-inferring them from csv.
+"""
+
+import pyarrow as pa
+
+# dictionary encoded strings; raw keeps wide indices since any value may arrive
+RAW_CATEGORY = pa.dictionary(pa.int32(), pa.string())
+SILVER_CATEGORY = pa.dictionary(pa.int8(), pa.string())
+
+RAW_LOAN_INFO_SCHEMA = pa.schema([
+    ("id", pa.int32()),
+    ("default", RAW_CATEGORY),
+    ("balance", pa.int32()),
+    ("housing", RAW_CATEGORY),
+    ("loan", RAW_CATEGORY),
+    ("contact", RAW_CATEGORY),
+    ("day", pa.int8()),
+    ("month", RAW_CATEGORY),
+    ("duration", pa.int32()),
+    ("campaign", pa.int16()),
+    ("pdays", pa.int16()),
+    ("previous", pa.int16()),
+    ("poutcome", RAW_CATEGORY),
+    ("y", RAW_CATEGORY),
+])
+
+RAW_CUSTOMER_INFO_SCHEMA = pa.schema([
+    ("id", pa.int32()),
+    ("age", pa.int16()),
+    ("job", RAW_CATEGORY),
+    ("marital", RAW_CATEGORY),
+    ("education", RAW_CATEGORY),
+])
+
+SILVER_LOAN_INFO_SCHEMA = pa.schema([
+    ("customer_id", pa.int32()),
+    ("has_credit", pa.int8()),
+    ("avg_yearly_balance", pa.int32()),
+    ("has_housing_loan", pa.int8()),
+    ("has_personal_loan", pa.int8()),
+    ("contacted_day", pa.int8()),
+    ("contacted_month", SILVER_CATEGORY),
+    ("contacted_duration_sec", pa.int32()),
+    ("total_times_contacted", pa.int16()),
+    ("outcome", pa.int8()),
+])
+
+SILVER_CUSTOMER_INFO_SCHEMA = pa.schema([
+    ("customer_id", pa.int32()),
+    ("age", pa.int16()),
+    ("job_type", SILVER_CATEGORY),
+    ("marital_status", SILVER_CATEGORY),
+    ("educational_level", SILVER_CATEGORY),
+    ("job_type_encoded", pa.int8()),
+    ("marital_status_encoded", pa.int8()),
+    ("educational_level_encoded", pa.int8()),
+])
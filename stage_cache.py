@@ -0,0 +1,244 @@
+"""
+Stage cache
+    •	A stage run is fingerprinted by the content of its input partitions, its parameters and the source code
+        of the stage script and of the repo modules it imports
+    •	When the outputs recorded for the same fingerprint still exist unchanged, the stage is skipped,
+        so a rerun of the pipeline after a failure only runs the stages whose inputs changed
+    •	Cache records are evicted least recently used first beyond max_records.
+        Outputs themselves are data lake partitions, they are not deleted by the cache.
+"""
+
+import ast
+import hashlib
+import json
+import os
+import time
+
+import util
+import raw_layer
+from feature_transforms import latest_params_folder, transform_params_file_name
+from gold_dataset import customer_loan_info_path
+
+cache_folder = "LocalDataLake/_stage_cache"
+file_hashes_file_name = "_file_hashes.json"
+repo_folder = os.path.dirname(os.path.abspath(__file__))
+
+stage_scripts = {
+    "ingestion": "2_data_ingestion.py",
+    "validation": "4_data_validation.py",
+    "preparation": "5_data_preparation.py",
+    "transformation": "6_data_transformation_and_storage.py",
+    "model_building": "9_model_building.py",
+}
+
+
+def stage_io(stage, file_arrival, params=None):
+    """
+        Data lake paths a stage reads and writes for a file arrival
+        :param params: parameters of the stage run, the training window of model_building
+        :return : (list of input paths, list of output paths)
+    """
+    params = params or {}
+    raw = [f"LocalDataLake/Raw/loan_info/file_arrival={file_arrival}",
+           f"LocalDataLake/Raw/customer_info/file_arrival={file_arrival}"]
+    silver = [f"LocalDataLake/silver/loan_info/file_arrival={file_arrival}",
+              f"LocalDataLake/silver/customer_info/file_arrival={file_arrival}"]
+    gold = [f"LocalDataLake/gold/customer_loan_info/file_arrival={file_arrival}"]
+
+    if stage == "ingestion":
+        return ["LocalDataLake/Landing", "db/customer_data.db"], raw
+    if stage == "validation":
+        return raw, [f"validation_reports/{file_arrival}"]
+    if stage == "preparation":
+        # customers of an incremental ingestion are prepared together with the earlier customer partitions
+        return raw[:1] + raw_layer.customer_info_partitions(file_arrival), silver
+    if stage == "transformation":
+        # parameters fitted on another gold partition are an input as well
+        if params.get("transform_params_from"):
+            params_folder = f"{customer_loan_info_path}/file_arrival={params['transform_params_from']}"
+        else:
+            params_folder = None if params.get("refit_transform") \
+                else latest_params_folder(customer_loan_info_path, file_arrival)
+        reused_params = [f"{params_folder}/{transform_params_file_name}"] if params_folder else []
+        return silver + reused_params, gold
+    if stage == "model_building":
+        # a training window reads several gold partitions, features come from the feature view source
+        training_data = ["LocalDataLake/gold/customer_loan_info"] if params.get("start") or params.get("end") \
+            else gold
+        return training_data + ["feature_repo/data/customer_loan_info.parquet"], []
+    raise ValueError(f"unknown stage {stage}")
+
+
+def code_files(script, seen=None):
+    """
+        :return : sorted list of the script and the repo modules it imports, directly or indirectly
+    """
+    seen = set() if seen is None else seen
+    path = os.path.join(repo_folder, script)
+    if path in seen or not os.path.exists(path):
+        return sorted(seen)
+    seen.add(path)
+    with open(path, "rb") as f:
+        tree = ast.parse(f.read())
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            modules = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            modules = [node.module]
+        else:
+            continue
+        for module in modules:
+            code_files(f"{module.split('.')[0]}.py", seen)
+    return sorted(seen)
+
+
+class StageCache:
+    """
+        Records of stage runs by fingerprint, kept as json files in cache_folder/<stage>/<fingerprint>.json
+    """
+
+    def __init__(self, folder=cache_folder, max_records=256):
+        self.folder = folder
+        self.max_records = max_records
+        self.file_hashes_file = os.path.join(folder, file_hashes_file_name)
+        self.file_hashes = None
+
+    def file_hash(self, path):
+        # content hashes are remembered by size and mtime, unchanged files are not read again
+        if self.file_hashes is None:
+            self.file_hashes = {}
+            if os.path.exists(self.file_hashes_file):
+                with open(self.file_hashes_file) as f:
+                    self.file_hashes = json.load(f)
+        stat = os.stat(path)
+        key = os.path.abspath(path)
+        known = self.file_hashes.get(key)
+        if known and known["size"] == stat.st_size and known["mtime_ns"] == stat.st_mtime_ns:
+            return known["sha256"]
+        sha256 = util.file_sha256(path)
+        self.file_hashes[key] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": sha256}
+        return sha256
+
+    def save_file_hashes(self):
+        if self.file_hashes is not None:
+            os.makedirs(self.folder, exist_ok=True)
+            # hashes of files which no longer exist are dropped
+            self.file_hashes = {path: known for path, known in self.file_hashes.items() if os.path.exists(path)}
+            with open(self.file_hashes_file, "w") as f:
+                json.dump(self.file_hashes, f)
+
+    def paths_fingerprint(self, paths):
+        """
+            :return : dict of file path -> content hash of all files under paths, missing paths included
+        """
+        fingerprint = {}
+        for path in sorted(paths):
+            if os.path.isfile(path):
+                fingerprint[path] = self.file_hash(path)
+            elif os.path.isdir(path):
+                for folder, folders, files in os.walk(path):
+                    folders.sort()
+                    for file in sorted(files):
+                        file_path = os.path.join(folder, file)
+                        fingerprint[file_path.replace(os.sep, "/")] = self.file_hash(file_path)
+            else:
+                fingerprint[path] = None
+        return fingerprint
+
+    def fingerprint(self, stage, inputs, params):
+        content = {
+            "stage": stage,
+            "inputs": self.paths_fingerprint(inputs),
+            "params": params,
+            "code": {os.path.relpath(path, repo_folder): self.file_hash(path)
+                     for path in code_files(stage_scripts[stage])},
+        }
+        return hashlib.sha256(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()
+
+    def record_file(self, stage, fingerprint):
+        return os.path.join(self.folder, stage, f"{fingerprint}.json")
+
+    def lookup(self, stage, fingerprint):
+        """
+            :return : cache record of the fingerprint when its outputs are unchanged, else None
+        """
+        record_file = self.record_file(stage, fingerprint)
+        if not os.path.exists(record_file):
+            return None
+        with open(record_file) as f:
+            record = json.load(f)
+        if self.paths_fingerprint(record["outputs"]) != record["output_fingerprint"]:
+            return None
+        record["last_used_at"] = time.time()
+        with open(record_file, "w") as f:
+            json.dump(record, f, indent=2)
+        return record
+
+    def store(self, stage, fingerprint, outputs, result=None):
+        """
+            Records the outputs of a finished stage run under its fingerprint
+            :param result: json serializable result of the run, returned again on a hit
+        """
+        os.makedirs(os.path.join(self.folder, stage), exist_ok=True)
+        now = time.time()
+        with open(self.record_file(stage, fingerprint), "w") as f:
+            json.dump({"stage": stage, "fingerprint": fingerprint, "outputs": list(outputs),
+                       "output_fingerprint": self.paths_fingerprint(outputs), "result": result,
+                       "created_at": now, "last_used_at": now}, f, indent=2)
+        self.evict()
+
+    def evict(self):
+        records = []
+        for stage in os.listdir(self.folder):
+            stage_folder = os.path.join(self.folder, stage)
+            if os.path.isdir(stage_folder):
+                for file in os.listdir(stage_folder):
+                    records.append(os.path.join(stage_folder, file))
+        if len(records) <= self.max_records:
+            return
+        # last use is the modification time, lookup rewrites a record on every hit
+        records.sort(key=os.path.getmtime)
+        for record_file in records[:len(records) - self.max_records]:
+            os.remove(record_file)
+
+
+def params_of_args(args):
+    """
+        :return : dict of the command line arguments of a stage which change its output
+    """
+    return {name: value for name, value in vars(args).items() if name not in ("file_arrival_time", "no_cache")}
+
+
+def run_cached(stage, file_arrival, params, run, cache=None, outputs_of_result=None):
+    """
+        Runs a stage unless a run with the same inputs, parameters and code already wrote its outputs
+        :param stage: stage name of stage_scripts
+        :param file_arrival: file arrival of the run
+        :param params: json serializable parameters which change the output of the stage
+        :param run: function running the stage, its result is recorded when json serializable
+        :param cache: StageCache, None runs the stage without cache
+        :param outputs_of_result: function of the result giving extra output paths, e.g. a model version folder
+        :return : (True, recorded result) when skipped, (False, result of run) when run
+    """
+    if cache is None:
+        return False, run()
+
+    params = {"file_arrival": file_arrival, **params}
+    inputs, outputs = stage_io(stage, file_arrival, params)
+    fingerprint = cache.fingerprint(stage, inputs, params)
+    record = cache.lookup(stage, fingerprint)
+    if record is not None:
+        cache.save_file_hashes()
+        return True, record["result"]
+
+    result = run()
+    if outputs_of_result is not None:
+        outputs = outputs + outputs_of_result(result)
+    try:
+        json.dumps(result)
+        recorded_result = result
+    except TypeError:
+        recorded_result = None
+    cache.store(stage, fingerprint, outputs, recorded_result)
+    cache.save_file_hashes()
+    return False, result
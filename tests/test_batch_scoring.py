@@ -0,0 +1,36 @@
+import importlib
+import os
+import sys
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def load_batch_scoring(tmp_path, monkeypatch):
+    # the stage logger writes to ./logs of the working directory
+    monkeypatch.chdir(tmp_path)
+    return importlib.import_module("10_batch_scoring")
+
+
+def test_single_row_group_is_split_into_chunks(tmp_path, monkeypatch):
+    batch_scoring = load_batch_scoring(tmp_path, monkeypatch)
+    gold_file = str(tmp_path / "part-0.parquet")
+    # a gold partition below the default row group size of pyarrow is one row group
+    pq.write_table(pa.table({"customer_id": list(range(250))}), gold_file)
+    assert pq.ParquetFile(gold_file).num_row_groups == 1
+
+    tasks = batch_scoring.scoring_tasks([gold_file], chunk_size=100)
+
+    assert tasks == [(gold_file, 0, 0, 100), (gold_file, 0, 100, 200), (gold_file, 0, 200, 250)]
+
+
+def test_chunks_do_not_cross_row_groups(tmp_path, monkeypatch):
+    batch_scoring = load_batch_scoring(tmp_path, monkeypatch)
+    gold_file = str(tmp_path / "part-0.parquet")
+    pq.write_table(pa.table({"customer_id": list(range(250))}), gold_file, row_group_size=150)
+
+    tasks = batch_scoring.scoring_tasks([gold_file], chunk_size=100)
+
+    assert tasks == [(gold_file, 0, 0, 100), (gold_file, 0, 100, 150), (gold_file, 1, 0, 100)]
@@ -1,10 +1,34 @@
 import logging
 import os
+import sys
+import json
+import time
+import sqlite3
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
 import glob
+import hashlib
+import uuid
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from functools import partial, wraps
+from contextlib import contextmanager, nullcontext
 
 from datetime import datetime
 
+try:
+    import resource
+except ImportError:  # not available on Windows, peak RSS is not recorded there
+    resource = None
+
+metrics_folder = "./metrics"
+metrics_file_env = "PIPELINE_METRICS_FILE"
+run_id_env = "PIPELINE_RUN_ID"
+span_parent_env = "PIPELINE_SPAN_PARENT"
+profile_env = "PIPELINE_PROFILE"
+
 def get_logger(job_name):
     job_run_timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
 
@@ -18,11 +42,468 @@ def get_logger(job_name):
     return logging
 
 
-def pd_read_csv_files(root_folder):
+def pd_read_csv_files(root_folder, columns=None, dtype=None, max_workers=None, executor="thread"):
     csv_files = glob.glob(f"{root_folder}/*.csv")
-    return pd.concat((pd.read_csv(file) for file in csv_files), ignore_index=True)
+    return pd_concat_csv_files(csv_files, columns, dtype, max_workers, executor)
+
+
+def pd_concat_csv_files(csv_files, columns=None, dtype=None, max_workers=None, executor="thread"):
+    """
+        Reads many csv files concurrently with the pyarrow csv engine into one dataframe
+        :param csv_files: list of csv file paths
+        :param columns: list of columns to read, None reads all columns
+        :param dtype: dict of column -> dtype applied while parsing, e.g. {"age": "int16", "job": "category"}
+        :param max_workers: number of files read at the same time
+        :param executor: "thread" or "process" pool
+        :return : dataframe
+    """
+    read_file = partial(_read_csv_table, columns=columns, dtype=dtype, use_threads=len(csv_files) == 1)
+    return _concat_tables_to_pandas(_read_tables_parallel(read_file, csv_files, max_workers, executor))
+
+
+def _arrow_type(dtype):
+    if isinstance(dtype, pa.DataType):
+        return dtype
+    if str(dtype) == "category":
+        return pa.dictionary(pa.int32(), pa.string())
+    if dtype in (str, "str", "string", "object"):
+        return pa.string()
+    return pa.from_numpy_dtype(np.dtype(dtype))
+
+
+def _read_csv_table(file, columns=None, dtype=None, use_threads=True):
+    convert_options = pacsv.ConvertOptions(
+        include_columns=columns,
+        column_types={col: _arrow_type(col_dtype) for col, col_dtype in (dtype or {}).items()},
+        strings_can_be_null=True)
+    return pacsv.read_csv(file, read_options=pacsv.ReadOptions(use_threads=use_threads),
+                          convert_options=convert_options)
+
+
+def _read_parquet_table(file, columns=None, dtype=None, use_threads=True):
+    table = pq.read_table(file, columns=columns, use_threads=use_threads)
+    for col, col_dtype in (dtype or {}).items():
+        if col in table.column_names:
+            i = table.column_names.index(col)
+            table = table.set_column(i, col, table.column(i).cast(_arrow_type(col_dtype)))
+    return table
 
 
-def pd_read_parquet_files(root_folder):
+def _read_tables_parallel(read_file, files, max_workers=None, executor="thread"):
+    if len(files) <= 1 or max_workers == 1:
+        return [read_file(file) for file in files]
+    pool = ProcessPoolExecutor if executor == "process" else ThreadPoolExecutor
+    with pool(max_workers=max_workers) as workers:
+        return list(workers.map(read_file, files))
+
+
+def _concat_tables_to_pandas(tables):
+    if not tables:
+        raise ValueError("No objects to concatenate")
+    # concatenating arrow tables only links their chunks, to_pandas then allocates each column once
+    return pa.concat_tables(tables, promote_options="permissive").to_pandas()
+
+
+def file_sha256(file_path, block_size=1024 * 1024):
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def pd_read_parquet_files(root_folder, columns=None, dtype=None, max_workers=None, executor="thread"):
+    """
+        Reads all parquet files of a partition folder concurrently, only the requested columns are decoded
+        :param root_folder: partition folder
+        :param columns: list of columns to read, None reads all columns
+        :param dtype: dict of column -> dtype to cast to, e.g. {"age": "int16"}
+        :param max_workers: number of files read at the same time
+        :param executor: "thread" or "process" pool
+        :return : dataframe
+    """
     parquet_files = glob.glob(f"{root_folder}/*.parquet")
-    return pd.concat((pd.read_csv(file) for file in parquet_files), ignore_index=True)
\ No newline at end of file
+    read_file = partial(_read_parquet_table, columns=columns, dtype=dtype, use_threads=len(parquet_files) == 1)
+    return _concat_tables_to_pandas(_read_tables_parallel(read_file, parquet_files, max_workers, executor))
+
+
+def iter_parquet_batches(root_folder, columns=None, batch_size=100_000):
+    """
+        Streams all parquet files of a partition folder as dataframes of bounded size
+        :param root_folder: partition folder
+        :param columns: list of columns to read, None reads all columns
+        :param batch_size: maximum number of rows per dataframe
+        :return : generator of dataframes
+    """
+    for file in sorted(glob.glob(f"{root_folder}/*.parquet")):
+        for batch in pq.ParquetFile(file).iter_batches(batch_size=batch_size, columns=columns):
+            yield batch.to_pandas()
+
+
+def pd_conform_to_schema(df, schema):
+    """
+        Casts a dataframe to the types it gets when written with schema and read back from parquet
+        :param df: dataframe
+        :param schema: pyarrow schema, see schemas.py
+        :return : dataframe
+    """
+    return pa.Table.from_pandas(df, schema=schema, preserve_index=False).to_pandas()
+
+
+def pd_write_parquet(df, output_file, schema):
+    """
+        Writes a dataframe as a compressed parquet file with an explicit schema
+        :param df: dataframe to write
+        :param output_file: parquet file to write
+        :param schema: pyarrow schema, see schemas.py
+    """
+    table = pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+    pq.write_table(table, output_file, compression="zstd")
+
+
+def write_chunks_to_parquet(chunks, output_file, schema):
+    """
+        Appends a stream of dataframes to a single parquet file, so only one chunk is held in memory
+        :param chunks: iterable of dataframes
+        :param output_file: parquet file to write
+        :param schema: pyarrow schema, see schemas.py
+        :return : number of rows written
+    """
+    rows_written = 0
+    with pq.ParquetWriter(output_file, schema, compression="zstd") as writer:
+        for chunk in chunks:
+            writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+            rows_written += len(chunk)
+    return rows_written
+
+
+def rows_within_memory_ceiling(sample_df, max_memory_mb, default_rows):
+    """
+        Estimates how many rows of a dataframe fit within a memory ceiling
+        :param sample_df: small sample of the data used to measure bytes per row
+        :param max_memory_mb: memory ceiling for one batch in MB, None for no ceiling
+        :param default_rows: number of rows to use when no ceiling is given
+        :return : number of rows per batch
+    """
+    if not max_memory_mb or sample_df.empty:
+        return default_rows
+    bytes_per_row = max(1, int(sample_df.memory_usage(index=True, deep=True).sum() / len(sample_df)))
+    return max(1, min(default_rows, int(max_memory_mb * 1024 * 1024 // bytes_per_row)))
+
+
+def iter_csv_chunks(csv_files, chunk_size=100_000, max_memory_mb=None):
+    """
+        Streams csv files as dataframes of bounded size instead of loading them at once
+        :param csv_files: list of csv file paths
+        :param chunk_size: maximum number of rows per chunk
+        :param max_memory_mb: memory ceiling for one chunk in MB
+        :return : generator of dataframes
+    """
+    for file in csv_files:
+        rows = rows_within_memory_ceiling(pd.read_csv(file, nrows=1000), max_memory_mb, chunk_size)
+        yield from pd.read_csv(file, chunksize=rows)
+
+
+def connect_sqlite_readonly(db_path):
+    """
+        Opens a read only SQLite connection tuned for large sequential reads
+        :param db_path: path of the SQLite database
+        :return : sqlite3 connection
+    """
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    conn.execute("PRAGMA query_only = ON")
+    conn.execute("PRAGMA cache_size = -65536")  # 64 MB page cache
+    conn.execute("PRAGMA mmap_size = 268435456")  # 256 MB memory mapped I/O
+    conn.execute("PRAGMA temp_store = MEMORY")
+    return conn
+
+
+def ensure_sqlite_index(db_path, table_name, column):
+    conn = sqlite3.connect(db_path)
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table_name}_{column} ON {table_name} ({column})")
+    conn.commit()
+    conn.close()
+
+
+def iter_sqlite_pages(conn, table_name, key_column="id", page_size=100_000, after=None):
+    """
+        Reads a table page by page ordered by key_column, using keyset pagination instead of OFFSET,
+        so every page is an index seek. rowid breaks ties between duplicated keys.
+        :param conn: sqlite3 connection, see connect_sqlite_readonly
+        :param table_name: table to read
+        :param key_column: indexed column to paginate on
+        :param page_size: number of rows per page
+        :param after: only rows with key_column greater than this value are read, None reads all rows
+        :return : generator of dataframes
+    """
+    columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table_name})")]
+    select = f"SELECT rowid, * FROM {table_name}"
+    order_by = f"ORDER BY {key_column}, rowid LIMIT ?"
+
+    if after is None:
+        cursor = conn.execute(f"{select} {order_by}", (page_size,))
+    else:
+        cursor = conn.execute(f"{select} WHERE {key_column} > ? {order_by}", (after, page_size))
+
+    while True:
+        rows = cursor.fetchall()
+        if not rows:
+            return
+        last_key, last_rowid = rows[-1][columns.index(key_column) + 1], rows[-1][0]
+        yield pd.DataFrame.from_records([row[1:] for row in rows], columns=columns)
+        if len(rows) < page_size:
+            return
+        cursor = conn.execute(f"{select} WHERE ({key_column}, rowid) > (?, ?) {order_by}",
+                              (last_key, last_rowid, page_size))
+
+
+class RunningStats:
+    """
+        Streaming count, mean, standard deviation, min and max of numeric columns.
+        Chunks are combined with the parallel form of Welford's algorithm, so the statistics
+        of data larger than memory are computed in one pass without loss of precision.
+    """
+
+    def __init__(self, columns):
+        self.columns = list(columns)
+        self.count = np.zeros(len(self.columns))
+        self.mean = np.zeros(len(self.columns))
+        self.m2 = np.zeros(len(self.columns))
+        self.min = np.full(len(self.columns), np.inf)
+        self.max = np.full(len(self.columns), -np.inf)
+
+    def update(self, df):
+        values = df[self.columns].to_numpy(dtype="float64", na_value=np.nan)
+        valid = ~np.isnan(values)
+        count = valid.sum(axis=0).astype("float64")
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = np.where(valid, values, 0).sum(axis=0) / count
+            m2 = np.where(valid, (values - mean) ** 2, 0).sum(axis=0)
+        self.merge_moments(count, np.nan_to_num(mean), m2,
+                           np.where(valid, values, np.inf).min(axis=0, initial=np.inf),
+                           np.where(valid, values, -np.inf).max(axis=0, initial=-np.inf))
+
+    def merge(self, other):
+        self.merge_moments(other.count, other.mean, other.m2, other.min, other.max)
+
+    def merge_moments(self, count, mean, m2, minimum, maximum):
+        total = self.count + count
+        with np.errstate(invalid="ignore", divide="ignore"):
+            delta = mean - self.mean
+            self.mean = np.where(total > 0, self.mean + delta * count / total, 0)
+            self.m2 = np.where(total > 0, self.m2 + m2 + delta ** 2 * self.count * count / total, 0)
+        self.count = total
+        self.min = np.minimum(self.min, minimum)
+        self.max = np.maximum(self.max, maximum)
+
+    def std(self):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.sqrt(self.m2 / (self.count - 1))
+
+    def summary(self):
+        """
+            :return : dataframe of count, mean, std, min and max per column, like DataFrame.describe
+        """
+        return pd.DataFrame([self.count, self.mean, self.std(), self.min, self.max],
+                            index=["count", "mean", "std", "min", "max"], columns=self.columns)
+
+
+def peak_rss_mb():
+    """
+        :return : peak resident set size of this process in MB, None when it cannot be measured
+    """
+    # on Linux ru_maxrss keeps the peak of the parent across fork and exec, so a subprocess started by a large
+    # process would report the peak of its parent. VmHWM is the peak of the memory of this process only.
+    if os.path.exists("/proc/self/status"):
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    if resource is None:
+        return None
+    # ru_maxrss is in bytes on macOS and in KB on Linux
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+def cpu_time():
+    """
+        :return : user and system CPU seconds of this process and of its child processes which have finished
+    """
+    if resource is None:
+        return time.process_time()
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+
+def path_size(path):
+    """
+        :return : size in bytes of a file or of all files under a folder, 0 when it does not exist
+    """
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(folder, file)) for folder, _, files in os.walk(path) for file in files)
+
+
+def count_rows(value):
+    """
+        :return : number of rows of a dataframe or table, of the first one of a tuple, else None
+    """
+    if isinstance(value, tuple) and value:
+        value = value[0]
+    if isinstance(value, (pd.DataFrame, pa.Table)):
+        return len(value)
+    return None
+
+
+_open_spans = []
+
+
+class Span:
+    """
+        Measures wall time, CPU time, peak RSS, rows in and out and bytes read and written of one step.
+        Used as a context manager, or as a decorator measuring every call of a function, rows are then
+        counted on the first argument and on the result. Every span is appended as one json line to the
+        metrics file of the run, see job_span, spans outside of a job only measure.
+    """
+
+    def __init__(self, name, rows_in=None, rows_out=None):
+        self.name = name
+        self.rows_in = rows_in
+        self.rows_out = rows_out
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.metrics = None
+
+    def read(self, *paths):
+        self.bytes_read += sum(path_size(path) for path in paths)
+
+    def written(self, *paths):
+        self.bytes_written += sum(path_size(path) for path in paths)
+
+    def __enter__(self):
+        # spans of worker processes have the span which started the job as parent
+        parent = _open_spans[-1].path if _open_spans else os.environ.get(span_parent_env)
+        self.path = f"{parent}/{self.name}" if parent else self.name
+        _open_spans.append(self)
+        self.started_at = datetime.now()
+        self.start_peak_rss_mb = peak_rss_mb()
+        self.start_cpu = cpu_time()
+        self.start_wall = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall_sec = time.perf_counter() - self.start_wall
+        cpu_sec = cpu_time() - self.start_cpu
+        _open_spans.remove(self)
+        end_peak_rss_mb = peak_rss_mb()
+        self.metrics = {
+            "run_id": os.environ.get(run_id_env),
+            "span": self.path,
+            "pid": os.getpid(),
+            "started_at": self.started_at.isoformat(),
+            "status": "failed" if exc_type else "ok",
+            "wall_sec": round(wall_sec, 6),
+            "cpu_sec": round(cpu_sec, 6),
+            "peak_rss_mb": end_peak_rss_mb,
+            # how much this span raised the peak, 0 when an earlier step already used more memory
+            "peak_rss_growth_mb": None if end_peak_rss_mb is None else end_peak_rss_mb - self.start_peak_rss_mb,
+            "rows_in": None if self.rows_in is None else int(self.rows_in),
+            "rows_out": None if self.rows_out is None else int(self.rows_out),
+            "bytes_read": int(self.bytes_read),
+            "bytes_written": int(self.bytes_written),
+        }
+        write_metrics(self.metrics)
+        return False
+
+    def __call__(self, func):
+        @wraps(func)
+        def measured(*args, **kwargs):
+            with Span(self.name) as span:
+                span.rows_in = count_rows(args[0]) if args else None
+                result = func(*args, **kwargs)
+                span.rows_out = count_rows(result)
+            return result
+
+        return measured
+
+
+def write_metrics(metrics):
+    metrics_file = os.environ.get(metrics_file_env)
+    if metrics_file:
+        # one write of one line per span, lines of concurrent worker processes do not interleave
+        with open(metrics_file, "a") as f:
+            f.write(json.dumps(metrics) + "\n")
+
+
+@contextmanager
+def profiler(output_prefix):
+    """
+        Profiles the block with the pyinstrument sampling profiler when it is installed,
+        else with cProfile, written to <output_prefix>.html or <output_prefix>.prof
+    """
+    try:
+        from pyinstrument import Profiler
+    except ImportError:
+        Profiler = None
+
+    if Profiler is not None:
+        sampling_profiler = Profiler()
+        sampling_profiler.start()
+        try:
+            yield
+        finally:
+            sampling_profiler.stop()
+            with open(f"{output_prefix}.html", "w") as f:
+                f.write(sampling_profiler.output_html())
+    else:
+        import cProfile
+
+        tracing_profiler = cProfile.Profile()
+        tracing_profiler.enable()
+        try:
+            yield
+        finally:
+            tracing_profiler.disable()
+            tracing_profiler.dump_stats(f"{output_prefix}.prof")
+
+
+def set_environment(values):
+    """
+        :param values: dict of environment variable -> value, None removes the variable
+    """
+    for name, value in values.items():
+        if value is None:
+            os.environ.pop(name, None)
+        else:
+            os.environ[name] = value
+
+
+@contextmanager
+def job_span(job_name, file_arrival):
+    """
+        Root span of a job run. Spans of the run, also of worker processes it starts, are appended to
+        metrics/file_arrival=<file_arrival>/metrics.jsonl. When the PIPELINE_PROFILE environment variable
+        is set the run is also profiled into the same folder, see profiler.
+        A job span inside another one is a run of its own, a stage of pipeline_runner.py, whose span is a child
+        of the enclosing span. The metrics environment of the enclosing run is restored at its end.
+        :return : Span of the job, with the run_id of the run
+    """
+    folder = f"{metrics_folder}/file_arrival={file_arrival}"
+    os.makedirs(folder, exist_ok=True)
+    # the start time orders the runs when read, the random part keeps two runs of one instant apart
+    run_id = f"{job_name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex}"
+    # one profiler at a time, the enclosing run profiles its job spans already
+    profile = os.environ.get(profile_env) and not _open_spans
+    # environment variables are inherited by worker processes, module state is not by spawned workers
+    run_environment = {metrics_file_env: f"{folder}/metrics.jsonl", run_id_env: run_id, span_parent_env: None}
+    previous_environment = {name: os.environ.get(name) for name in run_environment}
+    set_environment(run_environment)
+    try:
+        with profiler(f"{folder}/{run_id}") if profile else nullcontext():
+            with Span(job_name) as span:
+                span.run_id = run_id
+                os.environ[span_parent_env] = span.path
+                yield span
+    finally:
+        set_environment(previous_environment)
@@ -0,0 +1,357 @@
+"""
+Native validation engine
+    •	Evaluates a rules table of great_expectations style expectations on a pandas DataFrame
+    •	Every column is scanned once, all rules on a column share its null mask and values
+    •	Every rule keeps a mergeable state, so a partition can be validated chunk by chunk or by several
+        workers and the partial states combined into one result
+    •	Results use the layout of great_expectations validation results, so the same
+        validation summary and report can be built from either engine
+"""
+
+import glob
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+# number of unexpected values kept in a result, as great_expectations does by default
+partial_unexpected_count = 20
+
+
+def to_python(value):
+    return value.item() if isinstance(value, np.generic) else value
+
+
+class ColumnView:
+    """
+        Values of one column which are computed once and shared by all rules on the column
+    """
+
+    def __init__(self, series):
+        self.series = series
+        self.null_mask = series.isna().to_numpy()
+        self.non_null = series[~self.null_mask]
+
+
+class Expectation:
+    """
+        Mergeable state of one rule. update() consumes a chunk, merge() adds the state of another
+        chunk or worker and result() gives the great_expectations style outcome.
+    """
+
+    def __init__(self, column, **kwargs):
+        self.column = column
+        self.kwargs = kwargs
+
+    def update(self, view):
+        raise NotImplementedError
+
+    def merge(self, other):
+        raise NotImplementedError
+
+    def result(self):
+        raise NotImplementedError
+
+
+class UnexpectedValues(Expectation):
+    """
+        Base of map expectations: counts elements and unexpected values, keeps a sample of unexpected values
+    """
+
+    def __init__(self, column, **kwargs):
+        super().__init__(column, **kwargs)
+        self.element_count = 0
+        self.unexpected_count = 0
+        self.partial_unexpected_list = []
+
+    def add_unexpected(self, values, unexpected_mask, element_count):
+        self.element_count += element_count
+        self.unexpected_count += int(unexpected_mask.sum())
+        missing_samples = partial_unexpected_count - len(self.partial_unexpected_list)
+        if missing_samples > 0:
+            self.partial_unexpected_list += values[unexpected_mask].iloc[:missing_samples].tolist()
+
+    def merge(self, other):
+        self.element_count += other.element_count
+        self.unexpected_count += other.unexpected_count
+        self.partial_unexpected_list = (self.partial_unexpected_list
+                                        + other.partial_unexpected_list)[:partial_unexpected_count]
+
+    def result(self):
+        return self.unexpected_count == 0, {
+            "element_count": self.element_count,
+            "unexpected_count": self.unexpected_count,
+            "partial_unexpected_list": self.partial_unexpected_list,
+        }
+
+
+class ExpectTableColumnsToMatchOrderedList(Expectation):
+    def __init__(self, column=None, column_list=()):
+        super().__init__(column, column_list=column_list)
+        self.observed = None
+
+    def update(self, df):
+        if self.observed is None:
+            self.observed = list(df.columns)
+
+    def merge(self, other):
+        if self.observed is None:
+            self.observed = other.observed
+
+    def result(self):
+        return self.observed == list(self.kwargs["column_list"]), {"observed_value": self.observed}
+
+
+class ExpectColumnValuesToBeOfType(Expectation):
+    def __init__(self, column, type_):
+        super().__init__(column, type_=type_)
+        self.observed = []
+
+    def update(self, view):
+        observed = str(view.series.dtype)
+        if observed not in self.observed:
+            self.observed.append(observed)
+
+    def merge(self, other):
+        self.observed += [observed for observed in other.observed if observed not in self.observed]
+
+    def result(self):
+        observed = self.observed[0] if len(self.observed) == 1 else self.observed
+        return self.observed == [self.kwargs["type_"]], {"observed_value": observed}
+
+
+class ExpectColumnValuesToBeInSet(UnexpectedValues):
+    def __init__(self, column, value_set):
+        super().__init__(column, value_set=value_set)
+
+    def update(self, view):
+        unexpected_mask = ~view.non_null.isin(self.kwargs["value_set"]).to_numpy()
+        self.add_unexpected(view.non_null, unexpected_mask, len(view.series))
+
+
+class ExpectColumnValuesToBeBetween(UnexpectedValues):
+    def __init__(self, column, min_value=None, max_value=None):
+        super().__init__(column, min_value=min_value, max_value=max_value)
+        self.observed_min = None
+        self.observed_max = None
+
+    def update(self, view):
+        values = view.non_null.to_numpy()
+        unexpected_mask = np.zeros(len(values), dtype=bool)
+        if self.kwargs["min_value"] is not None:
+            unexpected_mask |= values < self.kwargs["min_value"]
+        if self.kwargs["max_value"] is not None:
+            unexpected_mask |= values > self.kwargs["max_value"]
+        self.add_unexpected(view.non_null, unexpected_mask, len(view.series))
+        if len(values):
+            self.merge_min_max(values.min(), values.max())
+
+    def merge_min_max(self, observed_min, observed_max):
+        observed_min, observed_max = to_python(observed_min), to_python(observed_max)
+        self.observed_min = observed_min if self.observed_min is None else min(self.observed_min, observed_min)
+        self.observed_max = observed_max if self.observed_max is None else max(self.observed_max, observed_max)
+
+    def merge(self, other):
+        super().merge(other)
+        if other.observed_min is not None:
+            self.merge_min_max(other.observed_min, other.observed_max)
+
+    def result(self):
+        success, result = super().result()
+        result["observed_min"] = self.observed_min
+        result["observed_max"] = self.observed_max
+        return success, result
+
+
+class ExpectColumnValuesToBeUnique(Expectation):
+    """
+        Tracks how often every value occurs by its 64 bit hash, kept as sorted arrays of
+        hash, count and one value. Chunks are kept as they come and merged once they outgrow the merged
+        arrays, so every hash is merged a logarithmic number of times and memory stays within
+        about twice the number of distinct values
+    """
+
+    def __init__(self, column):
+        super().__init__(column)
+        self.element_count = 0
+        self.hashes = np.empty(0, dtype=np.uint64)
+        self.counts = np.empty(0, dtype=np.int64)
+        self.values = None
+        # (hashes, counts, values) of chunks not merged yet
+        self.pending = []
+        self.pending_size = 0
+
+    def add(self, hashes, counts, values):
+        self.pending.append((hashes, counts, values))
+        self.pending_size += len(hashes)
+        if self.pending_size > len(self.hashes):
+            self.compact()
+
+    def compact(self):
+        if not self.pending:
+            return
+        parts = ([] if self.values is None else [(self.hashes, self.counts, self.values)]) + self.pending
+        all_hashes = np.concatenate([hashes for hashes, _, _ in parts])
+        self.hashes, first_index, inverse = np.unique(all_hashes, return_index=True, return_inverse=True)
+        self.counts = np.bincount(inverse, weights=np.concatenate([counts for _, counts, _ in parts]),
+                                  minlength=len(self.hashes)).astype(np.int64)
+        self.values = np.concatenate([values for _, _, values in parts])[first_index]
+        self.pending = []
+        self.pending_size = 0
+
+    def update(self, view):
+        self.element_count += len(view.series)
+        values = view.non_null.to_numpy()
+        hashes, first_index, counts = np.unique(pd.util.hash_array(values), return_index=True, return_counts=True)
+        self.add(hashes, counts, values[first_index])
+
+    def merge(self, other):
+        self.element_count += other.element_count
+        if other.values is not None:
+            self.add(other.hashes, other.counts, other.values)
+        for hashes, counts, values in other.pending:
+            self.add(hashes, counts, values)
+
+    def result(self):
+        self.compact()
+        if self.values is None:
+            return True, {"element_count": self.element_count, "unexpected_count": 0, "partial_unexpected_list": []}
+        duplicated = self.counts > 1
+        duplicated_values = pd.Series(np.repeat(self.values[duplicated], self.counts[duplicated]))
+        return not duplicated.any(), {
+            "element_count": self.element_count,
+            "unexpected_count": int(self.counts[duplicated].sum()),
+            "partial_unexpected_list": duplicated_values.sort_values().iloc[:partial_unexpected_count].tolist(),
+        }
+
+
+class ExpectColumnValuesToNotBeNull(UnexpectedValues):
+    def update(self, view):
+        null_count = int(view.null_mask.sum())
+        self.element_count += len(view.series)
+        self.unexpected_count += null_count
+        self.partial_unexpected_list = (self.partial_unexpected_list
+                                        + [None] * null_count)[:partial_unexpected_count]
+
+
+table_expectations = {
+    "expect_table_columns_to_match_ordered_list": ExpectTableColumnsToMatchOrderedList,
+}
+
+column_expectations = {
+    "expect_column_values_to_be_of_type": ExpectColumnValuesToBeOfType,
+    "expect_column_values_to_be_in_set": ExpectColumnValuesToBeInSet,
+    "expect_column_values_to_be_between": ExpectColumnValuesToBeBetween,
+    "expect_column_values_to_be_unique": ExpectColumnValuesToBeUnique,
+    "expect_column_values_to_not_be_null": ExpectColumnValuesToNotBeNull,
+}
+
+
+def build_accumulators(rules):
+    """
+        :param rules: list of (expectation, column, kwargs), column is None for table expectations
+        :return : list of (expectation name, state), one per rule
+    """
+    accumulators = []
+    for expectation, column, kwargs in rules:
+        expectation_class = table_expectations.get(expectation) or column_expectations[expectation]
+        accumulators.append((expectation, expectation_class(column, **kwargs)))
+    return accumulators
+
+
+def update_accumulators(accumulators, df):
+    views = {}
+    for expectation, state in accumulators:
+        if expectation in table_expectations:
+            state.update(df)
+        elif state.column in df.columns:
+            if state.column not in views:
+                views[state.column] = ColumnView(df[state.column])
+            state.update(views[state.column])
+
+
+def merge_accumulators(partial_accumulators):
+    """
+        Combines the states of several chunks or workers, all built from the same rules table
+    """
+    merged = partial_accumulators[0]
+    for accumulators in partial_accumulators[1:]:
+        for (_, state), (_, other_state) in zip(merged, accumulators):
+            state.merge(other_state)
+    return merged
+
+
+def results_from_accumulators(accumulators, columns):
+    results = []
+    for expectation, state in accumulators:
+        config_kwargs = dict(state.kwargs)
+        if state.column is None:
+            success, result = state.result()
+        else:
+            config_kwargs["column"] = state.column
+            if state.column in columns:
+                success, result = state.result()
+            else:
+                success, result = False, {"observed_value": f"column {state.column} not found"}
+
+        results.append({
+            "expectation_config": {"type": expectation, "kwargs": config_kwargs},
+            "success": bool(success),
+            "result": result,
+        })
+    return {"success": all(r["success"] for r in results), "results": results}
+
+
+def validate(df, rules):
+    """
+        Evaluates a rules table on a dataframe
+        :param df: dataframe to validate
+        :param rules: list of (expectation, column, kwargs), column is None for table expectations
+        :return : dict in the layout of great_expectations validation results
+    """
+    accumulators = build_accumulators(rules)
+    update_accumulators(accumulators, df)
+    return results_from_accumulators(accumulators, df.columns)
+
+
+def validate_row_groups(parquet_file, row_groups, rules, batch_size):
+    """
+        Validates some row groups of a parquet file batch by batch
+        :return : list of (expectation name, state) to be merged with merge_accumulators
+    """
+    accumulators = build_accumulators(rules)
+    for batch in pq.ParquetFile(parquet_file).iter_batches(batch_size=batch_size, row_groups=row_groups):
+        update_accumulators(accumulators, batch.to_pandas())
+    return accumulators
+
+
+def validate_parquet_partition(root_folder, rules, batch_size=100_000, max_workers=None):
+    """
+        Evaluates a rules table on a parquet partition without loading it in memory.
+        Row groups are validated in batches by a pool of worker processes and the partial states merged.
+        :param root_folder: partition folder
+        :param rules: list of (expectation, column, kwargs), column is None for table expectations
+        :param batch_size: number of rows validated at a time by one worker
+        :param max_workers: number of worker processes, 1 validates in this process
+        :return : dict in the layout of great_expectations validation results
+    """
+    parquet_files = sorted(glob.glob(f"{root_folder}/*.parquet"))
+    tasks = [(file, [row_group])
+             for file in parquet_files
+             for row_group in range(pq.ParquetFile(file).num_row_groups)]
+
+    if not tasks:
+        partial_accumulators = [build_accumulators(rules)]
+    elif max_workers == 1 or len(tasks) <= 1:
+        partial_accumulators = [validate_row_groups(file, row_groups, rules, batch_size)
+                                for file, row_groups in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as workers:
+            futures = [workers.submit(validate_row_groups, file, row_groups, rules, batch_size)
+                       for file, row_groups in tasks]
+            partial_accumulators = [future.result() for future in futures]
+
+    # an empty partition may have no file to read the columns from, its column rules fail as not found
+    columns = pq.read_schema(parquet_files[0]).names if parquet_files else []
+    return results_from_accumulators(merge_accumulators(partial_accumulators), columns)